@@ -33,12 +33,12 @@ class MyObservationsClient(txbom.observations.Client):
         '''
         if self.observations:
             if self.observations.current:
-                print "Current observation data:"
-                print self.observations.current
+                print("Current observation data:")
+                print(self.observations.current)
             else:
-                print "No current observation"
+                print("No current observation")
         else:
-            print "No observations"
+            print("No observations")
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -20,10 +20,10 @@ def demo(observation_url):
     if observations:
         # observations typically contains many (hundreds, perhaps),
         # lets just print out the current observation.
-        print "Current observation data:"
-        print observations.current
+        print("Current observation data:")
+        print(observations.current)
     else:
-        print "No observations retrieved"
+        print("No observations retrieved")
 
     # this is the end of the test, stop reactor to finish script
     reactor.callLater(0.1, reactor.stop)
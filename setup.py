@@ -4,7 +4,11 @@
 A distutils installation script for txBOM.
 """
 
-from distutils.core import setup
+try:
+    # setuptools supports extras_require
+    from setuptools import setup
+except ImportError:
+    from distutils.core import setup
 import txbom
 
 
@@ -25,7 +29,7 @@ setup(name='txbom',
       license='http://www.opensource.org/licenses/mit-license.php',
       url='https://github.com/claws/txBOM',
       download_url='https://github.com/claws/txBOM/tarball/master',
-      packages=['txbom'],
+      packages=['txbom', 'txbom.test'],
       classifiers=['Development Status :: 4 - Beta',
                    'Environment :: Console',
                    'Intended Audience :: End Users/Desktop',
@@ -38,5 +42,7 @@ setup(name='txbom',
                    'Topic :: Home Automation',
                    'Topic :: System :: Monitoring',
                    'Topic :: Software Development :: Libraries :: Python Modules'],
-      requires=['Twisted']
+      requires=['Twisted'],
+      # txbom.derived needs numpy
+      extras_require={'derived': ['numpy']}
       )
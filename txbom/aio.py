@@ -0,0 +1,417 @@
+
+"""
+An asyncio front-end for retrieving forecasts and observations.
+
+This module requires Python 3.5 or later.
+
+Two transports are available:
+
+TWISTED uses the existing Twisted retrieval code. Twisted must be running
+on the asyncio event loop using twisted.internet.asyncioreactor, which
+must be installed before the Twisted reactor is first imported. Deferreds
+are converted to futures on the same event loop so no thread handoffs
+are made.
+
+ASYNCIO uses asyncio streams directly and needs no Twisted reactor.
+
+Both transports share the txbom parsing code, so the results are the
+same Observations objects and forecast strings returned by the Twisted
+API.
+"""
+
+import asyncio
+import datetime
+import json
+import logging
+import re
+import zlib
+from urllib.parse import urljoin, urlsplit
+from txbom import forecasts, observations
+from txbom.observations import AIFSTIME_UTC, Observations
+from txbom.products import forecastId, isValidObservationUrl
+
+
+TWISTED = "twisted"
+ASYNCIO = "asyncio"
+
+# Delay between the data timestamp of the latest observation and the
+# first request for the next update. See observations.Client for details.
+RefreshOffset = datetime.timedelta(minutes=37)
+
+# Delay before retrying a failed retrieval
+RetryDelayInSeconds = 10
+
+# The default port of each supported URL scheme
+DefaultPorts = {"http": 80, "https": 443}
+
+# Redirects followed by fetch, up to MaxRedirects for each request
+RedirectCodes = (301, 302, 303, 307, 308)
+MaxRedirects = 5
+
+# The most data read from a response at a time
+ReadSize = 64 * 1024
+
+PasvPattern = re.compile(r"(\d+),(\d+),(\d+),(\d+),(\d+),(\d+)")
+
+
+def _asFuture(d):
+    """
+    Convert a Deferred into a future on the running event loop.
+    """
+    return d.asFuture(asyncio.get_event_loop())
+
+
+class _BodyDecoder(object):
+    """
+    Decompress a response body as each chunk arrives, the asyncio
+    equivalent of web.DecodingBodyProtocol.
+    """
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.chunks = []
+        self.received = 0
+        self.decoded = 0
+
+        if encoding == "gzip":
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            self.decoder = zlib.decompressobj(zlib.MAX_WBITS)
+        else:
+            self.decoder = None
+
+    def _decode(self, data):
+        try:
+            return self.decoder.decompress(data)
+        except zlib.error:
+            if self.encoding == "deflate" and self.received == len(data):
+                # Some servers send raw deflate data without the zlib
+                # header. Switch decoders on the first chunk only.
+                self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                return self.decoder.decompress(data)
+            raise
+
+    def dataReceived(self, data):
+        self.received += len(data)
+        if self.decoder:
+            data = self._decode(data)
+        self.decoded += len(data)
+        self.chunks.append(data)
+
+    def finish(self):
+        """
+        Return the decoded body.
+        """
+        if self.decoder:
+            data = self.decoder.flush()
+            self.decoded += len(data)
+            self.chunks.append(data)
+        return b"".join(self.chunks)
+
+
+async def _readHttpBody(reader, headers, dataReceived):
+    """
+    Pass each chunk of the raw body of a HTTP/1.1 response to
+    dataReceived, handling chunked transfer encoding.
+    """
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size = int((await reader.readline()).split(b";", 1)[0].strip(), 16)
+            if size == 0:
+                # consume any trailers up to the terminating blank line
+                while (await reader.readline()).strip():
+                    pass
+                break
+            dataReceived(await reader.readexactly(size))
+            await reader.readline()
+        return
+
+    remaining = int(headers["content-length"]) if "content-length" in headers else None
+    while remaining is None or remaining > 0:
+        size = ReadSize if remaining is None else min(ReadSize, remaining)
+        data = await reader.read(size)
+        if not data:
+            if remaining:
+                raise asyncio.IncompleteReadError(b"", remaining)
+            break
+        if remaining is not None:
+            remaining -= len(data)
+        dataReceived(data)
+
+
+async def _request(url, compressed):
+    """
+    Make a GET request and return the status code, headers, reader and
+    writer once the headers have been read.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in DefaultPorts:
+        raise ValueError("Unsupported URL scheme: %s" % url)
+
+    path = parts.path or "/"
+    if parts.query:
+        path = "%s?%s" % (path, parts.query)
+
+    reader, writer = await asyncio.open_connection(parts.hostname,
+                                                   parts.port or DefaultPorts[parts.scheme],
+                                                   ssl=parts.scheme == "https")
+    try:
+        request = ["GET %s HTTP/1.1" % path,
+                   "Host: %s" % parts.netloc,
+                   "User-Agent: %s" % observations.UserAgent.decode("ascii"),
+                   "Connection: close"]
+        if compressed:
+            request.append("Accept-Encoding: gzip, deflate")
+        writer.write(("\r\n".join(request) + "\r\n\r\n").encode("ascii"))
+
+        status = (await reader.readline()).decode("latin-1").split(None, 2)
+        code = int(status[1])
+
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    except Exception:
+        writer.close()
+        raise
+
+    return code, " ".join(status[1:]).strip(), headers, reader, writer
+
+
+async def fetch(url, compressed=True, stats=None):
+    """
+    Retrieve a http or https URL using asyncio streams, following
+    redirects. When compressed is True a gzip or deflate content encoding
+    is requested and decoded as the response arrives.
+
+    @param stats: An optional observations.TransferStats updated, along
+                  with observations.transferStats, once complete.
+
+    @return: The response body as bytes
+    """
+    for _redirect in range(MaxRedirects + 1):
+        code, status, headers, reader, writer = await _request(url, compressed)
+        try:
+            if code in RedirectCodes and "location" in headers:
+                url = urljoin(url, headers["location"])
+                continue
+
+            if code != 200:
+                raise IOError("HTTP request for %s failed: %s" % (url, status))
+
+            encoding = headers.get("content-encoding", "").lower() or None
+            if encoding == "identity":
+                encoding = None
+            elif encoding not in (None, "gzip", "deflate"):
+                raise IOError("Unsupported content encoding: %s" % encoding)
+
+            decoder = _BodyDecoder(encoding)
+            await _readHttpBody(reader, headers, decoder.dataReceived)
+            body = decoder.finish()
+        finally:
+            writer.close()
+
+        for s in (observations.transferStats, stats):
+            if s is not None:
+                s.record(encoding, decoder.received, decoder.decoded)
+        return body
+
+    raise IOError("Too many redirects retrieving %s" % url)
+
+
+async def _ftpResponse(reader):
+    """
+    Read a, possibly multi-line, FTP response and return (code, text).
+    """
+    line = (await reader.readline()).decode("latin-1")
+    code = line[:3]
+    lines = [line]
+    if line[3:4] == "-":
+        while not (line[:3] == code and line[3:4] == " "):
+            line = (await reader.readline()).decode("latin-1")
+            lines.append(line)
+    return int(code), "".join(lines)
+
+
+async def _ftpCommand(reader, writer, command, expected):
+    writer.write(("%s\r\n" % command).encode("latin-1"))
+    code, text = await _ftpResponse(reader)
+    if code not in expected:
+        raise IOError("FTP command %s failed: %s" % (command.split()[0], text.strip()))
+    return text
+
+
+async def retrieveFile(path, host=forecasts.BomFtpHost, port=forecasts.BomFtpPort):
+    """
+    Retrieve a file from the BOM FTP server using a passive mode
+    anonymous session over asyncio streams.
+
+    @return: The file content as bytes
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        code, text = await _ftpResponse(reader)
+        if code != 220:
+            raise IOError("FTP server refused connection: %s" % text.strip())
+        await _ftpCommand(reader, writer, "USER anonymous", (230, 331))
+        await _ftpCommand(reader, writer, "PASS guest", (230, 202))
+        await _ftpCommand(reader, writer, "TYPE I", (200,))
+        text = await _ftpCommand(reader, writer, "PASV", (227,))
+
+        numbers = [int(n) for n in PasvPattern.search(text).groups()]
+        dataReader, dataWriter = await asyncio.open_connection(
+            ".".join(str(n) for n in numbers[:4]), numbers[4] * 256 + numbers[5])
+        try:
+            await _ftpCommand(reader, writer, "RETR %s" % path, (125, 150))
+            data = await dataReader.read()
+        finally:
+            dataWriter.close()
+
+        code, text = await _ftpResponse(reader)
+        if code not in (226, 250):
+            raise IOError("FTP transfer of %s failed: %s" % (path, text.strip()))
+
+        try:
+            await _ftpCommand(reader, writer, "QUIT", (221,))
+        except Exception as ex:
+            logging.error("FTP session failed to quit properly")
+            logging.exception(ex)
+
+        return data
+    finally:
+        writer.close()
+
+
+async def get_forecast(forecast_id, transport=TWISTED):
+    """
+    Retrieve a text forecast. The coroutine equivalent of
+    forecasts.get_forecast.
+
+    @return: The forecast string or None
+    """
+    if transport == TWISTED:
+        return await _asFuture(forecasts.get_forecast(forecast_id))
+
+    if forecastId(forecast_id) is None:
+        logging.error("Invalid forecast identifier: %s" % forecast_id)
+        return None
+
+    try:
+        data = await retrieveFile(forecasts.BomFtpForecastPath % forecastId(forecast_id))
+        forecast = data.decode(forecasts.ForecastEncoding).replace("\r", "")
+        logging.debug("Forecast retrieval successful")
+        return forecast
+    except Exception as ex:
+        logging.error("Connection to forecast FTP server failed")
+        logging.exception(ex)
+        return None
+
+
+async def get_observations(observation_url, transport=TWISTED, compressed=True, stats=None):
+    """
+    Retrieve the latest observations. The coroutine equivalent of
+    observations.get_observations.
+
+    @return: An Observations object or None
+    """
+    if transport == TWISTED:
+        client = observations.Client(compressed=compressed)
+        if stats is not None:
+            client.transferStats = stats
+        return await _asFuture(client.get_observations(observation_url))
+
+    if not isValidObservationUrl(observation_url):
+        logging.error("Invalid observations URL: %s" % observation_url)
+        return None
+
+    try:
+        logging.debug("Requesting new observation data from: %s" % observation_url)
+        jsonString = await fetch(observation_url, compressed=compressed, stats=stats)
+        logging.debug("Retrieved new observation data")
+        return Observations(json.loads(jsonString))
+    except Exception as ex:
+        logging.error("Unable to retrieve observations data:")
+        logging.exception(ex)
+        return None
+
+
+class ObservationUpdates(object):
+    """
+    An asynchronous iterator of observation updates for a station. It is
+    the asyncio equivalent of observations.Client and uses the same
+    schedule: the first update is retrieved immediately, subsequent
+    retrievals are timed to occur shortly after the BOM publishes new
+    data.
+
+    Only updates containing new data are produced.
+
+    async for obs in ObservationUpdates(url):
+        print(obs.current.air_temp)
+    """
+
+    def __init__(self, observation_url, transport=TWISTED, compressed=True):
+        self.observation_url = observation_url
+        self.transport = transport
+        self.compressed = compressed
+        self.transferStats = observations.TransferStats()
+        self.observations = None
+        self.nextRefresh = None
+        self.closed = False
+
+    def close(self):
+        """
+        Stop producing updates. Iteration ends at the next update.
+        """
+        self.closed = True
+
+    def __aiter__(self):
+        return self
+
+    def _delayUntilNextRefresh(self):
+        if self.nextRefresh is None:
+            return 0
+        return max(0, (self.nextRefresh - datetime.datetime.utcnow()).total_seconds())
+
+    def _scheduleNextRefresh(self, latest):
+        timestamp = getattr(latest.current, AIFSTIME_UTC, None) if latest else None
+        if not timestamp:
+            self.nextRefresh = datetime.datetime.utcnow() + \
+                datetime.timedelta(seconds=RetryDelayInSeconds)
+            return
+
+        period = observations.Client.Update_Frequency_In_Seconds
+        nextRefresh = datetime.datetime.strptime(timestamp, "%Y%m%d%H%M%S") + RefreshOffset
+        now = datetime.datetime.utcnow()
+        if nextRefresh <= now:
+            # skip forward by whole update periods
+            periods = int((now - nextRefresh).total_seconds() // period) + 1
+            nextRefresh += datetime.timedelta(seconds=periods * period)
+        self.nextRefresh = nextRefresh
+
+    async def __anext__(self):
+        while not self.closed:
+            await asyncio.sleep(self._delayUntilNextRefresh())
+            if self.closed:
+                break
+
+            latest = await get_observations(self.observation_url,
+                                            transport=self.transport,
+                                            compressed=self.compressed,
+                                            stats=self.transferStats)
+            previous = self.observations
+            self._scheduleNextRefresh(latest)
+
+            if latest is None or latest.current is None:
+                continue
+
+            if previous is not None and \
+               getattr(previous.current, AIFSTIME_UTC, None) == getattr(latest.current, AIFSTIME_UTC, None):
+                continue
+
+            self.observations = latest
+            return latest
+
+        raise StopAsyncIteration
@@ -0,0 +1,434 @@
+
+"""
+Archive observation histories and parsed forecasts in a compact columnar
+file format.
+
+Rows are stored in groups of up to rowGroupSize rows. Within a group the
+values of each field are stored together as a separately compressed
+column chunk. The type of each chunk is chosen from its values:
+
+int    - strings that are all integers, stored as 64 bit integers
+float  - strings that are all floats, stored as doubles
+dict   - repetitive strings such as weather, cloud and wind_dir, stored
+         once in a dictionary with a small integer code per row
+text   - mostly unique strings, such as the raw forecast text
+json   - other values, such as the five day forecast list
+null   - columns without any values
+
+Numbers are only stored as numbers when the original string can be
+recreated exactly, so reading an archive returns the same values that
+were written.
+
+A footer at the end of the file records the position of every chunk and
+the time range of each group. Readers only decompress the chunks of the
+columns they ask for, and skip groups outside the requested time range
+without decoding them.
+
+For example:
+
+exportObservations("adelaide.txa", [observations1, observations2])
+reader = ArchiveReader("adelaide.txa")
+temps = reader.read([AIR_TEMP], start="20130104000000")
+
+This module does not depend on Twisted.
+"""
+
+import datetime
+import json
+import math
+import struct
+import zlib
+from txbom.observations import AIFSTIME_UTC, WMO, Observation
+
+
+Magic = b"TXBOMARC"
+FormatVersion = 1
+
+# The number of rows in each group
+RowGroupSize = 4096
+
+# The column holding the time of each row, as an integer of the form
+# YYYYMMDDHHMMSS, that time range filtering is based on. For observations
+# it is the UTC observation time. For forecasts it is the local issue
+# time.
+TIME = "_time"
+
+OBSERVATIONS = "observations"
+FORECASTS = "forecasts"
+
+# The forecast field holding the list of five day forecast tuples
+FIVE_DAYS = "fcast_five_days"
+
+IntMissing = -2 ** 63
+
+# Dictionary encode string columns with fewer distinct values than this
+# fraction of their rows.
+DictionaryRatio = 0.5
+
+PrefixStruct = struct.Struct("<8sI")
+FooterLengthStruct = struct.Struct("<I")
+
+
+def _isInt(value):
+    try:
+        return str(int(value)) == value and int(value) != IntMissing and \
+            -2 ** 63 <= int(value) < 2 ** 63
+    except (TypeError, ValueError):
+        return False
+
+
+def _isFloat(value):
+    try:
+        f = float(value)
+    except (TypeError, ValueError):
+        return False
+    return repr(f) == value and not (math.isnan(f) or math.isinf(f))
+
+
+def _isString(value):
+    try:
+        return isinstance(value, basestring)
+    except NameError:
+        return isinstance(value, str)
+
+
+def _native(value):
+    """
+    Return JSON decoded strings as the native str type.
+    """
+    if value is not None and not isinstance(value, str):
+        value = value.encode("utf-8")
+    return value
+
+
+def _pack(fmt, values):
+    return struct.pack("<%i%s" % (len(values), fmt), *values)
+
+
+def _unpack(fmt, data):
+    return list(struct.unpack("<%i%s" % (len(data) // 8, fmt), data))
+
+
+def encodeColumn(values):
+    """
+    Encode a list of column values.
+
+    @return: A (type, data) tuple.
+    """
+    present = [v for v in values if v is not None]
+    if not present:
+        return "null", b""
+
+    if all([_isString(v) for v in present]):
+        if all([_isInt(v) for v in present]):
+            return "int", _pack("q", [IntMissing if v is None else int(v) for v in values])
+
+        if all([_isFloat(v) for v in present]):
+            return "float", _pack("d", [float("nan") if v is None else float(v) for v in values])
+
+        distinct = sorted(set(present))
+        if len(distinct) <= len(values) * DictionaryRatio:
+            codes = dict((v, i + 1) for i, v in enumerate(distinct))
+            header = json.dumps(distinct).encode("utf-8")
+            codeFormat = "H" if len(distinct) < 2 ** 16 else "I"
+            return "dict", struct.pack("<cI", codeFormat.encode("ascii"), len(header)) + header + \
+                struct.pack("<%i%s" % (len(values), codeFormat),
+                            *[codes[v] if v is not None else 0 for v in values])
+
+        return "text", json.dumps(values).encode("utf-8")
+
+    return "json", json.dumps(values).encode("utf-8")
+
+
+def decodeColumn(kind, data, rows):
+    """
+    Decode a column chunk produced by encodeColumn.
+
+    @return: A list of column values.
+    """
+    if kind == "null":
+        return [None] * rows
+
+    if kind == "int":
+        return [None if v == IntMissing else str(v) for v in _unpack("q", data)]
+
+    if kind == "float":
+        return [None if math.isnan(v) else repr(v) for v in _unpack("d", data)]
+
+    if kind == "dict":
+        codeFormat, headerLength = struct.unpack_from("<cI", data)
+        start = struct.calcsize("<cI")
+        distinct = [None] + [_native(v) for v in json.loads(data[start:start + headerLength].decode("utf-8"))]
+        codes = struct.unpack_from("<%i%s" % (rows, codeFormat.decode("ascii")), data,
+                                   start + headerLength)
+        return [distinct[c] for c in codes]
+
+    if kind == "text":
+        return [_native(v) for v in json.loads(data.decode("utf-8"))]
+
+    if kind == "json":
+        return json.loads(data.decode("utf-8"))
+
+    raise ValueError("Unknown column type: %s" % kind)
+
+
+def _timeValue(value):
+    """
+    Convert a time bound, a datetime or a YYYYMMDDHHMMSS string or
+    integer, to an integer.
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        value = value.strftime("%Y%m%d%H%M%S")
+    return int(value)
+
+
+def forecastTime(forecast):
+    """
+    Return the local issue time of a forecast dict as a YYYYMMDDHHMMSS
+    integer, or None if it can't be determined.
+    """
+    try:
+        issued = datetime.datetime.strptime("%s %s" % (forecast["fcast_date"], forecast["fcast_time"]),
+                                            "%A %d %B %Y %I:%M %p")
+    except (KeyError, TypeError, ValueError):
+        return None
+    return _timeValue(issued)
+
+
+def write(path, kind, rows, rowGroupSize=RowGroupSize):
+    """
+    Write a list of row dicts to an archive file. Each row must have a
+    TIME value, which may be None. Rows are sorted by time so that time
+    range queries can skip whole groups.
+    """
+    rows = sorted(rows, key=lambda row: (row[TIME] is not None, row[TIME]))
+
+    columns = []
+    seen = set()
+    for row in rows:
+        for name in row:
+            if name not in seen:
+                seen.add(name)
+                columns.append(name)
+
+    groups = []
+    with open(path, "wb") as f:
+        f.write(PrefixStruct.pack(Magic, FormatVersion))
+
+        for start in range(0, len(rows), rowGroupSize):
+            groupRows = rows[start:start + rowGroupSize]
+            times = [row[TIME] for row in groupRows if row[TIME] is not None]
+            chunks = {}
+            for name in columns:
+                values = [row.get(name) for row in groupRows]
+                if name == TIME:
+                    values = [None if v is None else str(v) for v in values]
+                columnKind, data = encodeColumn(values)
+                data = zlib.compress(data)
+                chunks[name] = [columnKind, f.tell(), len(data)]
+                f.write(data)
+            groups.append({"rows": len(groupRows),
+                           "timed": len(times),
+                           "min": min(times) if times else None,
+                           "max": max(times) if times else None,
+                           "chunks": chunks})
+
+        footer = zlib.compress(json.dumps({"kind": kind,
+                                           "columns": columns,
+                                           "groups": groups}).encode("utf-8"))
+        f.write(footer)
+        f.write(FooterLengthStruct.pack(len(footer)))
+        f.write(Magic)
+
+
+def observationRows(histories, unique=True):
+    """
+    Return a list of row dicts for the observations in histories.
+
+    @param histories: An iterable of Observations objects and/or
+                      Observation rows.
+    @param unique: Skip rows for a station and time that have already
+                   been seen, as successive polls mostly repeat the same
+                   rows.
+    """
+    rows = []
+    seen = set()
+    for item in histories:
+        for observation in getattr(item, "data", [item]):
+            timestamp = getattr(observation, AIFSTIME_UTC, None)
+            if unique:
+                key = (getattr(observation, WMO, None), timestamp)
+                if key in seen:
+                    continue
+                seen.add(key)
+            row = dict((f, getattr(observation, f)) for f in observation.fields)
+            row[TIME] = int(timestamp) if _isInt(timestamp) else None
+            rows.append(row)
+    return rows
+
+
+def exportObservations(path, histories, unique=True, rowGroupSize=RowGroupSize):
+    """
+    Write observation histories to an archive file.
+
+    @param histories: An iterable of Observations objects and/or
+                      Observation rows, e.g. every poll retrieved for a
+                      set of stations.
+    @param unique: Only store the first row seen for each station and
+                   observation time.
+
+    @return: The number of rows written
+    """
+    rows = observationRows(histories, unique)
+    write(path, OBSERVATIONS, rows, rowGroupSize)
+    return len(rows)
+
+
+def exportForecasts(path, forecasts, rowGroupSize=RowGroupSize):
+    """
+    Write forecast dicts, as returned by forecastToDict, to an archive
+    file.
+
+    @return: The number of rows written
+    """
+    rows = []
+    for forecast in forecasts:
+        if forecast is None:
+            continue
+        row = dict(forecast)
+        row[TIME] = forecastTime(forecast)
+        rows.append(row)
+    write(path, FORECASTS, rows, rowGroupSize)
+    return len(rows)
+
+
+class ArchiveReader(object):
+    """
+    Read columns from an archive file written by exportObservations or
+    exportForecasts.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            magic, version = PrefixStruct.unpack(f.read(PrefixStruct.size))
+            if magic != Magic or version != FormatVersion:
+                raise ValueError("%s is not a compatible archive" % path)
+
+            f.seek(-(FooterLengthStruct.size + len(Magic)), 2)
+            footerLength = FooterLengthStruct.unpack(f.read(FooterLengthStruct.size))[0]
+            if f.read(len(Magic)) != Magic:
+                raise ValueError("%s is incomplete" % path)
+
+            f.seek(-(footerLength + FooterLengthStruct.size + len(Magic)), 2)
+            footer = json.loads(zlib.decompress(f.read(footerLength)).decode("utf-8"))
+
+        self.kind = _native(footer["kind"])
+        self.columns = [_native(c) for c in footer["columns"] if c != TIME]
+        self.groups = footer["groups"]
+
+    def __len__(self):
+        return sum([group["rows"] for group in self.groups])
+
+    def _chunk(self, f, group, name):
+        chunk = group["chunks"].get(name)
+        if chunk is None:
+            return [None] * group["rows"]
+        kind, offset, length = chunk
+        f.seek(offset)
+        return decodeColumn(kind, zlib.decompress(f.read(length)), group["rows"])
+
+    def read(self, columns=None, start=None, end=None):
+        """
+        Read columns from the archive.
+
+        @param columns: The names of the columns to read. Defaults to all
+                        columns.
+        @param start: Only return rows at or after this time. A datetime
+                      or YYYYMMDDHHMMSS string.
+        @param end: Only return rows before this time.
+
+        @return: A dict of column name to a list of values.
+        @rtype: dict
+        """
+        if columns is None:
+            columns = self.columns
+        start = _timeValue(start)
+        end = _timeValue(end)
+        filtered = start is not None or end is not None
+
+        result = dict((name, []) for name in columns)
+        with open(self.path, "rb") as f:
+            for group in self.groups:
+                selected = None
+                if filtered:
+                    if group["min"] is None or \
+                       (start is not None and group["max"] < start) or \
+                       (end is not None and group["min"] >= end):
+                        continue
+
+                    inside = group["timed"] == group["rows"] and \
+                        (start is None or group["min"] >= start) and \
+                        (end is None or group["max"] < end)
+                    if not inside:
+                        # only some rows of the group are in range
+                        selected = []
+                        for i, t in enumerate(self._chunk(f, group, TIME)):
+                            if t is not None and (start is None or int(t) >= start) and \
+                               (end is None or int(t) < end):
+                                selected.append(i)
+
+                for name in columns:
+                    values = self._chunk(f, group, name)
+                    if selected is not None:
+                        values = [values[i] for i in selected]
+                    result[name].extend(values)
+        return result
+
+    def rows(self, columns=None, start=None, end=None):
+        """
+        Return a list of row dicts. See read for the arguments.
+        """
+        data = self.read(columns, start, end)
+        names = list(data)
+        return [dict(zip(names, values)) for values in zip(*[data[n] for n in names])]
+
+    def observations(self, columns=None, start=None, end=None):
+        """
+        Return a list of Observation rows. Fields missing from a row when
+        it was archived are returned as None.
+        """
+        result = []
+        for row in self.rows(columns, start, end):
+            observation = Observation.__new__(Observation)
+            observation.fields = sorted(row)
+            for field, value in row.items():
+                setattr(observation, field, value)
+            result.append(observation)
+        return result
+
+    def forecasts(self, columns=None, start=None, end=None):
+        """
+        Return a list of forecast dicts.
+        """
+        result = self.rows(columns, start, end)
+        for forecast in result:
+            if forecast.get(FIVE_DAYS) is not None:
+                forecast[FIVE_DAYS] = [tuple([_native(v) for v in day]) for day in forecast[FIVE_DAYS]]
+        return result
+
+
+def readObservations(path, columns=None, start=None, end=None):
+    """
+    Return a list of Observation rows from an archive file.
+    """
+    return ArchiveReader(path).observations(columns, start, end)
+
+
+def readForecasts(path, columns=None, start=None, end=None):
+    """
+    Return a list of forecast dicts from an archive file.
+    """
+    return ArchiveReader(path).forecasts(columns, start, end)
@@ -0,0 +1,418 @@
+
+"""
+Parse large batches of forecasts and observations away from the reactor
+thread.
+
+Parsing is CPU bound so large batches are split up and sent to a pool
+of worker processes. Small jobs are not worth the cost of shipping the
+data to another process and are run in the reactor's thread pool
+instead. Results are returned from the workers in a compact tuple form,
+rather than as pickled objects, and rebuilt in the calling process.
+
+For a handful of items the existing single item functions,
+forecastToDict and Observations, remain the fastest option.
+"""
+
+import json
+import logging
+import multiprocessing
+import sys
+import traceback
+from twisted.internet import defer, threads
+from txbom.forecasts import forecastToDict
+from txbom.observations import (Observations, Notice, Header, Observation,
+                                validateValue, OBSERVATIONS, NOTICE, HEADER,
+                                DATA)
+
+
+# The order of the values in a compact forecast tuple
+ForecastKeys = ["fcast_id",
+                "fcast_town",
+                "fcast_state",
+                "fcast_date",
+                "fcast_time",
+                "fcast_warnings",
+                "fcast_uv_alert",
+                "fcast_uv_index",
+                "fcast_uv_index_name",
+                "fcast_today",
+                "fcast_today_content",
+                "fcast_today_precis",
+                "fcast_today_temperature",
+                "fcast_tomorrow",
+                "fcast_tomorrow_precis",
+                "fcast_tomorrow_minimum",
+                "fcast_tomorrow_maximum",
+                "fcast_five_days",
+                "fcast_raw"]
+
+
+def compactForecast(forecast):
+    """
+    Parse a forecast string and return the forecast dict values as a
+    tuple ordered by ForecastKeys, or None if the forecast could not be
+    parsed.
+    """
+    forecastDict = parseForecast(forecast)
+    if forecastDict is None:
+        return None
+    return tuple([forecastDict[k] for k in ForecastKeys])
+
+
+def parseForecast(forecast):
+    """
+    Parse a forecast string into a forecast dict, or return None if it
+    could not be parsed, failing in the same way as compactForecast.
+    """
+    try:
+        return forecastToDict(forecast)
+    except Exception as ex:
+        logging.error("Unable to parse forecast")
+        logging.exception(ex)
+        return None
+
+
+def expandForecast(compact):
+    """
+    Rebuild a forecast dict from its compact tuple form.
+    """
+    if compact is None:
+        return None
+    return dict(zip(ForecastKeys, compact))
+
+
+def _compactSection(inDict):
+    """
+    Return a (fields, values) tuple of validated section values.
+    """
+    fields = tuple(sorted([str(k) for k in inDict]))
+    values = tuple([validateValue(inDict[k]) for k in fields])
+    return fields, values
+
+
+def compactObservations(jsonString):
+    """
+    Decode an observations JSON string and return it in compact form, or
+    None if it could not be decoded.
+
+    The compact form is a tuple of (notice, header, fieldSets, rows). The
+    notice and header are (fields, values) tuples. Each row is a tuple of
+    (fieldSetIndex, values) where fieldSetIndex refers to the tuple of
+    field names in fieldSets. BOM responses use the same fields for every
+    row so the field names are only sent once.
+    """
+    try:
+        jsonData = json.loads(jsonString)
+        observations = jsonData[OBSERVATIONS]
+        notice = _compactSection(observations[NOTICE][0])
+        header = _compactSection(observations[HEADER][0])
+
+        fieldSets = []
+        fieldSetIndexes = {}
+        rows = []
+        for dataDict in observations[DATA]:
+            fields, values = _compactSection(dataDict)
+            index = fieldSetIndexes.get(fields)
+            if index is None:
+                index = fieldSetIndexes[fields] = len(fieldSets)
+                fieldSets.append(fields)
+            rows.append((index, values))
+
+        return (notice, header, tuple(fieldSets), tuple(rows))
+
+    except Exception as ex:
+        logging.error("Unable to decode observations data")
+        logging.exception(ex)
+        return None
+
+
+def parseObservations(jsonString):
+    """
+    Decode an observations JSON string into an Observations object, or
+    return None if it could not be decoded, failing in the same way as
+    compactObservations.
+    """
+    try:
+        return Observations(json.loads(jsonString))
+    except Exception as ex:
+        logging.error("Unable to decode observations data")
+        logging.exception(ex)
+        return None
+
+
+def _packSection(section):
+    """
+    Return a (fields, values) tuple for a parsed ResponseSection.
+    """
+    fields = tuple(section.fields)
+    return fields, tuple([getattr(section, f) for f in fields])
+
+
+def packObservations(observations):
+    """
+    Return an Observations object in the compact form produced by
+    compactObservations, so that already parsed observations can be
+    passed to another process cheaply.
+    """
+    if observations is None:
+        return None
+
+    fieldSets = []
+    fieldSetIndexes = {}
+    rows = []
+    for observation in observations.data:
+        fields, values = _packSection(observation)
+        index = fieldSetIndexes.get(fields)
+        if index is None:
+            index = fieldSetIndexes[fields] = len(fieldSets)
+            fieldSets.append(fields)
+        rows.append((index, values))
+
+    return (_packSection(observations.notice), _packSection(observations.header),
+            tuple(fieldSets), tuple(rows))
+
+
+def _buildSection(cls, fields, values):
+    """
+    Create a ResponseSection subclass instance from values that have
+    already been validated.
+    """
+    section = cls.__new__(cls)
+    section.fields = list(fields)
+    for field, value in zip(fields, values):
+        setattr(section, field, value)
+    return section
+
+
+def expandObservations(compact):
+    """
+    Rebuild an Observations object from its compact form.
+    """
+    if compact is None:
+        return None
+
+    notice, header, fieldSets, rows = compact
+    observations = Observations.__new__(Observations)
+    observations.notice = _buildSection(Notice, *notice)
+    observations.header = _buildSection(Header, *header)
+    observations.data = [_buildSection(Observation, fieldSets[index], values)
+                         for index, values in rows]
+    return observations
+
+
+def _runBatch(func, items):
+    """
+    Apply func to every item in a worker process. Exceptions are trapped
+    and returned as a formatted traceback so that the caller's Deferred
+    always fires.
+    """
+    try:
+        return (True, [func(item) for item in items])
+    except Exception:
+        return (False, traceback.format_exc())
+
+
+class BulkParser(object):
+    """
+    Parse batches of forecast strings or observation JSON strings using a
+    pool of worker processes.
+
+    Jobs with fewer than threadThreshold items are run in the reactor's
+    thread pool rather than being sent to the process pool. Larger jobs
+    are split into batches of batchSize items which are parsed in
+    parallel.
+
+    The process pool is created when start is called and must be shut
+    down using stop.
+    """
+
+    def __init__(self, processes=None, batchSize=200, threadThreshold=20):
+        self.processes = processes
+        self.batchSize = batchSize
+        self.threadThreshold = threadThreshold
+        self.pool = None
+
+    def start(self):
+        """
+        Create the worker process pool.
+        """
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes)
+
+    def stop(self):
+        """
+        Shut down the worker process pool.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def _submit(self, func, items):
+        """
+        Send a batch to the process pool and return a Deferred that fires
+        with the list of results.
+        """
+        # imported here so that importing this module, as the worker
+        # processes do, doesn't install the default reactor.
+        from twisted.internet import reactor
+
+        d = defer.Deferred()
+
+        def resultReceived(result):
+            ok, value = result
+            if ok:
+                d.callback(value)
+            else:
+                d.errback(Exception(value))
+
+        if sys.version_info >= (3,):
+            # The callbacks are called from the pool's result handling
+            # thread. The error callback is used when the batch couldn't
+            # be sent to a worker, e.g. an item isn't picklable.
+            self.pool.apply_async(_runBatch, (func, items),
+                                  callback=lambda result: reactor.callFromThread(resultReceived, result),
+                                  error_callback=lambda ex: reactor.callFromThread(d.errback, ex))
+        else:
+            # Python 2 pools don't support error callbacks so wait for the
+            # result in a thread, which also sees those failures.
+            asyncResult = self.pool.apply_async(_runBatch, (func, items))
+            threads.deferToThread(asyncResult.get).addCallbacks(resultReceived, d.errback)
+        return d
+
+    def _parse(self, func, items):
+        """
+        Apply func to all items, off the reactor thread, and return a
+        Deferred that fires with the list of results in the same order
+        as the items.
+        """
+        items = list(items)
+
+        if len(items) < self.threadThreshold or self.pool is None:
+            return threads.deferToThread(lambda: [func(item) for item in items])
+
+        batches = []
+        for i in range(0, len(items), self.batchSize):
+            batches.append(self._submit(func, items[i:i + self.batchSize]))
+
+        d = defer.gatherResults(batches, consumeErrors=True)
+
+        def flatten(batchResults):
+            results = []
+            for batchResult in batchResults:
+                results.extend(batchResult)
+            return results
+
+        d.addCallback(flatten)
+        return d
+
+    def parseForecasts(self, forecasts):
+        """
+        Parse a sequence of forecast strings.
+
+        @param forecasts: A sequence of forecast strings.
+
+        @return: A deferred that returns a list of forecast dicts, with
+                 None in place of any forecast that could not be parsed.
+        @rtype: defer.Deferred
+        """
+        d = self._parse(compactForecast, forecasts)
+        d.addCallback(lambda results: [expandForecast(r) for r in results])
+        return d
+
+    def parseObservations(self, jsonStrings):
+        """
+        Parse a sequence of observation JSON strings.
+
+        @param jsonStrings: A sequence of JSON strings as retrieved from
+                            the BOM observations URLs.
+
+        @return: A deferred that returns a list of Observations objects,
+                 with None in place of any that could not be parsed.
+        @rtype: defer.Deferred
+        """
+        d = self._parse(compactObservations, jsonStrings)
+        d.addCallback(lambda results: [expandObservations(r) for r in results])
+        return d
+
+
+class OffReactorParser(object):
+    """
+    Parse individual forecast and observation payloads off the reactor
+    thread so that large payloads, or bursts of payloads arriving at the
+    same time, don't stall the event loop.
+
+    Payloads smaller than inlineThreshold bytes are cheap to parse and
+    are parsed inline. Larger payloads are handed to the worker process
+    pool of a BulkParser, or to the reactor's thread pool if the
+    BulkParser has not been started. No more than maxConcurrent payloads
+    are handed off at a time; further payloads wait in a queue until a
+    worker becomes free, keeping the amount of outstanding work bounded.
+
+    Pass an instance to an observations Client, or to the module level
+    get_observations function, to enable off reactor parsing.
+    """
+
+    def __init__(self, bulkParser=None, maxConcurrent=4, inlineThreshold=16 * 1024):
+        if bulkParser is None:
+            bulkParser = BulkParser(processes=maxConcurrent)
+        self.bulkParser = bulkParser
+        self.inlineThreshold = inlineThreshold
+        self.semaphore = defer.DeferredSemaphore(maxConcurrent)
+
+    def start(self):
+        """
+        Start the underlying worker process pool.
+        """
+        self.bulkParser.start()
+
+    def stop(self):
+        """
+        Stop the underlying worker process pool.
+        """
+        self.bulkParser.stop()
+
+    @property
+    def pending(self):
+        """
+        Return the number of payloads waiting for a free worker.
+        """
+        return len(self.semaphore.waiting)
+
+    def _offload(self, func, payload):
+        if self.bulkParser.pool is None:
+            d = self.semaphore.run(threads.deferToThread, func, payload)
+        else:
+            d = self.semaphore.run(self.bulkParser._submit, func, [payload])
+            d.addCallback(lambda results: results[0])
+        return d
+
+    def parseObservations(self, jsonString):
+        """
+        Parse an observations JSON string.
+
+        @return: A deferred that returns an Observations object, or None
+                 if it could not be decoded.
+        @rtype: defer.Deferred
+        """
+        if len(jsonString) < self.inlineThreshold:
+            return defer.succeed(parseObservations(jsonString))
+
+        d = self._offload(compactObservations, jsonString)
+        d.addCallback(expandObservations)
+        return d
+
+    def parseForecast(self, forecast):
+        """
+        Parse a forecast string into a forecast dict.
+
+        @return: A deferred that returns a forecast dict, or None if it
+                 could not be parsed.
+        @rtype: defer.Deferred
+        """
+        if forecast is None or len(forecast) < self.inlineThreshold:
+            return defer.succeed(parseForecast(forecast))
+
+        d = self._offload(compactForecast, forecast)
+        d.addCallback(expandForecast)
+        return d
@@ -0,0 +1,172 @@
+
+"""
+Bounded caches of parsed and rendered forecasts.
+
+Forecasts are usually retrieved far more often than they are reissued,
+so the same forecast text is parsed over and over. The caches in this
+module are keyed on a hash of the forecast text so each distinct
+forecast is only processed once.
+
+This module does not depend on Twisted.
+"""
+
+import hashlib
+from collections import OrderedDict
+from txbom.forecasts import forecastToDict
+
+
+# Limits of the default forecast cache
+DefaultMaxEntries = 256
+DefaultMaxSize = 16 * 1024 * 1024
+
+# The forecast dict key holding the list of five day forecast tuples
+FIVE_DAYS = "fcast_five_days"
+
+
+def contentHash(text):
+    """
+    Return a hash identifying the content of a string.
+    """
+    if not isinstance(text, bytes):
+        text = text.encode("utf-8")
+    return hashlib.sha1(text).hexdigest()
+
+
+class CacheStats(object):
+    """
+    Counters describing the effectiveness of a cache.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def hitRatio(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def __str__(self):
+        return "%i hits, %i misses, %i evictions" % (self.hits, self.misses, self.evictions)
+
+
+class LRUCache(object):
+    """
+    A least recently used cache bounded by a number of entries and,
+    optionally, the total size of the entries. The size of each entry is
+    given by the caller when it is stored.
+    """
+
+    def __init__(self, maxEntries=DefaultMaxEntries, maxSize=None):
+        self.maxEntries = maxEntries
+        self.maxSize = maxSize
+
+        # key -> (value, size), least recently used first
+        self.entries = OrderedDict()
+
+        # The total size of all entries
+        self.size = 0
+
+        self.stats = CacheStats()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        """
+        Return the value stored for key, marking it as most recently
+        used, or default if it is not in the cache.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.stats.misses += 1
+            return default
+        self.entries[key] = entry
+        self.stats.hits += 1
+        return entry[0]
+
+    def put(self, key, value, size=0):
+        """
+        Store a value, evicting least recently used entries as needed to
+        stay within the limits. A value larger than maxSize is not stored.
+        """
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+
+        if self.maxSize is not None and size > self.maxSize:
+            return
+
+        self.entries[key] = (value, size)
+        self.size += size
+
+        while len(self.entries) > self.maxEntries or \
+                (self.maxSize is not None and self.size > self.maxSize):
+            _key, (_value, evictedSize) = self.entries.popitem(last=False)
+            self.size -= evictedSize
+            self.stats.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+class ForecastCache(object):
+    """
+    Memoize forecastToDict.
+
+    Parsed forecasts are stored by a hash of the forecast text, with the
+    size of an entry taken as the length of the text. Each call returns
+    a new dict, so callers may modify the result without affecting the
+    cached entry or other callers.
+    """
+
+    def __init__(self, maxEntries=DefaultMaxEntries, maxSize=DefaultMaxSize):
+        self.cache = LRUCache(maxEntries, maxSize)
+
+    @property
+    def stats(self):
+        return self.cache.stats
+
+    def _copy(self, forecastDict):
+        result = dict(forecastDict)
+        result[FIVE_DAYS] = list(result[FIVE_DAYS])
+        return result
+
+    def forecastToDict(self, forecast):
+        """
+        Return the forecast dict of a forecast string, parsing it only if
+        the same text has not been parsed recently.
+        """
+        if not forecast:
+            return forecastToDict(forecast)
+
+        key = contentHash(forecast)
+        forecastDict = self.cache.get(key)
+        if forecastDict is None:
+            forecastDict = forecastToDict(forecast)
+            if forecastDict is None:
+                return None
+            # store the five day list as a tuple so the cached entry
+            # can't be modified
+            forecastDict[FIVE_DAYS] = tuple(forecastDict[FIVE_DAYS])
+            self.cache.put(key, forecastDict, len(forecast))
+        return self._copy(forecastDict)
+
+
+# The cache used by cachedForecastToDict and txbom.ftp.get_forecast_dict
+forecastCache = ForecastCache()
+
+
+def cachedForecastToDict(forecast):
+    """
+    A drop in replacement for forecastToDict that uses the default
+    forecast cache.
+    """
+    return forecastCache.forecastToDict(forecast)
@@ -0,0 +1,223 @@
+
+"""
+Vectorised unit conversion and derived quantities over observation
+histories.
+
+Observation rows are converted once into numpy arrays, one per field,
+and all conversions and derived quantities are then computed on whole
+columns at once rather than row by row. Missing values are represented
+as NaN.
+
+This module requires numpy, which is installed by the derived extra,
+pip install txbom[derived].
+"""
+
+import numpy
+import txbom
+from txbom.observations import (AIFSTIME_UTC, AIR_TEMP, APPARENT_TEMP,
+                                DEW_POINT, GUST_KMH, GUST_KT, PRESSURE,
+                                PRESSURE_MSL, PRESSURE_QNH,
+                                RELATIVE_HUMIDITY, WIND_DIRECTION,
+                                WIND_SPEED_KMH, WIND_SPEED_KT)
+
+
+KMH_PER_KNOT = 1.852
+MS_PER_KMH = 1.0 / 3.6
+INHG_PER_HPA = 0.0295299830714
+
+# The numeric fields loaded by default
+NumericFields = [AIR_TEMP, APPARENT_TEMP, DEW_POINT, GUST_KMH, GUST_KT,
+                 PRESSURE, PRESSURE_MSL, PRESSURE_QNH, RELATIVE_HUMIDITY,
+                 WIND_SPEED_KMH, WIND_SPEED_KT]
+
+
+def _rows(observations):
+    """
+    Accept an Observations object or a sequence of Observation rows.
+    """
+    return getattr(observations, "data", observations)
+
+
+def _toFloat(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return numpy.nan
+
+
+def columns(observations, fields=None):
+    """
+    Convert observation rows into a dict of numpy arrays, one per field.
+    Numeric fields are returned as float arrays with NaN for missing
+    values. The wind direction and timestamp fields are returned as
+    object arrays.
+
+    @param observations: An Observations object or a sequence of
+                         Observation rows, e.g. a retained history.
+    @param fields: The numeric fields to load. Defaults to NumericFields.
+
+    @rtype: dict
+    """
+    rows = _rows(observations)
+    if fields is None:
+        fields = NumericFields
+
+    result = {}
+    for field in fields:
+        result[field] = numpy.array([_toFloat(getattr(row, field, None)) for row in rows],
+                                    dtype=float)
+    result[WIND_DIRECTION] = numpy.array([getattr(row, WIND_DIRECTION, None) for row in rows],
+                                         dtype=object)
+    result[AIFSTIME_UTC] = numpy.array([getattr(row, AIFSTIME_UTC, None) for row in rows],
+                                       dtype=object)
+    return result
+
+
+def kmhToKnots(kmh):
+    return numpy.asarray(kmh, dtype=float) / KMH_PER_KNOT
+
+
+def knotsToKmh(knots):
+    return numpy.asarray(knots, dtype=float) * KMH_PER_KNOT
+
+
+def kmhToMs(kmh):
+    return numpy.asarray(kmh, dtype=float) * MS_PER_KMH
+
+
+def hpaToInHg(hpa):
+    return numpy.asarray(hpa, dtype=float) * INHG_PER_HPA
+
+
+def preferred(primary, secondary):
+    """
+    Return primary with missing values filled from secondary.
+    """
+    primary = numpy.asarray(primary, dtype=float)
+    return numpy.where(numpy.isnan(primary), secondary, primary)
+
+
+def windSpeedKmh(cols):
+    """
+    Return the wind speed in km/h, using the knots value where the km/h
+    value is missing.
+    """
+    return preferred(cols[WIND_SPEED_KMH], knotsToKmh(cols[WIND_SPEED_KT]))
+
+
+def gustKmh(cols):
+    """
+    Return the gust speed in km/h, using the knots value where the km/h
+    value is missing.
+    """
+    return preferred(cols[GUST_KMH], knotsToKmh(cols[GUST_KT]))
+
+
+def pressure(cols):
+    """
+    Return the best available pressure, preferring the mean sea level
+    pressure, then the QNH and then the station pressure.
+    """
+    return preferred(preferred(cols[PRESSURE_MSL], cols[PRESSURE_QNH]), cols[PRESSURE])
+
+
+def bearings(windDirections):
+    """
+    Convert an array of compass point wind directions into angles, in
+    degrees, using txbom.WindDirectionsToBearing. Calm and unknown
+    directions are returned as NaN.
+    """
+    windDirections = numpy.asarray(windDirections, dtype=object)
+    if not len(windDirections):
+        return numpy.array([], dtype=float)
+
+    # Look up each distinct direction once and broadcast the results
+    keys = numpy.array([str(d) for d in windDirections])
+    unique, inverse = numpy.unique(keys, return_inverse=True)
+    table = numpy.array([_toFloat(txbom.WindDirectionsToBearing.get(d)) for d in unique],
+                        dtype=float)
+    return table[inverse]
+
+
+def windComponents(windDirections, speed):
+    """
+    Return the (u, v) wind vector components for arrays of compass point
+    wind directions and wind speeds. u is positive towards the east and v
+    positive towards the north, in the units of speed. Calm winds have
+    zero components.
+
+    txbom.WindDirectionsToBearing gives the angle of the direction the
+    wind comes from measured anticlockwise from east, so the wind vector
+    points the opposite way.
+    """
+    speed = numpy.asarray(speed, dtype=float)
+    angles = numpy.radians(bearings(windDirections))
+    calm = numpy.isnan(angles) & (numpy.asarray(windDirections, dtype=object) == "CALM")
+    u = numpy.where(calm, 0.0, -speed * numpy.cos(angles))
+    v = numpy.where(calm, 0.0, -speed * numpy.sin(angles))
+    return u, v
+
+
+def dewPointDepression(cols):
+    """
+    Return the difference between the air temperature and the dew point.
+    """
+    return cols[AIR_TEMP] - cols[DEW_POINT]
+
+
+def vapourPressure(temperature, relativeHumidity):
+    """
+    Return the water vapour pressure, in hPa.
+    """
+    temperature = numpy.asarray(temperature, dtype=float)
+    return (numpy.asarray(relativeHumidity, dtype=float) / 100.0 * 6.105 *
+            numpy.exp(17.27 * temperature / (237.7 + temperature)))
+
+
+def apparentTemperature(temperature, relativeHumidity, windSpeedMs):
+    """
+    Return the apparent temperature using the Steadman formula used by
+    the BOM:
+
+    AT = Ta + 0.33e - 0.70ws - 4.00
+    """
+    return (numpy.asarray(temperature, dtype=float) +
+            0.33 * vapourPressure(temperature, relativeHumidity) -
+            0.70 * numpy.asarray(windSpeedMs, dtype=float) - 4.00)
+
+
+def derive(observations):
+    """
+    Compute unit conversions and derived quantities for every row of an
+    observation history in one pass.
+
+    @param observations: An Observations object or a sequence of
+                         Observation rows.
+
+    @return: A dict of column name to numpy array containing the loaded
+             columns plus wind_spd_kmh_filled, wind_spd_ms, gust_kmh_filled,
+             pressure_hpa, pressure_inhg, wind_u_ms, wind_v_ms,
+             dewpt_depression, apparent_t_computed and apparent_t_error.
+    @rtype: dict
+    """
+    cols = columns(observations)
+
+    speedKmh = windSpeedKmh(cols)
+    speedMs = kmhToMs(speedKmh)
+    u, v = windComponents(cols[WIND_DIRECTION], speedMs)
+    best = pressure(cols)
+    computed = apparentTemperature(cols[AIR_TEMP], cols[RELATIVE_HUMIDITY], speedMs)
+
+    cols["wind_spd_kmh_filled"] = speedKmh
+    cols["wind_spd_ms"] = speedMs
+    cols["gust_kmh_filled"] = gustKmh(cols)
+    cols["pressure_hpa"] = best
+    cols["pressure_inhg"] = hpaToInHg(best)
+    cols["wind_u_ms"] = u
+    cols["wind_v_ms"] = v
+    cols["dewpt_depression"] = dewPointDepression(cols)
+    cols["apparent_t_computed"] = computed
+    # the difference between the reported and computed apparent
+    # temperature, useful for spotting suspect observations.
+    cols["apparent_t_error"] = cols[APPARENT_TEMP] - computed
+    return cols
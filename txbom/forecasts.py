@@ -2,17 +2,17 @@
 
 '''
 Retrieve forecasts from the BOM
+
+The forecast parsing functions in this module don't depend on Twisted.
+The FTP transport (get_forecast, get_forecast_dict, connect and
+BufferingProtocol) lives in txbom.ftp and is only imported the first
+time one of those names is used from this module.
 '''
 
+import importlib
 import logging
-from twisted.protocols.ftp import FTPClient
-from twisted.internet.protocol import Protocol, ClientCreator
-from twisted.internet import reactor, defer
+import sys
 import txbom
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
 
 
 # Details for the Bureau of Meteorology FTP site
@@ -20,59 +20,21 @@ BomFtpHost = "ftp2.bom.gov.au"
 BomFtpPort = 21
 BomFtpForecastPath = "/anon/gen/fwo/%s.txt"
 
+# The encoding used to decode forecast bytes into text on Python 3
+ForecastEncoding = "latin-1"
 
-class BufferingProtocol(Protocol):
-    """
-    Simple utility class that holds all data written to it in a buffer.
-    """
-
-    def __init__(self):
-        self.buffer = StringIO()
-
-    def dataReceived(self, data):
-        self.buffer.write(data)
+# Names provided by the txbom.ftp transport module
+TransportNames = ["BufferingProtocol", "connect", "get_forecast", "get_forecast_dict"]
 
 
-@defer.inlineCallbacks
-def get_forecast(forecast_id):
+def __getattr__(name):
     """
-    Retrieve a text weather forecast from the Australian Bureau of Meteorology FTP
-    server for the city specified by the forecast id.
-
-    Returns a deferred to the caller that will eventually return the
-    forecast string.
-
-    @param forecast_id: The forecast city identifier. For example Adelaide is
-                        IDS10034, Sydney is IDN10064, etc.
-
-    @return: A deferred that returns the forecast string or None
-    @rtype: defer.Deferred
+    Load the FTP transport on first use (PEP 562, Python 3.7+).
     """
-    creator = ClientCreator(reactor, FTPClient, username="anonymous", password="guest")
-
-    try:
-        ftpClient = yield creator.connectTCP(BomFtpHost, BomFtpPort)
-
-        bufferProtocol = BufferingProtocol()
-        forecast_path = BomFtpForecastPath % (forecast_id)
-        _result = yield ftpClient.retrieveFile(forecast_path, bufferProtocol)
-
-        forecast = bufferProtocol.buffer.getvalue()
-        forecast = forecast.replace("\r", "")  # prefer \n as line delimiters
-        logging.debug("Forecast retrieval successful")
-
-        try:
-            _result = yield ftpClient.quit()
-        except Exception, ex:
-            logging.error("ftpClient failed to quit properly")
-            logging.exception(ex)
-
-        defer.returnValue(forecast)
-
-    except Exception, ex:
-        logging.error("Connection to forecast FTP server failed")
-        logging.exception(ex)
-        defer.returnValue(None)
+    if name in TransportNames:
+        from txbom import ftp
+        return getattr(ftp, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 
 def expand_contractions(data):
@@ -106,9 +68,7 @@ def expand_contractions(data):
     # Process wind direction keys from longest to shortest so that
     # we don't get 'northerlyeasterly' from NE. Instead we should end
     # up with 'north easterly'.
-    keys = txbom.WindDirections.keys()
-    keys.sort(key=len)
-    keys.reverse()
+    keys = sorted(txbom.WindDirections, key=len, reverse=True)
     for k in keys:
         v = txbom.WindDirections[k]
         replace_str = " %s " % k
@@ -268,7 +228,7 @@ def get_forecast_for_today(data):
             # details should be on one line
             today_details = today_details.split("\n")[0]
             items = today_details.split("  ")
-            items = filter(None, items)  # remove empty items
+            items = [item for item in items if item]  # remove empty items
 
             if len(items) == 3:
                 location, precis, temperature = items
@@ -345,7 +305,7 @@ def get_forecast_for_tomorrow(data):
             if len(lines) > 1:
                 temp_line = lines[1]
                 items = temp_line.split("  ")
-                items = filter(None, items)  # remove empty items
+                items = [item for item in items if item]  # remove empty items
 
                 if len(items) == 3:
                     _, temperature_min, temperature_max = items
@@ -367,7 +327,7 @@ def get_forecast_for_tomorrow(data):
 
             forecast_line = tomorrow_details.split("\n")[0]
             items = forecast_line.split("  ")
-            items = filter(None, items)  # remove empty items
+            items = [item for item in items if item]  # remove empty items
             try:
                 location, _, temperature_min, temperature_max = items
 
@@ -377,7 +337,7 @@ def get_forecast_for_tomorrow(data):
                 temperature_max = temperature_max.replace("Max", "")
                 temperature_max = temperature_max.strip()
 
-            except ValueError, ex:
+            except ValueError as ex:
                 logging.error("Error extracting 4 items from line: \'%s\'. items=%s" % (forecast_line, str(items)))
                 logging.exception(ex)
 
@@ -404,7 +364,7 @@ def get_forecast_for_tomorrow(data):
             forecast_line = tomorrowsForecast.split("\n")[0]
 
             items = forecast_line.split("  ")
-            items = filter(None, items)  # remove empty items
+            items = [item for item in items if item]  # remove empty items
             description, precis, temperature_min, temperature_max = items
 
             description = description.strip()
@@ -454,7 +414,7 @@ def get_five_day_forecast(data):
             forecast_line = chunk.split("\n", 1)[0]
 
             items = forecast_line.split("  ")
-            items = filter(None, items)  # remove empty items
+            items = [item for item in items if item]  # remove empty items
 
             if len(items) == 3:
                 # occasionally the precis and min temp are not separated
@@ -506,7 +466,7 @@ def get_five_day_forecast(data):
             forecast_lines = five_day_forecast.split("\n")
             for forecast_line in forecast_lines:
                 items = forecast_line.split("  ")
-                items = filter(None, items)  # remove empty items
+                items = [item for item in items if item]  # remove empty items
                 day_name, precis, temperature_min, temperature_max = items
 
                 day_name = day_name.strip()
@@ -581,3 +541,148 @@ def forecastToDict(forecast=None):
     else:
         logging.error("Invalid forecast string received, can't produce dict.")
         return None
+
+
+# Forecast dict keys grouped into the sections that downstream consumers
+# care about. The keys that only describe when a forecast was issued
+# (fcast_date, fcast_time, fcast_raw) are deliberately not part of any
+# section so that a re-issue with identical content produces no changes.
+ForecastSections = {"summary": ["fcast_id", "fcast_town", "fcast_state"],
+                    "warnings": ["fcast_warnings"],
+                    "uv": ["fcast_uv_alert", "fcast_uv_index", "fcast_uv_index_name"],
+                    "today": ["fcast_today", "fcast_today_content",
+                              "fcast_today_precis", "fcast_today_temperature"],
+                    "tomorrow": ["fcast_tomorrow", "fcast_tomorrow_precis",
+                                 "fcast_tomorrow_minimum", "fcast_tomorrow_maximum"]}
+
+IssueKeys = ["fcast_date", "fcast_time", "fcast_raw"]
+
+FiveDayFields = ["minimum", "maximum", "precis"]
+
+
+class ForecastDiff(object):
+    """
+    The differences between two issues of the same forecast product.
+
+    changes holds a dict of forecast dict key to (old, new) tuples for
+    every changed key outside of the five day forecast.
+
+    days holds a dict of day name (e.g. 'Sunday 6 January') to a dict of
+    field name ('minimum', 'maximum', 'precis') to (old, new) tuples. A
+    day that only appears in one of the issues has all of its fields
+    reported, with None used for the missing side.
+
+    sections holds the set of section names that changed. Section names
+    are the keys of ForecastSections plus 'days' for the five day
+    forecast.
+    """
+
+    def __init__(self, changes, days, issueChanged):
+        self.changes = changes
+        self.days = days
+        self.issueChanged = issueChanged
+
+        self.sections = set()
+        for section, keys in ForecastSections.items():
+            for key in keys:
+                if key in changes:
+                    self.sections.add(section)
+                    break
+        if days:
+            self.sections.add("days")
+
+    @property
+    def issueOnly(self):
+        """
+        Return True if the only difference between the two issues is the
+        issue time, which is the case for most BOM re-issues.
+        """
+        return self.issueChanged and not self.sections
+
+    def sectionChanged(self, section):
+        """
+        Return True if the named section changed between issues.
+        """
+        return section in self.sections
+
+    def __nonzero__(self):
+        return bool(self.sections)
+
+    __bool__ = __nonzero__
+
+    def __str__(self):
+        o = []
+        for key in sorted(self.changes):
+            old, new = self.changes[key]
+            o.append("%s : %s -> %s" % (key, old, new))
+        for day in sorted(self.days):
+            for field in FiveDayFields:
+                if field in self.days[day]:
+                    old, new = self.days[day][field]
+                    o.append("%s %s : %s -> %s" % (day, field, old, new))
+        return "\n".join(o)
+
+
+def diffForecasts(previous, current):
+    """
+    Compare two forecast dicts, as produced by forecastToDict, for the
+    same forecast product and report which sections changed between
+    the two issues. This allows downstream processing to skip work when
+    a forecast is re-issued with unchanged content.
+
+    @param previous: The forecast dict of the earlier issue. May be None
+                     in which case every section is reported as changed.
+    @param current: The forecast dict of the latest issue.
+
+    @return: A ForecastDiff describing the changes.
+    @rtype: ForecastDiff
+    """
+    if previous is None:
+        previous = {}
+
+    if previous and previous.get("fcast_id") != current.get("fcast_id"):
+        raise ValueError("Can't diff different forecast products: %s and %s" % (
+            previous.get("fcast_id"), current.get("fcast_id")))
+
+    changes = {}
+    for keys in ForecastSections.values():
+        for key in keys:
+            old, new = previous.get(key), current.get(key)
+            if old != new:
+                changes[key] = (old, new)
+
+    issueChanged = False
+    for key in IssueKeys:
+        if previous.get(key) != current.get(key):
+            issueChanged = True
+            break
+
+    # The five day forecast rolls forward with each new day so the days
+    # are matched by name rather than by position.
+    previousDays = {}
+    for day_name, t_min, t_max, precis in previous.get("fcast_five_days") or []:
+        previousDays[day_name] = dict(zip(FiveDayFields, (t_min, t_max, precis)))
+
+    currentDays = {}
+    for day_name, t_min, t_max, precis in current.get("fcast_five_days") or []:
+        currentDays[day_name] = dict(zip(FiveDayFields, (t_min, t_max, precis)))
+
+    days = {}
+    for day_name in set(previousDays).union(currentDays):
+        old = previousDays.get(day_name, {})
+        new = currentDays.get(day_name, {})
+        fields = {}
+        for field in FiveDayFields:
+            if old.get(field) != new.get(field):
+                fields[field] = (old.get(field), new.get(field))
+        if fields:
+            days[day_name] = fields
+
+    return ForecastDiff(changes, days, issueChanged)
+
+
+if sys.version_info < (3, 7) and "txbom.ftp" not in sys.modules:
+    # Module level __getattr__ is not supported so load the transport now.
+    # The transport adds the TransportNames to this module when it is
+    # imported, whichever module is imported first.
+    importlib.import_module("txbom.ftp")
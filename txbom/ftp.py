@@ -0,0 +1,241 @@
+
+"""
+FTP transport for retrieving forecasts from the BOM.
+
+Importing this module loads Twisted. The forecast parsing functions in
+txbom.forecasts don't require it.
+"""
+
+import logging
+import sys
+from io import BytesIO
+from twisted.protocols.ftp import CommandFailed, FTPClient
+from twisted.internet.protocol import Protocol, ClientCreator
+from twisted.internet import reactor, defer
+from txbom.forecasts import (BomFtpHost, BomFtpPort, BomFtpForecastPath,
+                             ForecastEncoding)
+from txbom.products import catalog, forecastId
+
+
+# Idle FTP sessions are closed after this many seconds
+DefaultMaxIdle = 60
+
+
+class BufferingProtocol(Protocol):
+    """
+    Simple utility class that holds all data written to it in a buffer.
+    """
+
+    def __init__(self):
+        self.buffer = BytesIO()
+
+    def dataReceived(self, data):
+        self.buffer.write(data)
+
+
+def connect(host=BomFtpHost, port=BomFtpPort):
+    """
+    Connect to the Bureau of Meteorology FTP server using an anonymous
+    login.
+
+    @return: A deferred that returns a connected FTPClient
+    @rtype: defer.Deferred
+    """
+    creator = ClientCreator(reactor, FTPClient, username="anonymous", password="guest")
+    return creator.connectTCP(host, port)
+
+
+class SessionCache(object):
+    """
+    Logged in FTP sessions kept open for reuse.
+
+    Sessions can be opened ahead of time with warm so that a retrieval
+    doesn't wait for the connection and login. Sessions that have been
+    idle for longer than maxIdle seconds are closed rather than reused
+    as the server is likely to have timed them out.
+    """
+
+    def __init__(self, maxIdle=DefaultMaxIdle, clock=None):
+        self.maxIdle = maxIdle
+        self.clock = clock or reactor
+
+        # (host, port) -> list of (session, time it became idle)
+        self.idle = {}
+
+    def _available(self, host, port):
+        """
+        Return the idle sessions to a server, closing any that are stale.
+        """
+        now = self.clock.seconds()
+        fresh = []
+        for session, since in self.idle.get((host, port), []):
+            if session.transport is not None and session.transport.connected and \
+               now - since < self.maxIdle:
+                fresh.append((session, since))
+            elif session.transport is not None:
+                session.transport.loseConnection()
+        self.idle[(host, port)] = fresh
+        return fresh
+
+    def connect(self, host=BomFtpHost, port=BomFtpPort):
+        """
+        Return an idle session to the server, or connect a new one.
+
+        @return: A deferred that returns a connected FTPClient
+        @rtype: defer.Deferred
+        """
+        available = self._available(host, port)
+        if available:
+            session, _since = available.pop()
+            return defer.succeed(session)
+        return connect(host, port)
+
+    def release(self, session, host=BomFtpHost, port=BomFtpPort):
+        """
+        Return a session that is no longer in use to the cache.
+        """
+        if session.transport is not None and session.transport.connected:
+            self.idle.setdefault((host, port), []).append((session, self.clock.seconds()))
+
+    @defer.inlineCallbacks
+    def warm(self, host=BomFtpHost, port=BomFtpPort, count=1):
+        """
+        Open and log in sessions until count are idle.
+        """
+        for _i in range(count - len(self._available(host, port))):
+            try:
+                session = yield connect(host, port)
+                # wait for the login to complete
+                yield session.queueStringCommand("NOOP")
+                self.release(session, host, port)
+            except Exception as ex:
+                logging.error("Unable to open FTP session to %s:%s" % (host, port))
+                logging.exception(ex)
+                break
+
+    def close(self):
+        for sessions in self.idle.values():
+            for session, _since in sessions:
+                if session.transport is not None:
+                    session.transport.loseConnection()
+        self.idle = {}
+
+
+@defer.inlineCallbacks
+def retrieve_forecast(forecast_id, host=BomFtpHost, port=BomFtpPort, sessions=None):
+    """
+    Retrieve a text forecast from an FTP server. Unlike get_forecast,
+    failures are passed to the deferred's errback. Cancelling the
+    deferred closes the connection.
+
+    @param sessions: An optional SessionCache providing, and keeping, a
+                     logged in session.
+
+    @return: A deferred that returns the forecast string
+    @rtype: defer.Deferred
+    """
+    if sessions is None:
+        ftpClient = yield connect(host, port)
+    else:
+        ftpClient = yield sessions.connect(host, port)
+
+    try:
+        bufferProtocol = BufferingProtocol()
+        forecast_path = BomFtpForecastPath % (forecast_id)
+        yield ftpClient.retrieveFile(forecast_path, bufferProtocol)
+    except Exception:
+        # includes cancellation, don't leave the session open
+        if ftpClient.transport is not None:
+            ftpClient.transport.loseConnection()
+        raise
+
+    forecast = bufferProtocol.buffer.getvalue()
+    if not isinstance(forecast, str):
+        forecast = forecast.decode(ForecastEncoding)
+    forecast = forecast.replace("\r", "")  # prefer \n as line delimiters
+    logging.debug("Forecast retrieval successful")
+
+    if sessions is not None:
+        sessions.release(ftpClient, host, port)
+        defer.returnValue(forecast)
+
+    try:
+        yield ftpClient.quit()
+    except Exception as ex:
+        logging.error("ftpClient failed to quit properly")
+        logging.exception(ex)
+
+    defer.returnValue(forecast)
+
+
+@defer.inlineCallbacks
+def get_forecast(forecast_id, host=BomFtpHost, port=BomFtpPort, sessions=None):
+    """
+    Retrieve a text weather forecast from the Australian Bureau of Meteorology FTP
+    server for the city specified by the forecast id.
+
+    Returns a deferred to the caller that will eventually return the
+    forecast string.
+
+    @param forecast_id: The forecast city identifier. For example Adelaide is
+                        IDS10034, Sydney is IDN10064, etc. The .txt
+                        extension is optional.
+    @param sessions: An optional SessionCache providing, and keeping, a
+                     logged in session.
+
+    @return: A deferred that returns the forecast string or None
+    @rtype: defer.Deferred
+    """
+    if forecastId(forecast_id) is None:
+        logging.error("Invalid forecast identifier: %s" % forecast_id)
+        defer.returnValue(None)
+    # the extension is added to the remote path
+    forecast_id = forecastId(forecast_id)
+
+    known = forecast_id in catalog
+    if not known:
+        logging.warning("Forecast %s is not in the product catalog" % forecast_id)
+
+    try:
+        forecast = yield retrieve_forecast(forecast_id, host, port, sessions)
+        defer.returnValue(forecast)
+
+    except CommandFailed as ex:
+        # the server rejected the retrieval, usually as there is no such
+        # file
+        if known:
+            logging.error("Forecast %s was not found on the FTP server: %s" % (forecast_id, ex))
+        else:
+            logging.error("Unknown product %s was not found on the FTP server, check the identifier" % forecast_id)
+        defer.returnValue(None)
+
+    except Exception as ex:
+        logging.error("Connection to forecast FTP server failed")
+        logging.exception(ex)
+        defer.returnValue(None)
+
+
+def get_forecast_dict(forecast_id, cache=None):
+    """
+    Retrieve a forecast and return it as a forecast dict. Unchanged
+    forecasts are not parsed again.
+
+    @param cache: The txbom.cache.ForecastCache to use. Defaults to the
+                  shared txbom.cache.forecastCache.
+
+    @return: A deferred that returns the forecast dict or None
+    @rtype: defer.Deferred
+    """
+    if cache is None:
+        # imported here as txbom.cache imports txbom.forecasts
+        from txbom.cache import forecastCache as cache
+    d = get_forecast(forecast_id)
+    d.addCallback(lambda forecast: cache.forecastToDict(forecast) if forecast else None)
+    return d
+
+
+if sys.version_info < (3, 7):
+    # See the note at the end of txbom.forecasts
+    _module = sys.modules["txbom.forecasts"]
+    for _name in _module.TransportNames:
+        setattr(_module, _name, globals()[_name])
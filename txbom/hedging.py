@@ -0,0 +1,343 @@
+
+"""
+Hedged requests across equivalent BOM hosts.
+
+Forecasts are available from more than one BOM FTP host and observations
+can be served from local mirrors. A Hedger sends each request to the
+host that has recently been fastest. If that host hasn't answered within
+its 95th percentile latency, a duplicate request is sent to the next best
+host and whichever finishes first is used. The slower request is
+cancelled and the time it had been running is kept as a censored
+latency, a lower bound on how long it would have taken, apart from the
+latencies used to rank hosts. A request that fails is retried on the
+next host straight away.
+
+For example:
+
+forecastHedger = Hedger(ForecastHosts)
+d = get_forecast("IDS10034", forecastHedger)
+
+observationHedger = Hedger(["www.bom.gov.au", "bom-mirror.example.com:8080"])
+client = HedgedClient(observation_url, hedger=observationHedger)
+client.start()
+"""
+
+import collections
+import logging
+from twisted.internet import defer, reactor
+from txbom.forecasts import BomFtpHost, BomFtpPort
+from txbom.ftp import retrieve_forecast
+from txbom.products import forecastId
+from txbom.web import Client
+from txbom.web import fetch as _fetch
+try:
+    from urlparse import urlparse, urlunparse
+except ImportError:
+    from urllib.parse import urlparse, urlunparse
+
+
+# Equivalent hosts for each type of product. Hosts may include a port,
+# e.g. "mirror.example.com:2121".
+ForecastHosts = [BomFtpHost, "ftp.bom.gov.au"]
+ObservationHosts = ["www.bom.gov.au"]
+
+# The number of recent latencies kept for each host
+DefaultWindow = 100
+
+# The percentile of the primary host's latency after which a duplicate
+# request is sent.
+DefaultPercentile = 95
+
+# The hedge delay used until a host has MinSamples latencies, and the
+# limits of the delay, in seconds.
+DefaultHedgeDelay = 2.0
+MinHedgeDelay = 0.05
+MaxHedgeDelay = 30.0
+MinSamples = 5
+
+# The number of duplicate requests sent for each request, in addition to
+# retries after failures.
+DefaultHedges = 1
+
+
+def splitHost(host, defaultPort):
+    """
+    Split "host:port" into its parts.
+
+    @rtype: tuple
+    """
+    if ":" in host:
+        name, port = host.rsplit(":", 1)
+        return name, int(port)
+    return host, defaultPort
+
+
+class LatencyTracker(object):
+    """
+    The latency of recent requests to each host.
+    """
+
+    def __init__(self, window=DefaultWindow):
+        self.window = window
+
+        # host -> deque of recent latencies, in seconds
+        self.latencies = {}
+
+        # host -> number of failed requests
+        self.failures = collections.Counter()
+
+        # host -> deque of the time recent cancelled requests had been
+        # running, in seconds. These are censored latencies, the requests
+        # would have taken at least this long, so they are kept apart from
+        # the latencies used for ranking.
+        self.censored = {}
+
+    def record(self, host, latency):
+        samples = self.latencies.get(host)
+        if samples is None:
+            samples = self.latencies[host] = collections.deque(maxlen=self.window)
+        samples.append(latency)
+
+    def failed(self, host, elapsed):
+        """
+        Record a failed request. It counts as a request that took at least
+        MaxHedgeDelay so the host is moved down the ranking.
+        """
+        self.failures[host] += 1
+        self.record(host, max(elapsed, MaxHedgeDelay))
+
+    def cancelled(self, host, elapsed):
+        """
+        Record a request cancelled after elapsed seconds because another
+        host answered first. Its latency is censored, only known to be at
+        least elapsed, so it doesn't affect the host's ranking or hedge
+        delay.
+        """
+        samples = self.censored.get(host)
+        if samples is None:
+            samples = self.censored[host] = collections.deque(maxlen=self.window)
+        samples.append(elapsed)
+
+    def percentile(self, host, percentile):
+        """
+        Return a percentile of the host's recent latencies, or None if
+        there are fewer than MinSamples.
+        """
+        samples = self.latencies.get(host)
+        if not samples or len(samples) < MinSamples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100.0))
+        return ordered[index]
+
+    def median(self, host):
+        samples = self.latencies.get(host)
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[len(ordered) // 2]
+
+    def ranked(self, hosts):
+        """
+        Return hosts ordered fastest first by median latency. Hosts
+        without any latencies are tried first so that they are measured,
+        otherwise the given order breaks ties.
+        """
+        order = dict((host, i) for i, host in enumerate(hosts))
+
+        def key(host):
+            median = self.median(host)
+            return (median is not None, median, order[host])
+
+        return sorted(hosts, key=key)
+
+    def stats(self):
+        """
+        Return a dict of host to (requests, failures, median, p95)
+        """
+        return dict((host, (len(samples), self.failures[host], self.median(host),
+                            self.percentile(host, DefaultPercentile)))
+                    for host, samples in self.latencies.items())
+
+
+class Hedger(object):
+    """
+    Send requests to a set of equivalent hosts, hedging requests to the
+    primary host that are slower than usual.
+
+    @param hosts: The equivalent hosts, in order of preference.
+    @param tracker: The LatencyTracker used to rank the hosts. Hedgers
+                    for the same hosts can share a tracker.
+    @param hedges: The maximum number of duplicate requests.
+    @param clock: The IReactorTime provider used to time requests.
+                  Defaults to the reactor.
+    """
+
+    def __init__(self, hosts, tracker=None, percentile=DefaultPercentile,
+                 hedges=DefaultHedges, clock=None):
+        self.hosts = list(hosts)
+        self.tracker = tracker or LatencyTracker()
+        self.percentile = percentile
+        self.hedges = hedges
+        self.clock = clock or reactor
+
+        # The number of duplicate requests sent and the number of those
+        # that finished first.
+        self.hedged = 0
+        self.hedgeWins = 0
+
+    def hedgeDelay(self, host):
+        """
+        Return the time to wait for a host before sending a duplicate
+        request.
+        """
+        delay = self.tracker.percentile(host, self.percentile)
+        if delay is None:
+            return DefaultHedgeDelay
+        return min(MaxHedgeDelay, max(MinHedgeDelay, delay))
+
+    def request(self, func):
+        """
+        Make a request to the hosts.
+
+        @param func: Called with a host to start a request to it. It must
+                     return a deferred that fails if the request failed
+                     and can be cancelled.
+
+        @return: A deferred that returns the result of the first request
+                 to succeed, or fails with the last failure if every host
+                 failed. Cancelling it cancels all outstanding requests,
+                 without recording their latency.
+        @rtype: defer.Deferred
+        """
+        hosts = self.tracker.ranked(self.hosts)
+        pending = {}
+        state = {"timer": None, "hedges": 0}
+
+        def cancel(_d):
+            finish()
+
+        result = defer.Deferred(cancel)
+
+        def finish(answered=False):
+            if state["timer"] is not None and state["timer"].active():
+                state["timer"].cancel()
+            state["timer"] = None
+            for host, (d, started) in list(pending.items()):
+                # a losing request's latency is only known to be at least
+                # the time it had been running. Requests cancelled by the
+                # caller aren't recorded.
+                if answered:
+                    self.tracker.cancelled(host, self.clock.seconds() - started)
+                del pending[host]
+                d.cancel()
+
+        def succeeded(value, host, started, hedge):
+            if host not in pending or result.called:
+                return
+            del pending[host]
+            self.tracker.record(host, self.clock.seconds() - started)
+            if hedge:
+                self.hedgeWins += 1
+            finish(answered=True)
+            result.callback(value)
+
+        def failed(failure, host, started):
+            if host not in pending or result.called:
+                return
+            del pending[host]
+            self.tracker.failed(host, self.clock.seconds() - started)
+            logging.debug("Request to %s failed: %s" % (host, failure.getErrorMessage()))
+            if hosts:
+                # retry on the next host without waiting
+                start(hedge=False)
+            elif not pending:
+                finish()
+                result.errback(failure)
+
+        def start(hedge):
+            host = hosts.pop(0)
+            started = self.clock.seconds()
+            try:
+                d = func(host)
+            except Exception:
+                d = defer.fail()
+            pending[host] = (d, started)
+            d.addCallbacks(succeeded, failed,
+                           callbackArgs=(host, started, hedge), errbackArgs=(host, started))
+            # failures are handled above, including those of cancelled
+            # requests
+            d.addErrback(lambda _f: None)
+
+            if state["timer"] is None and hosts and state["hedges"] < self.hedges and not result.called:
+                state["timer"] = self.clock.callLater(self.hedgeDelay(host), hedgeTimeout)
+
+        def hedgeTimeout():
+            state["timer"] = None
+            if hosts and not result.called:
+                state["hedges"] += 1
+                self.hedged += 1
+                start(hedge=True)
+
+        start(hedge=False)
+        return result
+
+
+def _alternateUrl(url, host):
+    """
+    Return url with its host, and port, replaced.
+    """
+    parts = urlparse(url)
+    return urlunparse(parts._replace(netloc=host))
+
+
+def get_forecast(forecast_id, hedger):
+    """
+    Retrieve a forecast from the hedger's hosts.
+
+    @return: A deferred that returns the forecast string or None
+    @rtype: defer.Deferred
+    """
+    if forecastId(forecast_id) is None:
+        logging.error("Invalid forecast identifier: %s" % forecast_id)
+        return defer.succeed(None)
+    forecast_id = forecastId(forecast_id)
+
+    def request(host):
+        name, port = splitHost(host, BomFtpPort)
+        return retrieve_forecast(forecast_id, name, port)
+
+    def failed(failure):
+        logging.error("Unable to retrieve forecast %s from any host: %s" % (
+            forecast_id, failure.getErrorMessage()))
+        return None
+
+    d = hedger.request(request)
+    d.addErrback(failed)
+    return d
+
+
+def fetch(url, hedger, compressed=True, stats=None, connections=None):
+    """
+    Retrieve a URL from the hedger's hosts, substituting each host for
+    the host in the URL.
+
+    @return: A deferred that returns the response body
+    @rtype: defer.Deferred
+    """
+    return hedger.request(lambda host: _fetch(_alternateUrl(url, host), compressed=compressed,
+                                              stats=stats, connections=connections))
+
+
+class HedgedClient(Client):
+    """
+    An observations client that retrieves observations through a Hedger.
+    """
+
+    def __init__(self, observation_url=None, hedger=None, **kwargs):
+        Client.__init__(self, observation_url, **kwargs)
+        self.hedger = hedger or Hedger(ObservationHosts)
+
+    def fetch(self, observation_url):
+        return fetch(observation_url, self.hedger, compressed=self.compressed,
+                     stats=self.transferStats, connections=self.connections)
@@ -0,0 +1,531 @@
+
+"""
+Retain the history of observations for each station.
+
+Each poll of a station returns the most recent few days of observations,
+most of which were already returned by the previous poll. A HistoryStore
+keeps every distinct observation row for each station in time order so
+that the history extends beyond what a single response contains.
+
+A HistoryStore can be passed as the publisher of an observations Client
+or a txbom.service.Supervisor so that every update is added to it.
+
+The history of each station can be limited to a number of rows and/or a
+time span, in which case the oldest rows are discarded as new rows
+arrive. A MemoryBudget limits the total memory used by the histories of
+one or more stores. When the budget is exceeded the histories of the
+stations that have gone longest without being updated or read are
+written to disk, and loaded again when next used, or discarded if no
+spill directory is configured.
+
+This module does not depend on Twisted.
+"""
+
+import bisect
+import logging
+import os
+import sys
+from collections import OrderedDict
+from txbom.observations import AIFSTIME_UTC, WMO
+
+
+# Days in each month of a non leap year
+MonthDays = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+
+def _isLeap(year):
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+
+def _days(year, month, day):
+    """
+    Return the number of days from 1970-01-01 to a date.
+    """
+    # count years from March so the leap day is at the end of the year
+    if month <= 2:
+        year -= 1
+    era = year // 400
+    yearOfEra = year - era * 400
+    dayOfYear = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    dayOfEra = yearOfEra * 365 + yearOfEra // 4 - yearOfEra // 100 + dayOfYear
+    return era * 146097 + dayOfEra - 719468
+
+
+def epoch(aifstime_utc):
+    """
+    Convert a UTC observation timestamp, e.g. 20130104050000, to seconds
+    since the epoch. Returns None if the timestamp is missing or invalid.
+
+    The fixed width fields are extracted arithmetically, which is much
+    faster than time.strptime.
+    """
+    try:
+        if len(aifstime_utc) != 14 or not aifstime_utc.isdigit():
+            return None
+        value = int(aifstime_utc)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+    value, second = divmod(value, 100)
+    value, minute = divmod(value, 100)
+    value, hour = divmod(value, 100)
+    value, day = divmod(value, 100)
+    year, month = divmod(value, 100)
+
+    if not 1 <= month <= 12 or day < 1 or hour > 23 or minute > 59 or second > 61:
+        return None
+    if day > MonthDays[month - 1] and not (month == 2 and day == 29 and _isLeap(year)):
+        return None
+
+    return _days(year, month, day) * 86400 + hour * 3600 + minute * 60 + second
+
+
+def rowSize(observation):
+    """
+    Return an estimate of the memory, in bytes, used by an Observation
+    row and its values.
+    """
+    size = sys.getsizeof(observation) + sys.getsizeof(observation.__dict__) + \
+        sys.getsizeof(observation.fields)
+    for field in observation.fields:
+        size += sys.getsizeof(getattr(observation, field))
+    return size
+
+
+class StationHistory(object):
+    """
+    The observation rows of a single station in time order.
+
+    @param maxRows: The maximum number of rows kept.
+    @param maxAge: The maximum time span, in seconds, of the rows kept,
+                   measured back from the most recent row.
+    @param trimmed: An optional callable passed the station, the times of
+                    the rows discarded by the retention limits and the
+                    history.
+    """
+
+    def __init__(self, station, maxRows=None, maxAge=None, trimmed=None):
+        self.station = station
+        self.maxRows = maxRows
+        self.maxAge = maxAge
+        self.trimmed = trimmed
+
+        # observation times, in seconds since the epoch, in ascending
+        # order.
+        self.times = []
+
+        # Observation rows in the same order as times
+        self.rows = []
+
+        # The estimated memory used by the rows, in bytes
+        self.size = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def latest(self):
+        """
+        Return the most recent Observation or None
+        """
+        if self.rows:
+            return self.rows[-1]
+        return None
+
+    def add(self, observation, timestamp=None, trim=True):
+        """
+        Add an observation row. Rows for a time that is already held, or
+        older than the retention period, are ignored.
+
+        @param trim: If False, rows outside the retention limits are kept
+                     until trim is called.
+
+        @return: True if the row was added.
+        """
+        if timestamp is None:
+            timestamp = epoch(getattr(observation, AIFSTIME_UTC, None))
+            if timestamp is None:
+                return False
+
+        if not self.times or timestamp > self.times[-1]:
+            # the common case of a newer observation
+            self.times.append(timestamp)
+            self.rows.append(observation)
+        else:
+            index = bisect.bisect_left(self.times, timestamp)
+            if index < len(self.times) and self.times[index] == timestamp:
+                return False
+            if self.maxAge is not None and timestamp < self.times[-1] - self.maxAge:
+                return False
+            self.times.insert(index, timestamp)
+            self.rows.insert(index, observation)
+
+        self.size += rowSize(observation)
+        if trim:
+            self.trim()
+        return True
+
+    def trim(self):
+        """
+        Discard the oldest rows that are outside the retention limits.
+        """
+        excess = 0
+        if self.maxRows is not None:
+            excess = max(0, len(self.rows) - self.maxRows)
+        if self.maxAge is not None:
+            excess = max(excess, bisect.bisect_left(self.times, self.times[-1] - self.maxAge))
+        if excess:
+            for observation in self.rows[:excess]:
+                self.size -= rowSize(observation)
+            times = self.times[:excess]
+            del self.times[:excess]
+            del self.rows[:excess]
+            if self.trimmed is not None:
+                self.trimmed(self.station, times, self)
+
+    def between(self, start=None, end=None):
+        """
+        Return the rows observed at or after start and before end, in
+        seconds since the epoch.
+        """
+        first = 0 if start is None else bisect.bisect_left(self.times, start)
+        last = len(self.times) if end is None else bisect.bisect_left(self.times, end)
+        return self.rows[first:last]
+
+    def at(self, timestamp):
+        """
+        Return the most recent row observed at or before a time, or None.
+        """
+        index = bisect.bisect_right(self.times, timestamp)
+        if index:
+            return self.rows[index - 1]
+        return None
+
+    def nearest(self, timestamp, tolerance=None):
+        """
+        Return the row observed closest to a time, or None if there is no
+        row within tolerance seconds of it.
+        """
+        index = bisect.bisect_left(self.times, timestamp)
+        if index == len(self.times) or \
+           (index > 0 and timestamp - self.times[index - 1] <= self.times[index] - timestamp):
+            index -= 1
+        if index < 0:
+            return None
+        if tolerance is not None and abs(self.times[index] - timestamp) > tolerance:
+            return None
+        return self.rows[index]
+
+
+class MemoryBudget(object):
+    """
+    A limit on the memory used by the station histories of one or more
+    HistoryStores.
+
+    When a store exceeds the budget, station histories are evicted,
+    least recently used first, until usage falls to lowWater of the
+    budget. Evicted histories are written to spillDirectory, if one is
+    given, and loaded again the next time the station is used. Otherwise
+    they are discarded.
+
+    Stores sharing a budget and spill directory must have different
+    names.
+    """
+
+    def __init__(self, maxBytes, spillDirectory=None, lowWater=0.9):
+        self.maxBytes = maxBytes
+        self.spillDirectory = spillDirectory
+        self.lowWater = lowWater
+
+        # The estimated memory used by all resident histories, in bytes
+        self.used = 0
+
+        # (store, station) -> None, least recently used first
+        self.recent = OrderedDict()
+
+        # The number of station histories evicted
+        self.evictions = 0
+
+    def touch(self, store, station):
+        """
+        Mark a station as recently used.
+        """
+        key = (store, station)
+        self.recent.pop(key, None)
+        self.recent[key] = None
+
+    def charge(self, store, station, delta):
+        """
+        Record a change in the memory used by a station's history and
+        evict other histories if the budget is exceeded.
+        """
+        self.used += delta
+        self.touch(store, station)
+        if self.used > self.maxBytes:
+            self.reclaim(exclude=(store, station))
+
+    def adjust(self, delta):
+        """
+        Record a change in memory used alongside the histories that can't
+        be evicted, such as txbom.query summaries. Histories are evicted to
+        make room for it if the budget is exceeded.
+        """
+        self.used += delta
+        if self.used > self.maxBytes:
+            self.reclaim()
+
+    def forget(self, store, station, size):
+        """
+        Remove a station history that is no longer resident.
+        """
+        self.used -= size
+        self.recent.pop((store, station), None)
+
+    def reclaim(self, exclude=None):
+        """
+        Evict least recently used histories until usage is below the low
+        water mark.
+        """
+        target = self.maxBytes * self.lowWater
+        for key in list(self.recent):
+            if self.used <= target:
+                break
+            if key == exclude:
+                continue
+            store, station = key
+            store.evict(station)
+            self.evictions += 1
+
+
+class HistoryStore(object):
+    """
+    The observation history of many stations, keyed by WMO number.
+
+    Listeners registered with addListener are called with the station,
+    time and row of every row added to the store. This is used to keep
+    derived data, such as txbom.query summaries, up to date. Listeners
+    registered with addRemovalListener are called with the station, the
+    times of rows that were discarded, by the retention limits or by
+    eviction without a spill directory, and the station's remaining
+    StationHistory, or None if all of its rows were discarded. Rows
+    written to the spill directory are not removed.
+
+    @param maxRows: The maximum number of rows kept for each station.
+    @param maxAge: The maximum time span, in seconds, kept for each
+                   station.
+    @param budget: An optional MemoryBudget, which may be shared with
+                   other stores.
+    @param name: Identifies the store's files in the budget's spill
+                 directory.
+    """
+
+    def __init__(self, maxRows=None, maxAge=None, budget=None, name="history"):
+        self.maxRows = maxRows
+        self.maxAge = maxAge
+        self.budget = budget
+        self.name = name
+
+        # station -> StationHistory, for histories held in memory
+        self.stations = {}
+
+        # station -> path, for histories written to disk
+        self.spilled = {}
+
+        # callables passed (station, timestamp, observation) for each
+        # row added.
+        self.listeners = []
+
+        # callables passed (station, times, history) for rows discarded
+        self.removalListeners = []
+
+    def __len__(self):
+        return len(self.stations) + len(self.spilled)
+
+    def __contains__(self, station):
+        station = str(station)
+        return station in self.stations or station in self.spilled
+
+    def stationNames(self):
+        """
+        Return the stations with a history, whether held in memory or on
+        disk.
+        """
+        return list(self.stations) + list(self.spilled)
+
+    @property
+    def size(self):
+        """
+        Return the estimated memory used by the histories held in memory,
+        in bytes.
+        """
+        return sum([history.size for history in self.stations.values()])
+
+    def memoryUsage(self):
+        """
+        Return a dict of station to the estimated memory used by its
+        history, in bytes. Stations whose history is on disk are not
+        included.
+        """
+        return dict((station, history.size) for station, history in self.stations.items())
+
+    def get(self, station):
+        """
+        Return the StationHistory of a station or None. A history that
+        was evicted to disk is loaded again.
+        """
+        station = str(station)
+        history = self.stations.get(station)
+        if history is None and station in self.spilled:
+            history = self._load(station)
+        if history is not None and self.budget is not None:
+            self.budget.touch(self, station)
+        return history
+
+    def peek(self, station):
+        """
+        Return the StationHistory of a station or None, without marking it
+        as recently used. The history of a station evicted to disk is read
+        into a StationHistory that is neither kept in memory nor charged to
+        the budget, so no other histories are evicted.
+        """
+        station = str(station)
+        history = self.stations.get(station)
+        if history is None and station in self.spilled:
+            path = self.spilled[station]
+            history = StationHistory(station, self.maxRows, self.maxAge)
+            try:
+                self._read(path, history)
+            except (IOError, OSError, ValueError) as ex:
+                logging.error("Unable to read history of station %s from %s" % (station, path))
+                logging.exception(ex)
+        return history
+
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    def removeListener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def addRemovalListener(self, listener):
+        self.removalListeners.append(listener)
+
+    def removeRemovalListener(self, listener):
+        if listener in self.removalListeners:
+            self.removalListeners.remove(listener)
+
+    def _newHistory(self, station):
+        return StationHistory(station, self.maxRows, self.maxAge, trimmed=self._rowsRemoved)
+
+    def _rowsRemoved(self, station, times, history):
+        for listener in self.removalListeners:
+            listener(station, times, history)
+
+    def add(self, observation):
+        """
+        Add a single observation row.
+
+        @return: True if the row was new.
+        """
+        station = getattr(observation, WMO, None)
+        timestamp = epoch(getattr(observation, AIFSTIME_UTC, None))
+        if station is None or timestamp is None:
+            return False
+
+        history = self.stations.get(station)
+        if history is None:
+            if station in self.spilled:
+                history = self._load(station)
+            if history is None:
+                history = self.stations[station] = self._newHistory(station)
+
+        size = history.size
+        if not history.add(observation, timestamp, trim=False):
+            return False
+
+        if self.budget is not None:
+            self.budget.charge(self, station, history.size - size)
+
+        for listener in self.listeners:
+            listener(station, timestamp, observation)
+
+        # trim after the listeners have seen the row, which may be one of
+        # the rows discarded, unless a listener caused it to be evicted.
+        if self.stations.get(station) is history:
+            size = history.size
+            history.trim()
+            if self.budget is not None and history.size != size:
+                self.budget.charge(self, station, history.size - size)
+        return True
+
+    def publish(self, observations):
+        """
+        Add all new rows of an Observations object.
+
+        @return: The number of rows added
+        """
+        if observations is None:
+            return 0
+
+        added = 0
+        # rows are most recent first, add them oldest first
+        for observation in reversed(observations.data):
+            if self.add(observation):
+                added += 1
+        return added
+
+    def _spillPath(self, station):
+        return os.path.join(self.budget.spillDirectory, self.name, "%s.txa" % station)
+
+    def evict(self, station):
+        """
+        Remove a station's history from memory, writing it to the
+        budget's spill directory if there is one.
+        """
+        history = self.stations.pop(station, None)
+        if history is None:
+            return
+
+        if self.budget is not None:
+            self.budget.forget(self, station, history.size)
+
+            if self.budget.spillDirectory is not None and history.rows:
+                # imported here as only stores that spill need it
+                from txbom.archive import exportObservations
+                path = self._spillPath(station)
+                try:
+                    if not os.path.isdir(os.path.dirname(path)):
+                        os.makedirs(os.path.dirname(path))
+                    exportObservations(path, history.rows, unique=False)
+                    self.spilled[station] = path
+                except (IOError, OSError) as ex:
+                    logging.error("Unable to write history of station %s to %s" % (station, path))
+                    logging.exception(ex)
+
+        if station not in self.spilled and history.times:
+            # the rows have been discarded
+            self._rowsRemoved(station, history.times, None)
+
+    def _read(self, path, history):
+        # imported here as only stores that spill need it
+        from txbom.archive import readObservations
+        for observation in readObservations(path):
+            history.add(observation)
+
+    def _load(self, station):
+        """
+        Load a station's history from the spill directory.
+        """
+        path = self.spilled.pop(station)
+        history = self._newHistory(station)
+        try:
+            self._read(path, history)
+            os.remove(path)
+        except (IOError, OSError, ValueError) as ex:
+            logging.error("Unable to load history of station %s from %s" % (station, path))
+            logging.exception(ex)
+
+        self.stations[station] = history
+        if self.budget is not None:
+            self.budget.charge(self, station, history.size)
+        return history
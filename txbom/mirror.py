@@ -0,0 +1,472 @@
+
+"""
+Mirror whole directories of products from the BOM FTP server, or fetch
+individual products, such as radar and satellite images, straight to
+disk.
+"""
+
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import tempfile
+from twisted.internet import defer
+from twisted.internet.protocol import Protocol
+from twisted.protocols.ftp import FTPFileListProtocol
+from txbom.forecasts import BomFtpHost, BomFtpPort
+from txbom.ftp import connect
+from txbom.products import ProductId, isProductId
+
+
+# The directory containing forecasts, warnings and observations
+BomFtpForecastDirectory = "/anon/gen/fwo/"
+
+# The name of the file, stored alongside the mirrored files, that records
+# the listing details of each file when it was transferred.
+ManifestFilename = ".txbom-mirror.json"
+
+# The size of the write buffer used when streaming a product to disk
+DefaultWriteBufferSize = 64 * 1024
+
+
+def atomicRename(source, destination):
+    """
+    Rename source to destination, replacing any existing file.
+    """
+    if os.name == "nt" and os.path.exists(destination):
+        # rename can't replace an existing file on Windows
+        os.remove(destination)
+    os.rename(source, destination)
+
+
+def loadManifest(path):
+    """
+    Return the manifest stored at path, or an empty manifest if it
+    doesn't exist or can't be read.
+    """
+    if os.path.exists(path):
+        try:
+            with open(path) as fd:
+                return json.load(fd)
+        except (IOError, ValueError) as ex:
+            logging.error("Unable to load mirror manifest %s" % path)
+            logging.exception(ex)
+    return {}
+
+
+def saveManifest(path, manifest):
+    """
+    Atomically replace the manifest stored at path.
+    """
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path), prefix=ManifestFilename)
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f)
+    atomicRename(tmpPath, path)
+
+
+class FileWriterProtocol(Protocol):
+    """
+    Write all data received to a file object, optionally updating a
+    hashlib digest of the data.
+    """
+
+    def __init__(self, fileObject, digest=None):
+        self.file = fileObject
+        self.digest = digest
+        self.size = 0
+
+    def dataReceived(self, data):
+        self.file.write(data)
+        if self.digest is not None:
+            self.digest.update(data)
+        self.size += len(data)
+
+
+class SyncResult(object):
+    """
+    The outcome of a mirror synchronisation.
+    """
+
+    def __init__(self):
+        # names of files that were transferred
+        self.transferred = []
+        # names of files that were unchanged since the last sync
+        self.unchanged = []
+        # names of files that could not be transferred
+        self.failed = []
+
+    def __str__(self):
+        return "%i transferred, %i unchanged, %i failed" % (
+            len(self.transferred), len(self.unchanged), len(self.failed))
+
+
+class SessionPool(object):
+    """
+    A small pool of FTP sessions to the BOM FTP server that are kept open
+    between transfers.
+    """
+
+    def __init__(self, sessions=3, host=BomFtpHost, port=BomFtpPort):
+        self.host = host
+        self.port = port
+
+        # The pool of FTP sessions. None marks a session that needs to be
+        # (re)connected.
+        self.sessions = [None] * max(1, sessions)
+
+    @defer.inlineCallbacks
+    def _session(self, index):
+        """
+        Return a connected FTP session from the pool.
+        """
+        session = self.sessions[index]
+        if session is None or session.transport is None or not session.transport.connected:
+            session = yield connect(self.host, self.port)
+            self.sessions[index] = session
+        defer.returnValue(session)
+
+    def _dropSession(self, index):
+        session = self.sessions[index]
+        self.sessions[index] = None
+        if session is not None and session.transport is not None:
+            session.transport.loseConnection()
+
+    @defer.inlineCallbacks
+    def close(self):
+        """
+        Close all pooled FTP sessions.
+        """
+        for index, session in enumerate(self.sessions):
+            if session is not None:
+                try:
+                    yield session.quit()
+                except Exception as ex:
+                    logging.error("ftpClient failed to quit properly")
+                    logging.exception(ex)
+                self._dropSession(index)
+
+
+class Mirror(SessionPool):
+    """
+    Mirror the files in a BOM FTP directory, that match a set of filename
+    patterns or product categories, into a local directory.
+
+    The remote directory is listed once per sync. Matching files are then
+    transferred over a small pool of FTP sessions which are kept open
+    between syncs. Each file is written to a temporary file and renamed
+    into place once complete so readers never see a partial file.
+
+    The size and modification time of every file transferred is recorded
+    in a manifest so that subsequent syncs only transfer files that have
+    changed.
+
+    For example, to mirror all South Australian and Victorian text
+    products:
+
+    mirror = Mirror("/var/lib/bom", patterns=["IDS*.txt", "IDV*.txt"])
+    d = mirror.sync()
+    """
+
+    def __init__(self, localDirectory, remoteDirectory=BomFtpForecastDirectory,
+                 patterns=None, categories=None, sessions=3,
+                 host=BomFtpHost, port=BomFtpPort):
+        SessionPool.__init__(self, sessions, host, port)
+        self.remoteDirectory = remoteDirectory
+        self.localDirectory = os.path.join(localDirectory, remoteDirectory.strip("/"))
+        self.patterns = patterns
+        self.categories = categories
+
+        self.manifestPath = os.path.join(self.localDirectory, ManifestFilename)
+        self.manifest = loadManifest(self.manifestPath)
+
+    def matches(self, filename):
+        """
+        Return True if the filename matches the mirror's patterns and
+        categories. A mirror without patterns or categories matches every
+        file.
+        """
+        if self.patterns:
+            for pattern in self.patterns:
+                if fnmatch.fnmatchcase(filename, pattern):
+                    break
+            else:
+                return False
+
+        if self.categories:
+            if not isProductId(filename):
+                return False
+            if ProductId(filename).category not in self.categories:
+                return False
+
+        return True
+
+    @defer.inlineCallbacks
+    def list(self):
+        """
+        List the remote directory.
+
+        @return: A deferred that returns a list of dicts describing each
+                 file, as produced by FTPFileListProtocol.
+        @rtype: defer.Deferred
+        """
+        session = yield self._session(0)
+        fileList = FTPFileListProtocol()
+        try:
+            yield session.list(self.remoteDirectory, fileList)
+        except Exception:
+            self._dropSession(0)
+            raise
+        defer.returnValue([f for f in fileList.files if f["filetype"] == "-"])
+
+    @defer.inlineCallbacks
+    def _transfer(self, session, entry):
+        """
+        Transfer a single file into the local directory atomically.
+        """
+        filename = entry["filename"]
+        destination = os.path.join(self.localDirectory, filename)
+        fd, tmpPath = tempfile.mkstemp(dir=self.localDirectory, prefix=".%s." % filename)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                writer = FileWriterProtocol(f)
+                yield session.retrieveFile(posixpath.join(self.remoteDirectory, filename), writer)
+            atomicRename(tmpPath, destination)
+        except Exception:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+    @defer.inlineCallbacks
+    def _worker(self, index, queue, result):
+        """
+        Transfer files from the shared queue using one pooled session
+        until the queue is empty.
+        """
+        while queue:
+            entry = queue.pop(0)
+            filename = entry["filename"]
+            try:
+                session = yield self._session(index)
+                yield self._transfer(session, entry)
+                self.manifest[filename] = [entry["size"], entry["date"]]
+                result.transferred.append(filename)
+            except Exception as ex:
+                logging.error("Unable to mirror %s" % posixpath.join(self.remoteDirectory, filename))
+                logging.exception(ex)
+                result.failed.append(filename)
+                self._dropSession(index)
+
+    @defer.inlineCallbacks
+    def sync(self):
+        """
+        Transfer every matching file that has changed since the last
+        sync.
+
+        @return: A deferred that returns a SyncResult
+        @rtype: defer.Deferred
+        """
+        result = SyncResult()
+
+        if not os.path.isdir(self.localDirectory):
+            os.makedirs(self.localDirectory)
+
+        try:
+            entries = yield self.list()
+        except Exception as ex:
+            logging.error("Unable to list %s" % self.remoteDirectory)
+            logging.exception(ex)
+            defer.returnValue(result)
+
+        queue = []
+        for entry in entries:
+            filename = entry["filename"]
+            if not self.matches(filename):
+                continue
+
+            localPath = os.path.join(self.localDirectory, filename)
+            if self.manifest.get(filename) == [entry["size"], entry["date"]] and \
+               os.path.exists(localPath):
+                result.unchanged.append(filename)
+            else:
+                queue.append(entry)
+
+        workers = [self._worker(i, queue, result) for i in range(len(self.sessions))]
+        yield defer.DeferredList(workers)
+
+        if result.transferred:
+            saveManifest(self.manifestPath, self.manifest)
+
+        logging.debug("Mirror of %s complete: %s" % (self.remoteDirectory, result))
+        defer.returnValue(result)
+
+
+def _replyValue(reply):
+    """
+    Return the value of a single line FTP reply, e.g. '213 12345'.
+    """
+    return reply[-1].split(None, 1)[1].strip()
+
+
+class ProductFetcher(SessionPool):
+    """
+    Retrieve individual products, such as radar, satellite and chart
+    images, straight to disk.
+
+    Each product is streamed from the RETR data connection into a
+    temporary file through a write buffer of bufferSize bytes, so memory
+    use doesn't grow with the size of the product, and renamed into
+    place once complete. Products are stored under localDirectory at
+    their path on the FTP server.
+
+    Before a product is transferred its size and modification time are
+    requested (SIZE and MDTM) and compared with the manifest so that
+    unchanged products are skipped. If the server can't provide them the
+    product is transferred and only replaces the local copy when its
+    content has changed.
+
+    For example, to keep a set of radar images up to date:
+
+    fetcher = ProductFetcher("/var/lib/bom")
+    task = LoopingCall(fetcher.fetch, ["IDR643.gif", "IDR644.gif", "IDE00135.jpg"])
+    task.start(5 * 60)
+    """
+
+    def __init__(self, localDirectory, sessions=3, bufferSize=DefaultWriteBufferSize,
+                 host=BomFtpHost, port=BomFtpPort):
+        SessionPool.__init__(self, sessions, host, port)
+        self.localDirectory = localDirectory
+        self.bufferSize = bufferSize
+
+        # remote path -> [size, modification time, sha1 of the content]
+        self.manifestPath = os.path.join(localDirectory, ManifestFilename)
+        self.manifest = loadManifest(self.manifestPath)
+
+    def remotePath(self, product):
+        """
+        Return the FTP path of a product identifier, e.g. IDR643.gif. Any
+        other string, such as the path of a radar loop frame, is assumed
+        to already be an FTP path.
+        """
+        if isinstance(product, ProductId):
+            return product.ftp_path
+        if isProductId(product):
+            return ProductId(product).ftp_path
+        return product
+
+    def localPath(self, remotePath):
+        return os.path.join(self.localDirectory, remotePath.strip("/"))
+
+    @defer.inlineCallbacks
+    def _stat(self, session, path):
+        """
+        Return the size and modification time of a remote file. Either is
+        None if the server did not provide it.
+        """
+        size = modified = None
+        try:
+            reply = yield session.queueStringCommand("SIZE %s" % path)
+            size = int(_replyValue(reply))
+            reply = yield session.queueStringCommand("MDTM %s" % path)
+            modified = _replyValue(reply)
+        except Exception as ex:
+            logging.debug("Unable to determine size and time of %s: %s" % (path, ex))
+        defer.returnValue((size, modified))
+
+    @defer.inlineCallbacks
+    def _transfer(self, session, path):
+        """
+        Transfer a single product to disk unless it is unchanged.
+
+        @return: A deferred that returns True if the product was replaced
+        @rtype: defer.Deferred
+        """
+        destination = self.localPath(path)
+        entry = self.manifest.get(path)
+        exists = os.path.exists(destination)
+
+        size, modified = yield self._stat(session, path)
+        if entry and exists and size is not None and modified is not None and \
+           entry[:2] == [size, modified]:
+            defer.returnValue(False)
+
+        directory, filename = os.path.split(destination)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        fd, tmpPath = tempfile.mkstemp(dir=directory, prefix=".%s." % filename)
+        try:
+            with os.fdopen(fd, "wb", self.bufferSize) as f:
+                writer = FileWriterProtocol(f, hashlib.sha1())
+                yield session.retrieveFile(path, writer)
+            if size is not None and writer.size != size:
+                raise IOError("Incomplete transfer of %s: %i of %i bytes" % (path, writer.size, size))
+
+            digest = writer.digest.hexdigest()
+            self.manifest[path] = [writer.size if size is None else size, modified, digest]
+            if entry and exists and entry[2] == digest:
+                os.remove(tmpPath)
+                defer.returnValue(False)
+            atomicRename(tmpPath, destination)
+        except Exception:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+        defer.returnValue(True)
+
+    @defer.inlineCallbacks
+    def _worker(self, index, queue, result):
+        """
+        Fetch products from the shared queue using one pooled session
+        until the queue is empty.
+        """
+        while queue:
+            path = queue.pop(0)
+            try:
+                session = yield self._session(index)
+                replaced = yield self._transfer(session, path)
+                if replaced:
+                    result.transferred.append(path)
+                else:
+                    result.unchanged.append(path)
+            except Exception as ex:
+                logging.error("Unable to fetch %s" % path)
+                logging.exception(ex)
+                result.failed.append(path)
+                self._dropSession(index)
+
+    @defer.inlineCallbacks
+    def fetch(self, products):
+        """
+        Fetch products that have changed since they were last fetched.
+
+        @param products: A list of product identifiers, e.g. IDR643.gif,
+                         and/or FTP paths.
+
+        @return: A deferred that returns a SyncResult listing the FTP
+                 paths of the products.
+        @rtype: defer.Deferred
+        """
+        result = SyncResult()
+
+        if not os.path.isdir(self.localDirectory):
+            os.makedirs(self.localDirectory)
+
+        queue = []
+        for product in products:
+            path = self.remotePath(product)
+            if path not in queue:
+                queue.append(path)
+
+        count = len(queue)
+        manifest = dict(self.manifest)
+        workers = [self._worker(i, queue, result) for i in range(len(self.sessions))]
+        yield defer.DeferredList(workers)
+
+        if self.manifest != manifest:
+            saveManifest(self.manifestPath, self.manifest)
+
+        logging.debug("Fetch of %i products complete: %s" % (count, result))
+        defer.returnValue(result)
@@ -1,14 +1,31 @@
 
 """
 Retrieve observations from the BOM
+
+The observation data classes in this module don't depend on Twisted.
+The HTTP transport (Client, get_observations, fetch and
+DecodingBodyProtocol) lives in txbom.web and is only imported the first
+time one of those names is used from this module.
 """
 
-import datetime
-import logging
-import json
-from twisted.internet import reactor, defer
-from twisted.internet.task import LoopingCall
-from twisted.web.client import getPage
+import importlib
+import sys
+
+
+UserAgent = b"txbom"
+
+# Names provided by the txbom.web transport module
+TransportNames = ["Client", "DecodingBodyProtocol", "fetch", "get_observations"]
+
+
+def __getattr__(name):
+    """
+    Load the HTTP transport on first use (PEP 562, Python 3.7+).
+    """
+    if name in TransportNames:
+        from txbom import web
+        return getattr(web, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 
 #
@@ -198,169 +215,47 @@ class Observations(object):
         return "\n".join(o)
 
 
-class Client(object):
+class TransferStats(object):
     """
-    The observations client allows a user to obtain BoM observations for a
-    specified URL. The client can operate in two modes.
-
-    The first mode simply retrieves the BoM observations whenever the
-    Client's get_observations method is called.
-
-    The second mode will keep the client's observations attribute
-    up to date by running a periodic task that retrieves the latest observation.
-    The update routine used in this mode is optimized to make the fewest
-    update requests as possible to maintain current data. It inspects the first
-    response and determines the appropriate time to begin the periodic
-    observations retrieval such that the minimum number of requests are
-    made to keep the observations up to date.
+    Byte counters for observation downloads. compressedBytes counts the
+    bytes received over the network while decompressedBytes counts the
+    size of the decoded responses.
     """
 
-    # Perform an observation retrieval every 30 minutes. This is how often
-    # the data is refreshed on the BoM website. There is no point requesting
-    # updates any faster.
-    Update_Frequency_In_Seconds = 30 * 60
-
-    def __init__(self, observation_url=None):
-        self.observation_url = observation_url
-
-        # The most recent observation response object
-        self.observations = None
-
-        # A reference to the task that periodically requests an
-        # observation update. This is needed so the task can be
-        # stopped later.
-        self.periodicRetrievalTask = None
-
-    def start(self):
-        """
-        Start monitoring sensors in and around the home environment
-        """
-        if self.observation_url is None:
-            logging.error("Can't start periodic observations retrieval as no URL is set")
-            return
-
-        logging.info('BoM Observation Client starting')
-        # Obtain the first observation right now. Inspect the update timestamp
-        # attribute so we can determine the time until the next update which
-        # will determine the time at which the periodic update task will begin.
-        #
-        self.retrieveFirstObservations()
-
-    def stop(self):
-        """
-        Stop monitoring sensors in and around the home environment
-        """
-        logging.info('BoM Observation Client stopping')
-
-        if self.periodicRetrievalTask:
-            self.periodicRetrievalTask.stop()
-            self.periodicRetrievalTask = None
+    def __init__(self):
+        self.requests = 0
+        self.compressedResponses = 0
+        self.compressedBytes = 0
+        self.decompressedBytes = 0
 
-    @defer.inlineCallbacks
-    def retrieveFirstObservations(self):
-        """
-        Retrieve the first BOM observations and inspect it for the most recent
-        update time. Using that information determine the time until the next
-        observation update and schedule the BOM retrieval task to begin running
-        periodically at the calculated delay interval.
-        """
-        try:
-            observations = yield self.get_observations(self.observation_url)
-            self.observations = observations
-
-            self.observationsReceived(observations)
-
-            if observations.current.aifstime_utc:
-                refresh_utc = datetime.datetime.strptime(observations.current.aifstime_utc, "%Y%m%d%H%M%S")
-                # While the update timestamp within the data indicates an update interval
-                # of 30 minutes, the updates of the half hourly data at the BoM web site
-                # seem to occur at 5 minutes past the data timestamp so the real time to
-                # the next update is 30 minutes (for the data) + 5 minutes (for the web
-                # server to receive the data update). Then I'll add 2 minutes of buffer
-                # time to ensure that the next query will see new data.
-                # Therefore the total time from the last data timestamp to the next query
-                # will be 30 + 5 + 2 = 37 minutes. From that initial offset time the
-                # periodic task runs at intervals of Update_Frequency_In_Seconds seconds.
-                next_refresh_time = refresh_utc + datetime.timedelta(minutes=37)
-                now_utc = datetime.datetime.utcnow()
-                time_until_next_refresh = next_refresh_time - now_utc
-                logging.info("Scheduling the periodic observation retrieval task to begin after delay of: %s" % time_until_next_refresh)
-                delay_in_seconds = time_until_next_refresh.total_seconds()
-                reactor.callLater(delay_in_seconds, self.startPeriodicRetrievalTask)
-            else:
-                logging.error("Could not extract most recent BOM refresh time from %s field" % AIFSTIME_UTC)
-
-        except Exception, ex:
-            logging.error("First BoM observation retrieval failed")
-            logging.exception(ex)
-            # schedule another attempt in 10 seconds.
-            logging.info("Scheduling another attempt to retrieve first BoM observation")
-            reactor.callLater(10, self.retrieveFirstObservations)
-
-        defer.returnValue(True)
-
-    def startPeriodicRetrievalTask(self):
-        """
-        Begin the looping call that will retrieve the latest BoM observation
-        """
-        self.bomUpdateTask = LoopingCall(self._retrieveObservations)
-        self.bomUpdateTask.start(Client.Update_Frequency_In_Seconds, now=True)
-        logging.info("Starting periodic BoM observation retrieval task")
+    def record(self, encoding, received, decoded):
+        self.requests += 1
+        if encoding:
+            self.compressedResponses += 1
+        self.compressedBytes += received
+        self.decompressedBytes += decoded
 
-    @defer.inlineCallbacks
-    def _retrieveObservations(self):
-        """
-        Retrieve the latest BoM observation and store it
+    @property
+    def ratio(self):
         """
-        observations = yield self.get_observations(self.observation_url)
-        if observations:
-            logging.info("BoM observations retrieved successfully")
-            self.observations = observations
-
-            # pass observations off the user provided handler
-            self.observationsReceived(observations)
-
-        defer.returnValue(None)
-
-    @defer.inlineCallbacks
-    def get_observations(self, observation_url):
+        Return the ratio of bytes received to decoded bytes.
         """
-        Retrieve the latest observations from the BOM in JSON format.
+        if self.decompressedBytes:
+            return float(self.compressedBytes) / self.decompressedBytes
+        return 1.0
 
-        Returns a deferred that will eventually return an Observation
-        object with attributes populated from parsing the JSON update.
+    def __str__(self):
+        return "%i requests (%i compressed), %i bytes received, %i bytes decoded" % (
+            self.requests, self.compressedResponses, self.compressedBytes,
+            self.decompressedBytes)
 
-        @return: A deferred that returns an Observations object
-        @rtype: defer.Deferred
-        """
-        try:
-            logging.debug("Requesting new observation data from: %s" % observation_url)
-            jsonString = yield getPage(observation_url)
-            logging.debug("Retrieved new observation data")
-            jsonData = json.loads(jsonString)
-            observations = Observations(jsonData)
-            defer.returnValue(observations)
-        except Exception, ex:
-            logging.error("Unable to retrieve observations data:")
-            logging.exception(ex)
-            defer.returnValue(None)
-
-    def observationsReceived(self, observations):
-        """
-        Override this method to receive observation updates as they are
-        retrieved.
-        """
-        pass
 
+# Counters for every observation download made by this process
+transferStats = TransferStats()
 
-def get_observations(observation_url):
-    """
-    Retrieve the latest observations from the BOM.
-    Returns a deferred to the caller that will eventually return a
-    Observations object or None.
 
-    @return: A deferred that returns a Observations object
-    @rtype: defer.Deferred
-    """
-    logging.debug("Retrieving observations from url %s" % (observation_url))
-    return Client().get_observations(observation_url)
+if sys.version_info < (3, 7) and "txbom.web" not in sys.modules:
+    # Module level __getattr__ is not supported so load the transport now.
+    # The transport adds the TransportNames to this module when it is
+    # imported, whichever module is imported first.
+    importlib.import_module("txbom.web")
@@ -0,0 +1,117 @@
+
+"""
+Prepare connections shortly before scheduled retrievals.
+
+The observations Client knows when its next retrieval will be made.
+Given a Prewarmer it resolves the host name and opens a persistent HTTP
+connection a few seconds beforehand, so the retrieval itself starts on a
+warm connection. Forecast retrievals can likewise use logged in FTP
+sessions opened ahead of time, which a txbom.scheduler.FreshnessScheduler
+given the Prewarmer does before each forecast poll.
+
+For example:
+
+prewarmer = Prewarmer()  # installs a CachingResolver
+client = Client(observation_url, prewarmer=prewarmer)
+
+prewarmer.prewarm("IDS10034")
+...
+d = get_forecast("IDS10034", sessions=prewarmer.sessions)
+"""
+
+import logging
+from twisted.internet import defer, reactor
+from twisted.web.client import Agent, HTTPConnectionPool
+from twisted.web.http_headers import Headers
+from txbom.forecasts import BomFtpHost, BomFtpPort
+from txbom.ftp import SessionCache
+from txbom.observations import UserAgent
+from txbom.products import isProductId
+from txbom.resolver import CachingResolver
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+
+# How many seconds before a scheduled retrieval connections are prepared
+DefaultLead = 5
+
+# The number of idle persistent HTTP connections kept to each host
+DefaultMaxPersistentPerHost = 4
+
+
+class Prewarmer(object):
+    """
+    Resolve host names and open connections ahead of retrievals.
+
+    @param resolver: The CachingResolver to prefetch addresses into. It
+                     should be installed as the reactor's resolver.
+                     Defaults to the installed CachingResolver, or a new
+                     one that is installed.
+    @param sessions: The ftp.SessionCache that FTP sessions are opened
+                     into.
+    @param lead: The time, in seconds, before a scheduled retrieval that
+                 connections are prepared.
+    """
+
+    def __init__(self, resolver=None, sessions=None, lead=DefaultLead,
+                 maxPersistentPerHost=DefaultMaxPersistentPerHost):
+        if resolver is None and isinstance(reactor.resolver, CachingResolver):
+            resolver = reactor.resolver
+        if resolver is None:
+            resolver = CachingResolver()
+            resolver.install()
+        self.resolver = resolver
+        self.sessions = sessions or SessionCache()
+        self.lead = lead
+
+        # Keep HTTP connections open between requests so a connection
+        # opened by prewarm is used by the following retrieval.
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = maxPersistentPerHost
+        self.agent = Agent(reactor, pool=self.pool)
+
+    def prewarm(self, item):
+        """
+        Prepare a connection for an observations URL or a forecast
+        identifier.
+
+        @return: A deferred that fires when the connection is ready
+        @rtype: defer.Deferred
+        """
+        if isProductId(item):
+            return self.prewarmFtp()
+        return self.prewarmUrl(item)
+
+    @defer.inlineCallbacks
+    def prewarmUrl(self, url):
+        """
+        Resolve the URL's host and open a persistent connection to it with
+        a HEAD request.
+        """
+        host = urlparse(url).hostname
+        try:
+            yield self.resolver.prefetch(host, self.lead * 2)
+            response = yield self.agent.request(b"HEAD", url.encode("ascii"),
+                                                Headers({b"User-Agent": [UserAgent]}))
+            logging.debug("Prewarmed connection to %s: %s" % (host, response.code))
+        except Exception as ex:
+            logging.debug("Unable to prewarm connection to %s: %s" % (host, ex))
+
+    @defer.inlineCallbacks
+    def prewarmFtp(self, host=BomFtpHost, port=BomFtpPort, count=1):
+        """
+        Resolve the FTP host and log in count sessions.
+        """
+        yield self.resolver.prefetch(host, self.lead * 2)
+        yield self.sessions.warm(host, port, count)
+
+    def close(self):
+        """
+        Close all idle connections.
+
+        @rtype: defer.Deferred
+        """
+        self.sessions.close()
+        return self.pool.closeCachedConnections()
@@ -0,0 +1,316 @@
+
+"""
+A catalog of BOM product identifiers.
+
+Product identifiers have the general form IDcxxxxx.ext (see the notes in
+txbom/__init__.py). This module parses identifiers into their parts,
+maps them to the FTP path or HTTP URL they are published at and
+provides an indexed catalog of known products so that requests can be
+validated before any network I/O is attempted.
+"""
+
+import re
+import txbom
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+
+# Details of where products are published
+BomFtpProductPath = "/anon/gen/%s/%s"
+BomObservationUrl = "http://www.bom.gov.au/fwo/%s/%s.%s.json"
+
+# The FTP directory products of each category are published in. Anything
+# not listed is found in the forecasts, warnings and observations
+# directory.
+CategoryFtpDirectories = {txbom.Radar: "radar",
+                          txbom.Satellite: "gms"}
+DefaultFtpDirectory = "fwo"
+
+# The extension used when none is given. Most products requested by
+# identifier alone are text products.
+DefaultExtension = "txt"
+
+CategoryNames = {txbom.Bundled: "Bundled",
+                 txbom.Climate: "Climate",
+                 txbom.NT: "NT",
+                 txbom.Satellite: "Satellite",
+                 txbom.Graphical: "Graphical",
+                 txbom.NSW: "NSW/ACT",
+                 txbom.QLD: "QLD",
+                 txbom.Radar: "Radar",
+                 txbom.SA: "SA",
+                 txbom.TAS: "TAS",
+                 txbom.VIC: "VIC",
+                 txbom.WA: "WA",
+                 txbom.Digital_Fax: "Digital Fax",
+                 txbom.National_Operations_Centre: "National Operations Centre"}
+
+Extensions = ["au", "axf", "cat", "gif", "htm", "jpg", "json", "mpg", "nc",
+              "png", "ps", "txt", "wav", "xml"]
+
+ProductIdPattern = re.compile(r"^ID([A-Z])([0-9A-Z]+)(?:\.([a-z]+))?$")
+
+# The path of an observations URL, e.g. /fwo/IDS60901/IDS60901.94675.json
+ObservationPathPattern = re.compile(r"^/fwo/(ID[A-Z][0-9A-Z]+)/(ID[A-Z][0-9A-Z]+)\.([0-9]+)\.json$")
+
+
+class ProductId(object):
+    """
+    A parsed product identifier.
+
+    For example ProductId("IDR643.gif") has a category of txbom.Radar,
+    a product of '643', an extension of 'gif' and a state of None, while
+    ProductId("IDS10034") has a category and state of txbom.SA.
+    """
+
+    def __init__(self, productId):
+        match = ProductIdPattern.match(productId)
+        if match is None:
+            raise ValueError("Invalid product identifier: %s" % productId)
+
+        category, product, extension = match.groups()
+        if category not in txbom.Categories:
+            raise ValueError("Invalid product category '%s' in: %s" % (category, productId))
+        if extension is not None and extension not in Extensions:
+            raise ValueError("Invalid product extension '%s' in: %s" % (extension, productId))
+
+        self.category = category
+        self.product = product
+        self.extension = extension
+
+        # The identifier without any extension, e.g. IDS10034
+        self.id = "ID%s%s" % (category, product)
+
+        self.state = category if category in txbom.StateCategories else None
+
+    @property
+    def categoryName(self):
+        return CategoryNames[self.category]
+
+    @property
+    def filename(self):
+        """
+        Return the file name of the product, using the default extension
+        if none was specified.
+        """
+        return "%s.%s" % (self.id, self.extension or DefaultExtension)
+
+    @property
+    def ftp_path(self):
+        """
+        Return the path of the product on the BOM FTP server
+        """
+        directory = CategoryFtpDirectories.get(self.category, DefaultFtpDirectory)
+        return BomFtpProductPath % (directory, self.filename)
+
+    def observation_url(self, wmo):
+        """
+        Return the URL of the JSON observations for a station within
+        this observations product.
+        """
+        return BomObservationUrl % (self.id, self.id, wmo)
+
+    def __eq__(self, other):
+        return isinstance(other, ProductId) and str(self) == str(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __str__(self):
+        if self.extension:
+            return "%s.%s" % (self.id, self.extension)
+        return self.id
+
+
+def isProductId(productId):
+    """
+    Return True if the string is a valid product identifier
+    """
+    try:
+        ProductId(productId)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def forecastId(productId):
+    """
+    Return the identifier of a text product, such as a forecast, without
+    its extension, e.g. IDS10034 for IDS10034.txt, or None if the string
+    isn't a valid text product identifier.
+    """
+    try:
+        parsed = ProductId(productId)
+    except (TypeError, ValueError):
+        return None
+    if parsed.extension not in (None, DefaultExtension):
+        return None
+    return parsed.id
+
+
+def parseObservationUrl(observation_url):
+    """
+    Return a (ProductId, wmo) tuple extracted from a BOM observations
+    URL, or None if the URL is not a valid observations URL.
+    """
+    try:
+        path = urlparse(observation_url).path
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+    match = ObservationPathPattern.match(path)
+    if match is None:
+        return None
+
+    product, fileProduct, wmo = match.groups()
+    if product != fileProduct or not isProductId(product):
+        return None
+    return (ProductId(product), wmo)
+
+
+def isValidObservationUrl(observation_url):
+    """
+    Return True if the URL can be requested. URLs on the BOM web site
+    must follow the observations URL structure. URLs on other hosts,
+    such as local mirrors, are not checked.
+    """
+    try:
+        host = urlparse(observation_url).hostname or ""
+    except (AttributeError, TypeError, ValueError):
+        return False
+
+    if host == "bom.gov.au" or host.endswith(".bom.gov.au"):
+        return parseObservationUrl(observation_url) is not None
+    return True
+
+
+class Product(object):
+    """
+    A catalog entry. The FTP path is computed once when the entry is
+    created.
+    """
+
+    def __init__(self, productId, description=None):
+        if not isinstance(productId, ProductId):
+            productId = ProductId(productId)
+        self.productId = productId
+        self.description = description
+        self.ftp_path = productId.ftp_path
+
+    @property
+    def id(self):
+        return self.productId.id
+
+    @property
+    def category(self):
+        return self.productId.category
+
+    @property
+    def state(self):
+        return self.productId.state
+
+    def __str__(self):
+        return "%s %s" % (self.productId, self.description or "")
+
+
+class ProductCatalog(object):
+    """
+    An indexed collection of products that can be queried by identifier,
+    category or state. Identifiers with and without the default extension,
+    e.g. IDS10034 and IDS10034.txt, refer to the same product.
+    """
+
+    def __init__(self, products=None):
+        # product file name -> Product
+        self.products = {}
+        # category -> {product file name: Product}
+        self.categories = {}
+
+        for productId, description in products or []:
+            self.add(productId, description)
+
+    def __len__(self):
+        return len(self.products)
+
+    def __contains__(self, productId):
+        return self._key(productId) in self.products
+
+    def _key(self, productId):
+        try:
+            if not isinstance(productId, ProductId):
+                productId = ProductId(productId)
+        except (TypeError, ValueError):
+            return None
+        return productId.filename
+
+    def add(self, productId, description=None):
+        """
+        Add a product to the catalog and return its entry. A ValueError
+        is raised if the product identifier is invalid.
+        """
+        product = Product(productId, description)
+        key = product.productId.filename
+        self.products[key] = product
+        self.categories.setdefault(product.category, {})[key] = product
+        return product
+
+    def get(self, productId):
+        """
+        Return the catalog entry for a product identifier or None.
+        """
+        return self.products.get(self._key(productId))
+
+    def byCategory(self, category):
+        """
+        Return a list of products in a category, e.g. txbom.Radar
+        """
+        return sorted(self.categories.get(category, {}).values(), key=str)
+
+    def byState(self, state):
+        """
+        Return a list of products for a state, e.g. txbom.VIC. As the ACT
+        shares a category with NSW the products of both are returned
+        for either.
+        """
+        if state not in txbom.StateCategories:
+            return []
+        return self.byCategory(state)
+
+    def validate(self, productId):
+        """
+        Return the catalog entry for a product identifier. A ValueError is
+        raised if the identifier is invalid or not in the catalog.
+        """
+        product = self.get(productId)
+        if product is None:
+            # raises a ValueError describing a malformed identifier
+            ProductId(str(productId))
+            raise ValueError("Unknown product identifier: %s" % productId)
+        return product
+
+
+# Commonly used products
+CapitalCityForecasts = [("IDN10035", "Canberra Forecast"),
+                        ("IDN10064", "Sydney Forecast"),
+                        ("IDD10150", "Darwin Forecast"),
+                        ("IDQ10095", "Brisbane Forecast"),
+                        ("IDS10034", "Adelaide Forecast"),
+                        ("IDT65061", "Hobart Forecast"),
+                        ("IDV10450", "Melbourne Forecast"),
+                        ("IDW12300", "Perth Forecast")]
+
+StateObservations = [("IDN60903", "ACT Observations"),
+                     ("IDN60901", "NSW Observations"),
+                     ("IDD60901", "NT Observations"),
+                     ("IDQ60901", "QLD Observations"),
+                     ("IDS60901", "SA Observations"),
+                     ("IDT60901", "TAS Observations"),
+                     ("IDV60901", "VIC Observations"),
+                     ("IDW60901", "WA Observations")]
+
+catalog = ProductCatalog(CapitalCityForecasts + StateObservations)
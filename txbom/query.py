@@ -0,0 +1,417 @@
+
+"""
+Time-series queries over the observation history of many stations.
+
+An ObservationQuery keeps a summary (min, max, sum, count and last value)
+of each numeric field for every station and time bucket, updated as
+rows are added to a txbom.history.HistoryStore. Queries over a time range
+combine the summaries of the whole buckets inside the range and only
+look at individual rows at the edges of the range, so repeated queries
+over long histories and many stations don't scan every row. Buckets
+are rebuilt when the store discards rows, and the memory they use is
+charged to the store's MemoryBudget, if it has one.
+
+The summaries of stations whose history has been evicted to disk are
+kept, so aggregates over whole buckets don't read them back. Rows at
+the edges of a range, and delta queries, read a spilled history with
+HistoryStore.peek, which doesn't load it into the store or evict other
+stations.
+
+For example, the maximum gust of each station over the last day and the
+stations where the air temperature has dropped by 5 degrees in an hour:
+
+store = HistoryStore()
+query = ObservationQuery(store, [GUST_KMH, AIR_TEMP])
+client = txbom.observations.Client(observation_url, publisher=store)
+...
+gusts = query.summarise(GUST_KMH, now - 86400, now, MAX)
+cooling = query.changedBy(AIR_TEMP, -5, 3600)
+
+Times are given in seconds since the epoch, see txbom.history.epoch.
+
+This module does not depend on Twisted.
+"""
+
+import bisect
+import heapq
+import sys
+
+
+MIN = "min"
+MAX = "max"
+MEAN = "mean"
+SUM = "sum"
+COUNT = "count"
+LAST = "last"
+
+Aggregates = [MIN, MAX, MEAN, SUM, COUNT, LAST]
+
+# Bucket sizes, in seconds, maintained by default
+DefaultBucketSizes = (3600, 86400)
+
+# The estimated memory, in bytes, used by each bucket: its Summary and
+# values, its start time and its entries in a BucketSeries.
+BucketBytes = 3 * sys.getsizeof(0.0) + sys.getsizeof(2 ** 40) + 150
+
+
+def _toFloat(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Summary(object):
+    """
+    The aggregate of a set of values.
+    """
+
+    __slots__ = ("min", "max", "sum", "count", "last", "lastTime")
+
+    def __init__(self):
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.count = 0
+        self.last = None
+        self.lastTime = None
+
+    def add(self, timestamp, value):
+        if self.count == 0 or value < self.min:
+            self.min = value
+        if self.count == 0 or value > self.max:
+            self.max = value
+        self.sum += value
+        self.count += 1
+        if self.lastTime is None or timestamp >= self.lastTime:
+            self.last = value
+            self.lastTime = timestamp
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        if self.count == 0 or other.min < self.min:
+            self.min = other.min
+        if self.count == 0 or other.max > self.max:
+            self.max = other.max
+        self.sum += other.sum
+        self.count += other.count
+        if self.lastTime is None or other.lastTime >= self.lastTime:
+            self.last = other.last
+            self.lastTime = other.lastTime
+
+    def value(self, aggregate):
+        """
+        Return the value of one of the Aggregates, or None if the summary
+        is empty.
+        """
+        if self.count == 0:
+            return None if aggregate != COUNT else 0
+        if aggregate == MEAN:
+            return self.sum / self.count
+        if aggregate in Aggregates:
+            return getattr(self, aggregate)
+        raise ValueError("Unknown aggregate: %s" % aggregate)
+
+
+class BucketSeries(object):
+    """
+    The bucket summaries of one field of one station for one bucket size.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        # bucket start times in ascending order
+        self.keys = []
+        # bucket start time -> Summary
+        self.buckets = {}
+
+    def add(self, timestamp, value):
+        """
+        Add a value to its bucket.
+
+        @return: The number of buckets created
+        """
+        key = timestamp - timestamp % self.size
+        summary = self.buckets.get(key)
+        created = 0
+        if summary is None:
+            summary = self.buckets[key] = Summary()
+            created = 1
+            if not self.keys or key > self.keys[-1]:
+                self.keys.append(key)
+            else:
+                bisect.insort(self.keys, key)
+        summary.add(timestamp, value)
+        return created
+
+    def replace(self, key, summary):
+        """
+        Replace the summary of a bucket, removing the bucket if the summary
+        is empty.
+
+        @return: The number of buckets removed
+        """
+        if key not in self.buckets:
+            return 0
+        if summary.count:
+            self.buckets[key] = summary
+            return 0
+        del self.buckets[key]
+        del self.keys[bisect.bisect_left(self.keys, key)]
+        return 1
+
+    def range(self, start, end):
+        """
+        Return the bucket start times within [start, end).
+        """
+        return self.keys[bisect.bisect_left(self.keys, start):bisect.bisect_left(self.keys, end)]
+
+
+class ObservationQuery(object):
+    """
+    Aggregate, delta and top-K queries over a HistoryStore.
+
+    Summaries are kept for the given numeric fields at each of the
+    bucket sizes. Rows already in the store, including those spilled to
+    disk, are summarised when the query is created and new rows as they
+    are added. The buckets of rows the store discards are rebuilt from
+    the rows that remain.
+    """
+
+    def __init__(self, store, fields, bucketSizes=DefaultBucketSizes):
+        self.store = store
+        self.fields = list(fields)
+        self.bucketSizes = sorted(bucketSizes, reverse=True)
+
+        # (station, field, size) -> BucketSeries
+        self.series = {}
+
+        # the number of buckets in all of the series
+        self.bucketCount = 0
+
+        for station in store.stationNames():
+            history = store.peek(station)
+            for timestamp, observation in zip(history.times, history.rows):
+                self.rowAdded(station, timestamp, observation)
+        store.addListener(self.rowAdded)
+        store.addRemovalListener(self.rowsRemoved)
+
+    @property
+    def size(self):
+        """
+        The estimated memory, in bytes, used by the summaries.
+        """
+        return self.bucketCount * BucketBytes
+
+    def close(self):
+        """
+        Stop following updates to the store, and release the memory
+        charged to its budget.
+        """
+        self.store.removeListener(self.rowAdded)
+        self.store.removeRemovalListener(self.rowsRemoved)
+        self._counted(-self.bucketCount)
+
+    def _counted(self, created):
+        """
+        Record created buckets, or removed buckets if negative.
+        """
+        if not created:
+            return
+        self.bucketCount += created
+        if self.store.budget is not None:
+            self.store.budget.adjust(created * BucketBytes)
+
+    def rowAdded(self, station, timestamp, observation):
+        created = 0
+        for field in self.fields:
+            value = _toFloat(getattr(observation, field, None))
+            if value is None:
+                continue
+            for size in self.bucketSizes:
+                key = (station, field, size)
+                series = self.series.get(key)
+                if series is None:
+                    series = self.series[key] = BucketSeries(size)
+                created += series.add(timestamp, value)
+        self._counted(created)
+
+    def rowsRemoved(self, station, times, history):
+        """
+        Rebuild the buckets that held rows discarded by the store from the
+        rows of history, the station's remaining history or None.
+        """
+        removed = 0
+        for size in self.bucketSizes:
+            keys = set(timestamp - timestamp % size for timestamp in times)
+            for field in self.fields:
+                series = self.series.get((station, field, size))
+                if series is None:
+                    continue
+                for key in keys:
+                    summary = Summary()
+                    if history is not None:
+                        self._rowSummary(summary, history, field, key, key + size)
+                    removed += series.replace(key, summary)
+                if not series.keys:
+                    del self.series[(station, field, size)]
+        self._counted(-removed)
+
+    def _stations(self, stations):
+        if stations is None:
+            return self.store.stationNames()
+        return [str(s) for s in stations]
+
+    def _checkField(self, field):
+        if field not in self.fields:
+            raise ValueError("Field %s is not summarised" % field)
+
+    def _rowSummary(self, summary, history, field, start, end):
+        first = bisect.bisect_left(history.times, start)
+        last = bisect.bisect_left(history.times, end)
+        for i in range(first, last):
+            value = _toFloat(getattr(history.rows[i], field, None))
+            if value is not None:
+                summary.add(history.times[i], value)
+
+    def _merge(self, summary, history, station, field, start, end, sizes):
+        """
+        Add the values of a field over [start, end) to summary, using the
+        largest bucket size that fits within the range and smaller bucket
+        sizes, then individual rows, for the remainder at either end.
+
+        @param history: A callable returning the station's StationHistory
+                        or None, called only if individual rows are needed.
+        """
+        if start >= end:
+            return
+
+        for i, size in enumerate(sizes):
+            first = -(-start // size) * size
+            last = end - end % size
+            if first >= last:
+                continue
+            series = self.series.get((station, field, size))
+            if series is None:
+                # the station has no values for the field
+                return
+            for key in series.range(first, last):
+                summary.merge(series.buckets[key])
+            self._merge(summary, history, station, field, start, first, sizes[i + 1:])
+            self._merge(summary, history, station, field, last, end, sizes[i + 1:])
+            return
+
+        rows = history()
+        if rows is not None:
+            self._rowSummary(summary, rows, field, start, end)
+
+    def _summary(self, station, field, start, end):
+        """
+        Return the Summary of a field of a station over [start, end).
+        """
+        summary = Summary()
+        # the history, read once if needed
+        histories = []
+
+        def history():
+            if not histories:
+                histories.append(self.store.peek(station))
+            return histories[0]
+
+        self._merge(summary, history, station, field, start, end, self.bucketSizes)
+        return summary
+
+    def summarise(self, field, start, end, aggregate, stations=None):
+        """
+        Aggregate a field over a time range for each station.
+
+        @param aggregate: One of Aggregates, e.g. MAX.
+        @param stations: The stations to include. Defaults to all.
+
+        @return: A dict of station to aggregate value. Stations without
+                 any values in the range are omitted.
+        @rtype: dict
+        """
+        self._checkField(field)
+        result = {}
+        for station in self._stations(stations):
+            summary = self._summary(station, field, int(start), int(end))
+            if summary.count:
+                result[station] = summary.value(aggregate)
+        return result
+
+    def buckets(self, field, size, start, end, aggregate, stations=None):
+        """
+        Return a field aggregated into buckets of one of the bucket sizes.
+
+        @return: A dict of station to a list of (bucket start time, value)
+                 tuples in time order.
+        @rtype: dict
+        """
+        self._checkField(field)
+        if size not in self.bucketSizes:
+            raise ValueError("Bucket size %s is not maintained" % size)
+
+        result = {}
+        for station in self._stations(stations):
+            series = self.series.get((station, field, size))
+            if series is None:
+                continue
+            values = [(key, series.buckets[key].value(aggregate))
+                      for key in series.range(int(start) - int(start) % size, int(end))]
+            if values:
+                result[station] = values
+        return result
+
+    def _value(self, history, field, timestamp):
+        observation = history.at(timestamp)
+        if observation is None:
+            return None
+        return _toFloat(getattr(observation, field, None))
+
+    def delta(self, field, window, end=None, stations=None):
+        """
+        Return the change in a field over a window of seconds ending at
+        end, which defaults to the most recent observation of each
+        station.
+
+        @return: A dict of station to change. Stations without values at
+                 both ends of the window are omitted.
+        @rtype: dict
+        """
+        result = {}
+        for station in self._stations(stations):
+            history = self.store.peek(station)
+            if history is None or not history.times:
+                continue
+            stationEnd = history.times[-1] if end is None else int(end)
+            new = self._value(history, field, stationEnd)
+            old = self._value(history, field, stationEnd - window)
+            if new is not None and old is not None:
+                result[station] = new - old
+        return result
+
+    def changedBy(self, field, amount, window, end=None, stations=None):
+        """
+        Return the stations where a field has changed by at least amount
+        over the window. A negative amount selects decreases.
+
+        @return: A dict of station to change.
+        @rtype: dict
+        """
+        deltas = self.delta(field, window, end, stations)
+        if amount < 0:
+            return dict((s, d) for s, d in deltas.items() if d <= amount)
+        return dict((s, d) for s, d in deltas.items() if d >= amount)
+
+    def top(self, field, k, start, end, aggregate=MAX, smallest=False, stations=None):
+        """
+        Return the k stations with the largest, or smallest, aggregate of
+        a field over a time range.
+
+        @return: A list of (station, value) tuples, best first.
+        """
+        values = self.summarise(field, start, end, aggregate, stations)
+        select = heapq.nsmallest if smallest else heapq.nlargest
+        return select(k, values.items(), key=lambda item: item[1])
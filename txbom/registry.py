@@ -0,0 +1,192 @@
+
+"""
+Manage the lifecycle of many observation Clients.
+
+A ClientRegistry holds Clients keyed by observation URL. Clients are
+started in batches so that thousands of them don't all make their first
+request at the same moment, and stopping a client, whether it is
+removed or the whole registry is shut down, cancels its scheduled calls
+and requests in progress and closes its connections. Live counts of
+each are available from counts.
+
+For example:
+
+registry = ClientRegistry()
+registry.install()  # shut down with the reactor
+for observation_url in observation_urls:
+    registry.add(Client(observation_url))
+registry.startAll()
+...
+registry.remove(observation_url)
+print(registry.counts())
+"""
+
+import collections
+import logging
+from twisted.internet import defer, reactor
+
+
+# Clients are started DefaultBatchSize at a time, DefaultBatchInterval
+# seconds apart.
+DefaultBatchSize = 100
+DefaultBatchInterval = 1.0
+
+
+class ClientRegistry(object):
+    """
+    The observation Clients of a process.
+
+    @param batchSize: The number of clients started at a time by startAll.
+    @param batchInterval: The delay, in seconds, between batches.
+    @param clock: The IReactorTime provider used to schedule batches.
+                  Defaults to the reactor.
+    """
+
+    def __init__(self, batchSize=DefaultBatchSize, batchInterval=DefaultBatchInterval,
+                 clock=None):
+        self.batchSize = batchSize
+        self.batchInterval = batchInterval
+        self.clock = clock or reactor
+
+        # observation url -> Client
+        self.clients = {}
+
+        # Clients waiting to be started by startAll, the call that starts
+        # the next batch and the deferreds returned by startAll.
+        self.starting = collections.deque()
+        self.startCall = None
+        self.waiting = []
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __contains__(self, observation_url):
+        return observation_url in self.clients
+
+    def __iter__(self):
+        return iter(list(self.clients))
+
+    def get(self, observation_url):
+        return self.clients.get(observation_url)
+
+    def add(self, client):
+        """
+        Register a client, stopping any other client registered for the
+        same URL.
+
+        @return: The client
+        """
+        previous = self.clients.get(client.observation_url)
+        if previous is not None and previous is not client:
+            previous.stop()
+        self.clients[client.observation_url] = client
+        return client
+
+    def remove(self, observation_url):
+        """
+        Stop and unregister the client for a URL.
+
+        @return: The client, or None if no client was registered
+        """
+        client = self.clients.pop(observation_url, None)
+        if client is not None:
+            client.stop()
+        return client
+
+    def startAll(self):
+        """
+        Start every registered client that isn't running, batchSize
+        clients at a time.
+
+        @return: A deferred that fires once the clients have been started,
+                 or startAll is cancelled by stopAll.
+        @rtype: defer.Deferred
+        """
+        queued = set(self.starting)
+        for client in self.clients.values():
+            if not client.running and client not in queued:
+                self.starting.append(client)
+
+        d = defer.Deferred()
+        self.waiting.append(d)
+        if self.startCall is None:
+            self._startBatch()
+        return d
+
+    def _startBatch(self):
+        self.startCall = None
+        started = 0
+        while self.starting and started < self.batchSize:
+            client = self.starting.popleft()
+            # skip clients removed or replaced since they were queued
+            if self.clients.get(client.observation_url) is client and not client.running:
+                client.start()
+                started += 1
+
+        if self.starting:
+            self.startCall = self.clock.callLater(self.batchInterval, self._startBatch)
+        else:
+            self._startFinished()
+
+    def _startFinished(self):
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(None)
+
+    def stopAll(self):
+        """
+        Stop every client, and any batches still to be started. The
+        clients remain registered and can be started again.
+        """
+        if self.startCall is not None and self.startCall.active():
+            self.startCall.cancel()
+        self.startCall = None
+        self.starting.clear()
+        self._startFinished()
+
+        for client in self.clients.values():
+            client.stop()
+
+    def shutdown(self):
+        """
+        Stop and unregister every client.
+        """
+        self.stopAll()
+        for client in self.leaks():
+            logging.error("Client for %s still has %i scheduled calls, %i requests and %i connections after stopping" % (
+                client.observation_url, client.scheduledCalls, len(client.requests),
+                len(client.connections)))
+        self.clients.clear()
+
+    def install(self, _reactor=None):
+        """
+        Shut the registry down when the reactor shuts down.
+        """
+        (_reactor or reactor).addSystemEventTrigger("before", "shutdown", self.shutdown)
+
+    def leaks(self):
+        """
+        Return the stopped clients that still have scheduled calls,
+        requests in progress or open connections.
+
+        @rtype: list
+        """
+        return [client for client in self.clients.values()
+                if not client.running and
+                (client.scheduledCalls or client.requests or client.connections)]
+
+    def counts(self):
+        """
+        Return a dict of the number of registered, starting and running
+        clients and the total scheduled calls, requests in progress and
+        open connections of the clients.
+        """
+        counts = {"clients": len(self.clients), "starting": len(self.starting),
+                  "running": 0, "calls": 0, "requests": 0, "connections": 0}
+        for client in self.clients.values():
+            if client.running:
+                counts["running"] += 1
+            counts["calls"] += client.scheduledCalls
+            counts["requests"] += len(client.requests)
+            counts["connections"] += len(client.connections)
+        return counts
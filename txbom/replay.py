@@ -0,0 +1,411 @@
+
+"""
+Record BOM responses and replay them through the polling clients under a
+virtual clock.
+
+The observations Client schedules its requests from the timestamps in
+the data it retrieves, so the efficiency of its schedule can only be
+seen over many hours of real time. A Recorder samples observation URLs
+and forecasts at a short interval and keeps each distinct response with
+the time it was first seen. A Simulation replays a Recording through
+Clients running under a twisted.internet.task.Clock, so weeks of
+polling take seconds, and reports for each URL or forecast:
+
+requests  - the number of requests made
+wasted    - requests that returned data the client already had
+missed    - updates that were replaced before the client saw them
+staleness - the time between an update first being seen by the
+            recorder and the client retrieving it
+
+Staleness can't be measured more finely than the recording interval.
+
+For example:
+
+recording = Recording()
+recorder = Recorder(recording, observation_urls=urls, path="bom.jsonl.gz")
+recorder.start()
+...
+recording = load("bom.jsonl.gz")
+report = Simulation(recording, observation_urls=urls).run()
+print(report)
+"""
+
+import bisect
+import gzip
+import json
+import logging
+import time
+from twisted.internet import defer, reactor, task
+from twisted.web import error
+from txbom.forecasts import ForecastEncoding
+from txbom.ftp import get_forecast
+from txbom.products import isProductId
+from txbom.web import Client, fetch
+
+
+# How often the Recorder samples each item
+DefaultRecordInterval = 60
+
+# How often forecasts are retrieved during a Simulation, the same as
+# the txbom.service workers.
+DefaultForecastInterval = 30 * 60
+
+
+def _open(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "b")
+    return open(path, mode + "b")
+
+
+def _line(key, timestamp, body):
+    return (json.dumps({"key": key, "time": timestamp, "body": body}) + "\n").encode("utf-8")
+
+
+class Recording(object):
+    """
+    The distinct responses of a set of observation URLs and forecast
+    identifiers, each with the time it was first seen.
+    """
+
+    def __init__(self):
+        # key -> times each response was first seen, in ascending order
+        self.times = {}
+
+        # key -> response text in the same order as times
+        self.bodies = {}
+
+    def __len__(self):
+        return sum([len(times) for times in self.times.values()])
+
+    def keys(self):
+        return sorted(self.times)
+
+    @property
+    def start(self):
+        return min([times[0] for times in self.times.values()]) if self.times else None
+
+    @property
+    def end(self):
+        return max([times[-1] for times in self.times.values()]) if self.times else None
+
+    def add(self, key, timestamp, body):
+        """
+        Add a response. Responses must be added in time order and are
+        only kept if they differ from the previous response for the key.
+
+        @return: True if the response was kept.
+        """
+        if isinstance(body, bytes):
+            body = body.decode(ForecastEncoding if isProductId(key) else "utf-8")
+
+        times = self.times.setdefault(key, [])
+        bodies = self.bodies.setdefault(key, [])
+        if times and timestamp < times[-1]:
+            raise ValueError("Response for %s at %s is older than the last response" % (key, timestamp))
+        if bodies and bodies[-1] == body:
+            return False
+        times.append(timestamp)
+        bodies.append(body)
+        return True
+
+    def response(self, key, timestamp):
+        """
+        Return the index and text of the response for key that was
+        current at a time, or (None, None) if there was none.
+        """
+        index = bisect.bisect_right(self.times.get(key, []), timestamp) - 1
+        if index < 0:
+            return None, None
+        return index, self.bodies[key][index]
+
+    def save(self, path):
+        """
+        Write the recording to a file of JSON lines, compressed if path
+        ends with .gz.
+        """
+        entries = []
+        for key in self.times:
+            entries.extend(zip(self.times[key], [key] * len(self.times[key]), self.bodies[key]))
+        entries.sort(key=lambda entry: entry[0])
+
+        f = _open(path, "w")
+        try:
+            for timestamp, key, body in entries:
+                f.write(_line(key, timestamp, body))
+        finally:
+            f.close()
+
+
+def load(path):
+    """
+    Read a Recording written by Recording.save or a Recorder.
+    """
+    recording = Recording()
+    f = _open(path, "r")
+    try:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line.decode("utf-8"))
+                recording.add(entry["key"], entry["time"], entry["body"])
+    finally:
+        f.close()
+    return recording
+
+
+class Recorder(object):
+    """
+    Periodically retrieve observation URLs and forecasts and add the
+    responses to a Recording.
+
+    @param path: An optional file that each new response is appended to
+                 as it is recorded.
+    """
+
+    def __init__(self, recording, observation_urls=(), forecast_ids=(),
+                 interval=DefaultRecordInterval, path=None):
+        self.recording = recording
+        self.observation_urls = list(observation_urls)
+        self.forecast_ids = list(forecast_ids)
+        self.interval = interval
+        self.path = path
+
+        self.file = None
+        self.task = None
+
+    def start(self):
+        if self.path:
+            self.file = _open(self.path, "a")
+        self.task = task.LoopingCall(self.sample)
+        self.task.start(self.interval, now=True)
+
+    def stop(self):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        self.task = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _add(self, body, key):
+        if body is None:
+            return
+        timestamp = reactor.seconds()
+        if self.recording.add(key, timestamp, body) and self.file is not None:
+            self.file.write(_line(key, timestamp, self.recording.bodies[key][-1]))
+            self.file.flush()
+
+    def _failed(self, failure, key):
+        logging.error("Unable to record %s: %s" % (key, failure.getErrorMessage()))
+
+    def sample(self):
+        """
+        Retrieve every item once.
+
+        @return: A deferred that fires when all items have been retrieved
+        @rtype: defer.Deferred
+        """
+        ds = []
+        for observation_url in self.observation_urls:
+            d = fetch(observation_url)
+            d.addCallbacks(self._add, self._failed,
+                           callbackArgs=(observation_url,), errbackArgs=(observation_url,))
+            ds.append(d)
+        for forecast_id in self.forecast_ids:
+            d = get_forecast(forecast_id)
+            d.addCallbacks(self._add, self._failed,
+                           callbackArgs=(forecast_id,), errbackArgs=(forecast_id,))
+            ds.append(d)
+        return defer.DeferredList(ds)
+
+
+class PollStats(object):
+    """
+    The requests made for one item during a Simulation.
+    """
+
+    def __init__(self, key, times, start):
+        self.key = key
+
+        # The times each response became current, no earlier than the
+        # start of the simulation.
+        self.versionTimes = [max(t, start) for t in times]
+
+        self.requests = 0
+        self.wasted = 0
+        self.errors = 0
+
+        # response index -> time the client first retrieved it
+        self.received = {}
+
+        self.latest = None
+
+    def request(self, timestamp, index):
+        self.requests += 1
+        if index is None:
+            self.errors += 1
+        elif index == self.latest:
+            self.wasted += 1
+        else:
+            self.latest = index
+            self.received.setdefault(index, timestamp)
+
+    def versions(self, start, end):
+        """
+        Return the indices of the responses current at some time within
+        [start, end].
+        """
+        first = max(0, bisect.bisect_right(self.versionTimes, start) - 1)
+        last = bisect.bisect_right(self.versionTimes, end)
+        return range(first, last)
+
+    def staleness(self):
+        """
+        Return the delay, in seconds, before each retrieved response was
+        retrieved.
+        """
+        return [t - self.versionTimes[i] for i, t in sorted(self.received.items())]
+
+
+class Report(object):
+    """
+    The results of a Simulation.
+    """
+
+    def __init__(self, stats, start, end, elapsed):
+        # key -> PollStats
+        self.stats = stats
+        self.start = start
+        self.end = end
+
+        # The wall clock time the simulation took, in seconds
+        self.elapsed = elapsed
+
+    @property
+    def requests(self):
+        return sum([s.requests for s in self.stats.values()])
+
+    @property
+    def wasted(self):
+        return sum([s.wasted for s in self.stats.values()])
+
+    def missed(self, key):
+        stats = self.stats[key]
+        return len([i for i in stats.versions(self.start, self.end) if i not in stats.received])
+
+    def staleness(self):
+        """
+        Return the delays of every retrieved response of every item.
+        """
+        delays = []
+        for stats in self.stats.values():
+            delays.extend(stats.staleness())
+        return delays
+
+    def __str__(self):
+        lines = ["%-60s %8s %8s %8s %10s %10s" % ("item", "requests", "wasted", "missed",
+                                                  "mean stale", "max stale")]
+        for key in sorted(self.stats):
+            stats = self.stats[key]
+            delays = stats.staleness()
+            lines.append("%-60s %8i %8i %8i %10.0f %10.0f" % (
+                key, stats.requests, stats.wasted, self.missed(key),
+                sum(delays) / len(delays) if delays else 0, max(delays) if delays else 0))
+        delays = self.staleness()
+        lines.append("%i requests, %i wasted, mean staleness %.0fs over %.1f days "
+                     "simulated in %.2fs" % (
+                         self.requests, self.wasted,
+                         sum(delays) / len(delays) if delays else 0,
+                         (self.end - self.start) / 86400.0, self.elapsed))
+        return "\n".join(lines)
+
+
+class Simulation(object):
+    """
+    Replay a Recording through observation Clients, and periodic forecast
+    retrievals, running under a virtual clock.
+
+    @param observation_urls: The observation URLs to poll. Defaults to
+                             all observation URLs in the recording.
+    @param forecast_ids: The forecasts to poll. Defaults to all forecasts
+                         in the recording.
+    @param clientClass: The observations Client class, or a subclass
+                        implementing a different schedule.
+    @param start: The simulated start time. Defaults to the start of the
+                  recording.
+    @param end: The simulated end time. Defaults to the end of the
+                recording.
+    """
+
+    def __init__(self, recording, observation_urls=None, forecast_ids=None,
+                 forecastInterval=DefaultForecastInterval, clientClass=Client,
+                 start=None, end=None):
+        self.recording = recording
+        if observation_urls is None:
+            observation_urls = [k for k in recording.keys() if not isProductId(k)]
+        if forecast_ids is None:
+            forecast_ids = [k for k in recording.keys() if isProductId(k)]
+        self.observation_urls = list(observation_urls)
+        self.forecast_ids = list(forecast_ids)
+        self.forecastInterval = forecastInterval
+        self.clientClass = clientClass
+        self.start = recording.start if start is None else start
+        self.end = recording.end if end is None else end
+
+        self.clock = task.Clock()
+
+        # key -> PollStats
+        self.stats = {}
+
+    def _response(self, key):
+        index, body = self.recording.response(key, self.clock.seconds())
+        self.stats[key].request(self.clock.seconds(), index)
+        return body
+
+    def _fetch(self, observation_url):
+        body = self._response(observation_url)
+        if body is None:
+            return defer.fail(error.Error(404, b"No recorded response"))
+        return defer.succeed(body.encode("utf-8"))
+
+    def run(self):
+        """
+        Run the simulation from start to end.
+
+        @rtype: Report
+        """
+        began = time.time()
+        self.clock.advance(self.start)
+
+        for key in self.observation_urls + self.forecast_ids:
+            self.stats[key] = PollStats(key, self.recording.times.get(key, []), self.start)
+
+        clients = []
+        for observation_url in self.observation_urls:
+            client = self.clientClass(observation_url, clock=self.clock)
+            client.fetch = self._fetch
+            clients.append(client)
+            client.start()
+
+        tasks = []
+        for forecast_id in self.forecast_ids:
+            forecastTask = task.LoopingCall(self._response, forecast_id)
+            forecastTask.clock = self.clock
+            tasks.append(forecastTask)
+            forecastTask.start(self.forecastInterval, now=True)
+
+        # jump straight to each scheduled call rather than stepping
+        while True:
+            calls = self.clock.getDelayedCalls()
+            if not calls:
+                break
+            nextTime = min([call.getTime() for call in calls])
+            if nextTime > self.end:
+                break
+            self.clock.advance(nextTime - self.clock.seconds())
+
+        for client in clients:
+            client.stop()
+        for forecastTask in tasks:
+            forecastTask.stop()
+
+        return Report(self.stats, self.start, self.end, time.time() - began)
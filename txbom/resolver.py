@@ -0,0 +1,123 @@
+
+"""
+A caching host name resolver.
+
+Every FTP connection and HTTP request resolves the host name of the BOM
+servers again, and at refresh boundaries hundreds of identical lookups
+can be made at once. A CachingResolver keeps each address for a fixed
+time to live and shares a single lookup between concurrent requests for
+the same name.
+
+Install it as the reactor's resolver so that it is used by
+connectTCP, ClientCreator and Agent:
+
+resolver = CachingResolver()
+resolver.install()
+"""
+
+import logging
+from twisted.internet import defer, reactor
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+from twisted.internet.error import DNSLookupError
+from twisted.internet.interfaces import IResolverSimple
+from zope.interface import implementer
+
+
+# How long resolved addresses, and failed lookups, are kept in seconds
+DefaultTTL = 300
+DefaultNegativeTTL = 30
+
+
+@implementer(IResolverSimple)
+class CachingResolver(object):
+    """
+    Cache the addresses returned by another IResolverSimple.
+
+    @param resolver: The resolver used to look up names that aren't
+                     cached. Defaults to the reactor's resolver at the
+                     time the CachingResolver is created.
+    @param clock: The IReactorTime provider used to expire entries.
+    """
+
+    def __init__(self, resolver=None, ttl=DefaultTTL, negativeTTL=DefaultNegativeTTL,
+                 clock=None):
+        self.resolver = resolver or reactor.resolver
+        self.ttl = ttl
+        self.negativeTTL = negativeTTL
+        self.clock = clock or reactor
+
+        # name -> (address or None for a failed lookup, expiry time)
+        self.cache = {}
+
+        # name -> deferreds waiting for a lookup in progress
+        self.pending = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def install(self, _reactor=None):
+        """
+        Make this the resolver used by the reactor.
+        """
+        (_reactor or reactor).installResolver(self)
+
+    def getHostByName(self, name, timeout=(1, 3, 11, 45)):
+        """
+        Resolve a name, using the cached address if it hasn't expired.
+
+        @return: A deferred that returns the address
+        @rtype: defer.Deferred
+        """
+        if isIPAddress(name) or isIPv6Address(name):
+            return defer.succeed(name)
+
+        entry = self.cache.get(name)
+        if entry is not None and entry[1] > self.clock.seconds():
+            self.hits += 1
+            if entry[0] is None:
+                return defer.fail(DNSLookupError(name))
+            return defer.succeed(entry[0])
+
+        d = defer.Deferred()
+        waiting = self.pending.get(name)
+        if waiting is not None:
+            # share the lookup already in progress
+            self.hits += 1
+            waiting.append(d)
+            return d
+
+        self.misses += 1
+        self.pending[name] = [d]
+        lookup = self.resolver.getHostByName(name, timeout)
+        lookup.addCallbacks(self._resolved, self._failed,
+                            callbackArgs=(name,), errbackArgs=(name,))
+        return d
+
+    def _resolved(self, address, name):
+        self.cache[name] = (address, self.clock.seconds() + self.ttl)
+        for d in self.pending.pop(name, []):
+            d.callback(address)
+
+    def _failed(self, failure, name):
+        logging.debug("Unable to resolve %s: %s" % (name, failure.getErrorMessage()))
+        self.cache[name] = (None, self.clock.seconds() + self.negativeTTL)
+        for d in self.pending.pop(name, []):
+            d.errback(failure)
+
+    def prefetch(self, name, lead=0):
+        """
+        Resolve a name again if its cached address expires within lead
+        seconds, so that a later lookup is answered from the cache.
+
+        @return: A deferred that returns the address
+        @rtype: defer.Deferred
+        """
+        entry = self.cache.get(name)
+        if entry is not None and entry[1] <= self.clock.seconds() + lead:
+            del self.cache[name]
+        d = self.getHostByName(name)
+        d.addErrback(lambda _f: None)
+        return d
+
+    def clear(self):
+        self.cache.clear()
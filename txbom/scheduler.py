@@ -0,0 +1,376 @@
+
+"""
+Poll stations and forecasts according to freshness objectives.
+
+Each observation URL or forecast identifier is given a freshness SLO,
+the longest acceptable delay in seconds between an update becoming
+available and it being retrieved, and a priority tier, with tier 0 the
+most important. A FreshnessScheduler spends a global budget of requests
+per second on the items whose deadlines are closest, most important
+tier first, so requests to low tier items are delayed when the budget
+is exhausted rather than the request rate growing.
+
+Observations are published every 30 minutes, about 5 minutes after
+their observation time, so a station isn't polled again until its next
+update is expected, and then at RetryInterval until it arrives. Each
+expected update is met if it is retrieved within the SLO. Forecasts are
+issued at irregular times so a forecast's SLO is met if it is retrieved
+at least once every SLO seconds. An observation update published later
+than expected counts against the SLO if it arrives after the deadline.
+
+Given a txbom.prewarm.Prewarmer, the scheduler logs in an FTP session
+shortly before each scheduled forecast poll and the poll uses it.
+
+For example:
+
+scheduler = FreshnessScheduler(RequestBudget(rate=2.0, burst=20))
+scheduler.add(dashboard_url, slo=5 * 60, tier=0)
+scheduler.add(report_url, slo=6 * 3600, tier=2)
+scheduler.add("IDS10034", slo=15 * 60, tier=1)
+scheduler.start()
+...
+print(scheduler.report())
+"""
+
+import logging
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
+from txbom.ftp import get_forecast
+from txbom.history import epoch
+from txbom.products import isProductId
+from txbom.web import get_observations
+
+
+# Item types
+OBSERVATIONS = "observations"
+FORECAST = "forecast"
+
+# Observations are published every UpdatePeriod seconds, about
+# PublishDelay seconds after the observation time.
+UpdatePeriod = 30 * 60
+PublishDelay = 5 * 60
+
+# The time, after an observation update is expected, that the first
+# request is made. Capped at half the SLO.
+PollMargin = 2 * 60
+
+# The delay before polling again when an expected update hasn't arrived
+# yet or a request failed.
+RetryInterval = 60
+
+# Forecasts are polled after this fraction of their SLO has passed
+ForecastPollFraction = 0.8
+
+# How often, in seconds, the scheduler looks for items to poll
+DefaultTickInterval = 1.0
+
+
+class RequestBudget(object):
+    """
+    A token bucket limiting requests to rate per second, with bursts of
+    up to burst requests.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, rate))
+        self.tokens = self.burst
+        self.updated = None
+
+    def refill(self, now):
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """
+        Use one request from the budget.
+
+        @return: True if a request was available
+        """
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class TierStats(object):
+    """
+    SLO attainment and request counters for one priority tier.
+    """
+
+    def __init__(self):
+        # updates, or forecast SLO periods, that were retrieved in time
+        # and those that weren't.
+        self.met = 0
+        self.missed = 0
+
+        self.requests = 0
+
+        # polls that were due but postponed because the budget was
+        # exhausted.
+        self.delayed = 0
+
+    @property
+    def attainment(self):
+        total = self.met + self.missed
+        if total == 0:
+            return 1.0
+        return float(self.met) / total
+
+    def __str__(self):
+        return "%.1f%% of %i met, %i requests, %i delayed" % (
+            self.attainment * 100, self.met + self.missed, self.requests, self.delayed)
+
+
+class Item(object):
+    """
+    The polling state of an observation URL or forecast.
+    """
+
+    def __init__(self, key, slo, tier, now):
+        self.key = key
+        self.kind = FORECAST if isProductId(key) else OBSERVATIONS
+        self.slo = slo
+        self.tier = tier
+
+        # The earliest time worth polling and the time by which the
+        # current update must be retrieved.
+        self.earliest = now
+        self.deadline = now + slo
+
+        # The observation time of the latest observations, in seconds
+        # since the epoch, or the latest forecast text.
+        self.latest = None
+
+        self.inFlight = False
+        self.missed = False
+        self.delayed = False
+
+    def startCycle(self, earliest, deadline):
+        self.earliest = earliest
+        self.deadline = deadline
+        self.missed = False
+        self.delayed = False
+
+
+class FreshnessScheduler(object):
+    """
+    Poll items in order of priority tier and deadline within a request
+    budget.
+
+    @param budget: The RequestBudget shared by all items.
+    @param publisher: An optional txbom.subscriptions.Publisher passed
+                      every observation update.
+    @param clock: The IReactorTime provider used for scheduling.
+                  Defaults to the reactor.
+    @param maxInFlight: An optional limit on concurrent requests.
+    @param prewarmer: An optional txbom.prewarm.Prewarmer used to open
+                      FTP sessions before forecast polls.
+    """
+
+    def __init__(self, budget, publisher=None, clock=None,
+                 tickInterval=DefaultTickInterval, maxInFlight=None, prewarmer=None):
+        self.budget = budget
+        self.publisher = publisher
+        self.clock = clock or reactor
+        self.tickInterval = tickInterval
+        self.maxInFlight = maxInFlight
+        self.prewarmer = prewarmer
+
+        # forecast id -> the call that prewarms its next poll
+        self.prewarmCalls = {}
+
+        # key -> Item
+        self.items = {}
+
+        # tier -> TierStats
+        self.stats = {}
+
+        # observation url -> latest Observations
+        self.observations = {}
+
+        # forecast id -> latest forecast string
+        self.forecasts = {}
+
+        self.inFlight = 0
+        self.task = None
+
+    def add(self, key, slo, tier=0):
+        """
+        Start polling an observation URL or forecast identifier.
+
+        @param slo: The freshness objective in seconds.
+        @param tier: The priority tier, 0 being the most important.
+        """
+        self.items[key] = Item(key, slo, tier, self.clock.seconds())
+        self.stats.setdefault(tier, TierStats())
+
+    def remove(self, key):
+        self.items.pop(key, None)
+        self.observations.pop(key, None)
+        self.forecasts.pop(key, None)
+        self._cancelPrewarm(key)
+
+    def start(self):
+        self.task = LoopingCall(self.tick)
+        self.task.clock = self.clock
+        self.task.start(self.tickInterval, now=True)
+
+    def stop(self):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        self.task = None
+        for key in list(self.prewarmCalls):
+            self._cancelPrewarm(key)
+
+    def tick(self):
+        """
+        Record missed deadlines and poll the most urgent due items that
+        the budget allows.
+        """
+        now = self.clock.seconds()
+        self.budget.refill(now)
+
+        due = []
+        for item in self.items.values():
+            if now > item.deadline and not item.missed:
+                item.missed = True
+                self.stats[item.tier].missed += 1
+            if not item.inFlight and item.earliest <= now:
+                due.append(item)
+
+        due.sort(key=lambda item: (item.tier, item.deadline))
+        for item in due:
+            if (self.maxInFlight is not None and self.inFlight >= self.maxInFlight) or \
+               not self.budget.take():
+                if not item.delayed:
+                    item.delayed = True
+                    self.stats[item.tier].delayed += 1
+                continue
+            self.poll(item)
+
+    @defer.inlineCallbacks
+    def poll(self, item):
+        """
+        Retrieve an item and schedule its next poll.
+        """
+        item.inFlight = True
+        self.inFlight += 1
+        self.stats[item.tier].requests += 1
+        try:
+            if item.kind == FORECAST:
+                result = yield self.retrieveForecast(item.key)
+            else:
+                result = yield self.retrieveObservations(item.key)
+        except Exception as ex:
+            logging.error("Unable to retrieve %s" % item.key)
+            logging.exception(ex)
+            result = None
+        finally:
+            item.inFlight = False
+            self.inFlight -= 1
+
+        if self.items.get(item.key) is not item:
+            # removed while the request was in progress
+            return
+
+        now = self.clock.seconds()
+        if result is None:
+            item.earliest = now + RetryInterval
+        elif item.kind == FORECAST:
+            self._forecastPolled(item, result, now)
+        else:
+            self._observationsPolled(item, result, now)
+
+    def _met(self, item):
+        if not item.missed:
+            self.stats[item.tier].met += 1
+
+    def _forecastPolled(self, item, forecast, now):
+        self._met(item)
+        item.startCycle(now + item.slo * ForecastPollFraction, now + item.slo)
+        self._schedulePrewarm(item, now)
+        if forecast != item.latest:
+            item.latest = forecast
+            self.forecasts[item.key] = forecast
+            self.forecastReceived(item.key, forecast)
+
+    def _observationsPolled(self, item, observations, now):
+        timestamp = epoch(observations.current.aifstime_utc) if observations.current else None
+        if timestamp is None or (item.latest is not None and timestamp <= item.latest):
+            # the expected update hasn't been published yet
+            item.earliest = now + RetryInterval
+            return
+
+        self._met(item)
+        item.latest = timestamp
+        expected = timestamp + UpdatePeriod + PublishDelay
+        item.startCycle(max(now, expected + min(PollMargin, item.slo / 2.0)),
+                        max(now, expected) + item.slo)
+
+        self.observations[item.key] = observations
+        self.observationsReceived(item.key, observations)
+        if self.publisher:
+            self.publisher.publish(observations)
+
+    def _schedulePrewarm(self, item, now):
+        """
+        Prewarm an FTP session shortly before the next poll of a forecast.
+        """
+        if self.prewarmer is None:
+            return
+        self._cancelPrewarm(item.key)
+        delay = item.earliest - now - self.prewarmer.lead
+        if delay > 0:
+            self.prewarmCalls[item.key] = self.clock.callLater(delay, self._prewarm, item.key)
+
+    def _prewarm(self, forecast_id):
+        del self.prewarmCalls[forecast_id]
+        d = self.prewarmer.prewarm(forecast_id)
+        d.addErrback(lambda failure: logging.debug("Unable to prewarm a session for %s: %s" % (
+            forecast_id, failure.getErrorMessage())))
+
+    def _cancelPrewarm(self, key):
+        call = self.prewarmCalls.pop(key, None)
+        if call is not None and call.active():
+            call.cancel()
+
+    def retrieveObservations(self, observation_url):
+        """
+        Retrieve observations. Override this method to supply them from
+        elsewhere.
+
+        @return: A deferred that returns an Observations object or None
+        @rtype: defer.Deferred
+        """
+        return get_observations(observation_url)
+
+    def retrieveForecast(self, forecast_id):
+        """
+        Retrieve a forecast. Override this method to supply forecasts from
+        elsewhere.
+
+        @return: A deferred that returns the forecast string or None
+        @rtype: defer.Deferred
+        """
+        sessions = self.prewarmer.sessions if self.prewarmer is not None else None
+        return get_forecast(forecast_id, sessions=sessions)
+
+    def report(self):
+        """
+        Return a summary of SLO attainment for each tier.
+        """
+        return "\n".join(["tier %i: %s" % (tier, self.stats[tier]) for tier in sorted(self.stats)])
+
+    def observationsReceived(self, observation_url, observations):
+        """
+        Override this method to receive new observations.
+        """
+        pass
+
+    def forecastReceived(self, forecast_id, forecast):
+        """
+        Override this method to receive forecasts as they change.
+        """
+        pass
@@ -0,0 +1,452 @@
+
+"""
+Poll thousands of stations and forecasts using a pool of worker processes.
+
+A Supervisor partitions observation URLs and forecast identifiers across
+a number of worker processes. Each worker runs the normal observations
+Client and forecast retrieval code for its share of the items and sends
+the parsed results back to the supervisor over its stdin/stdout pipes.
+
+Items are assigned to workers using rendezvous (highest random weight)
+hashing. Each item goes to the live worker with the highest hash of the
+worker name and item, so the assignment is the same on every run and
+adding or losing a worker only moves the items assigned to that worker.
+When a worker dies its items are spread over the remaining workers and
+move back once the worker has been restarted.
+
+Messages are marshal encoded tuples framed as netstrings. Observations
+are sent in the compact form used by txbom.bulk which sends the field
+names of the rows only once per response.
+
+For example:
+
+supervisor = Supervisor(observation_urls=urls, forecast_ids=ids, workers=4)
+reactor.callWhenRunning(supervisor.start)
+"""
+
+import hashlib
+import logging
+import marshal
+import multiprocessing
+import os
+import sys
+from twisted.internet import reactor, defer
+from twisted.internet.endpoints import ProcessEndpoint
+from twisted.internet.protocol import Factory
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import NetstringReceiver
+from txbom.bulk import (compactForecast, expandForecast, packObservations,
+                        expandObservations)
+from txbom.ftp import get_forecast
+from txbom.registry import ClientRegistry
+from txbom.web import Client
+
+
+# How often workers retrieve each forecast. Forecasts are only sent to
+# the supervisor when they have changed.
+Forecast_Frequency_In_Seconds = 30 * 60
+
+# Delay before a worker that has exited is restarted
+RestartDelayInSeconds = 5
+
+# The largest message accepted, in bytes
+MaxMessageLength = 16 * 1024 * 1024
+
+# Message types
+ASSIGN = "assign"
+STOP = "stop"
+OBSERVATIONS = "observations"
+FORECAST = "forecast"
+
+# marshal format version used for messages. Version 2 is understood by
+# every supported Python.
+MarshalVersion = 2
+
+
+def _weight(name, key):
+    digest = hashlib.md5(("%s:%s" % (name, key)).encode("utf-8")).hexdigest()
+    return int(digest[:16], 16)
+
+
+def rendezvous(key, names):
+    """
+    Return the name, from names, that key is assigned to or None if names
+    is empty.
+    """
+    best = None
+    bestWeight = -1
+    for name in names:
+        weight = _weight(name, key)
+        if weight > bestWeight:
+            best, bestWeight = name, weight
+    return best
+
+
+def partition(keys, names):
+    """
+    Assign every key to one of the names.
+
+    @return: A dict of name to a sorted list of the keys assigned to it.
+    Every name is present, even if no keys are assigned to it.
+    """
+    assignments = dict((name, []) for name in names)
+    if not assignments:
+        return assignments
+    for key in keys:
+        assignments[rendezvous(key, names)].append(key)
+    for name in assignments:
+        assignments[name].sort()
+    return assignments
+
+
+class MessageProtocol(NetstringReceiver):
+    """
+    Send and receive marshal encoded message tuples.
+    """
+
+    MAX_LENGTH = MaxMessageLength
+
+    def sendMessage(self, *message):
+        self.sendString(marshal.dumps(message, MarshalVersion))
+
+    def stringReceived(self, string):
+        try:
+            message = marshal.loads(string)
+            self.messageReceived(message[0], *message[1:])
+        except Exception as ex:
+            logging.error("Unable to handle message")
+            logging.exception(ex)
+
+    def messageReceived(self, kind, *args):
+        """
+        Override this method to handle messages.
+        """
+        pass
+
+
+class WorkerConnection(MessageProtocol):
+    """
+    The supervisor's end of the pipes to a worker process.
+    """
+
+    def __init__(self, supervisor, name):
+        self.supervisor = supervisor
+        self.name = name
+
+        # fires when the worker process has exited
+        self.ended = defer.Deferred()
+
+    def messageReceived(self, kind, *args):
+        if kind == OBSERVATIONS:
+            observation_url, compact = args
+            self.supervisor._observationsReceived(observation_url, expandObservations(compact))
+        elif kind == FORECAST:
+            forecast_id, compact = args
+            self.supervisor._forecastReceived(forecast_id, expandForecast(compact))
+        else:
+            logging.error("Unexpected message from %s: %s" % (self.name, kind))
+
+    def assign(self, observation_urls, forecast_ids, forecastInterval):
+        self.sendMessage(ASSIGN, tuple(observation_urls), tuple(forecast_ids),
+                         forecastInterval)
+
+    def connectionLost(self, reason):
+        self.supervisor._workerEnded(self.name, reason)
+        self.ended.callback(None)
+
+
+class WorkerFactory(Factory):
+    """
+    Create the WorkerConnection for a worker process.
+    """
+
+    def __init__(self, supervisor, name):
+        self.supervisor = supervisor
+        self.name = name
+
+    def buildProtocol(self, addr):
+        return WorkerConnection(self.supervisor, self.name)
+
+
+class Supervisor(object):
+    """
+    Retrieve observations and forecasts for large numbers of stations
+    using a pool of worker processes.
+
+    Results are passed to observationsReceived and forecastReceived, which
+    can be overridden to write them to a shared store, and observations
+    are also passed to an optional txbom.subscriptions.Publisher. The most
+    recent results are kept in the observations and forecasts attributes.
+    """
+
+    def __init__(self, observation_urls=None, forecast_ids=None, workers=None,
+                 publisher=None, forecastInterval=Forecast_Frequency_In_Seconds,
+                 restartDelay=RestartDelayInSeconds, executable=sys.executable):
+        self.observation_urls = set(observation_urls or [])
+        self.forecast_ids = set(forecast_ids or [])
+        self.publisher = publisher
+        self.forecastInterval = forecastInterval
+        self.restartDelay = restartDelay
+        self.executable = executable
+
+        # The names of all workers, whether running or not
+        self.names = ["worker-%i" % i for i in range(workers or multiprocessing.cpu_count())]
+
+        # name -> WorkerConnection for each running worker
+        self.workers = {}
+
+        # name -> (observation urls, forecast ids) last sent to the worker
+        self.assignments = {}
+
+        # name -> pending restart delayed call
+        self.restarts = {}
+
+        # observation url -> most recent Observations object
+        self.observations = {}
+
+        # forecast id -> most recent forecast dict
+        self.forecasts = {}
+
+        self.running = False
+
+    def start(self):
+        """
+        Start the worker processes.
+        """
+        logging.info("Supervisor starting %i workers" % len(self.names))
+        self.running = True
+        for name in self.names:
+            self._spawn(name)
+
+    def stop(self):
+        """
+        Stop the worker processes.
+
+        @return: A deferred that fires once every worker has exited.
+        @rtype: defer.Deferred
+        """
+        logging.info("Supervisor stopping")
+        self.running = False
+
+        for call in self.restarts.values():
+            if call.active():
+                call.cancel()
+        self.restarts = {}
+
+        ended = []
+        for worker in list(self.workers.values()):
+            ended.append(worker.ended)
+            worker.sendMessage(STOP)
+            worker.transport.loseConnection()
+        return defer.DeferredList(ended)
+
+    def add(self, observation_urls=(), forecast_ids=()):
+        """
+        Add observation URLs and forecast identifiers to be retrieved.
+        """
+        self.observation_urls.update(observation_urls)
+        self.forecast_ids.update(forecast_ids)
+        self.rebalance()
+
+    def remove(self, observation_urls=(), forecast_ids=()):
+        """
+        Stop retrieving observation URLs and forecast identifiers.
+        """
+        self.observation_urls.difference_update(observation_urls)
+        self.forecast_ids.difference_update(forecast_ids)
+        self.rebalance()
+
+    def workerFor(self, key):
+        """
+        Return the name of the running worker responsible for an
+        observation URL or forecast identifier, or None if no workers
+        are running.
+        """
+        return rendezvous(key, sorted(self.workers))
+
+    def rebalance(self):
+        """
+        Partition the items over the running workers and send each worker
+        whose share has changed its new assignment.
+        """
+        names = sorted(self.workers)
+        urls = partition(self.observation_urls, names)
+        ids = partition(self.forecast_ids, names)
+        for name in names:
+            assignment = (urls[name], ids[name])
+            if self.assignments.get(name) != assignment:
+                self.assignments[name] = assignment
+                self.workers[name].assign(urls[name], ids[name], self.forecastInterval)
+
+    def _spawn(self, name):
+        self.restarts.pop(name, None)
+        if not self.running:
+            return
+
+        # make the txbom package importable by the worker
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join([p for p in sys.path if p])
+
+        endpoint = ProcessEndpoint(reactor, self.executable,
+                                   [self.executable, "-m", "txbom.service", name],
+                                   env=env, childFDs={0: "w", 1: "r", 2: 2})
+        d = endpoint.connect(WorkerFactory(self, name))
+        d.addCallbacks(self._workerStarted, self._workerFailed,
+                       callbackArgs=(name,), errbackArgs=(name,))
+
+    def _workerStarted(self, worker, name):
+        logging.info("Supervisor started %s" % name)
+        if not self.running:
+            worker.transport.loseConnection()
+            return
+        self.workers[name] = worker
+        self.rebalance()
+
+    def _workerFailed(self, failure, name):
+        logging.error("Supervisor failed to start %s: %s" % (name, failure.getErrorMessage()))
+        self._scheduleRestart(name)
+
+    def _workerEnded(self, name, reason):
+        self.workers.pop(name, None)
+        self.assignments.pop(name, None)
+        if self.running:
+            logging.error("Supervisor worker %s exited: %s" % (name, reason.getErrorMessage()))
+            self.rebalance()
+            self._scheduleRestart(name)
+
+    def _scheduleRestart(self, name):
+        if self.running and name not in self.restarts:
+            self.restarts[name] = reactor.callLater(self.restartDelay, self._spawn, name)
+
+    def _observationsReceived(self, observation_url, observations):
+        if observations is None:
+            return
+        self.observations[observation_url] = observations
+        self.observationsReceived(observation_url, observations)
+        if self.publisher:
+            self.publisher.publish(observations)
+
+    def _forecastReceived(self, forecast_id, forecast):
+        if forecast is None:
+            return
+        self.forecasts[forecast_id] = forecast
+        self.forecastReceived(forecast_id, forecast)
+
+    def observationsReceived(self, observation_url, observations):
+        """
+        Override this method to receive observation updates as they are
+        retrieved by the workers.
+        """
+        pass
+
+    def forecastReceived(self, forecast_id, forecast):
+        """
+        Override this method to receive forecast dicts as they change.
+        """
+        pass
+
+
+class Worker(MessageProtocol):
+    """
+    The worker process end of the pipes to the supervisor. The worker
+    retrieves the items it is assigned and sends the results back.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+        # The WorkerClient of each observation url
+        self.clients = ClientRegistry()
+
+        # forecast id -> LoopingCall retrieving the forecast
+        self.forecastTasks = {}
+
+        # forecast id -> last forecast string sent
+        self.latestForecasts = {}
+
+    def messageReceived(self, kind, *args):
+        if kind == ASSIGN:
+            self.assign(*args)
+        elif kind == STOP:
+            self.transport.loseConnection()
+        else:
+            logging.error("%s received unexpected message: %s" % (self.name, kind))
+
+    def assign(self, observation_urls, forecast_ids, forecastInterval):
+        """
+        Start retrieving newly assigned items and stop retrieving items
+        that are no longer assigned.
+        """
+        logging.info("%s assigned %i observations and %i forecasts" % (
+            self.name, len(observation_urls), len(forecast_ids)))
+
+        for observation_url in set(self.clients).difference(observation_urls):
+            self.clients.remove(observation_url)
+        for observation_url in observation_urls:
+            if observation_url not in self.clients:
+                self.clients.add(WorkerClient(self, observation_url))
+        self.clients.startAll()
+
+        for forecast_id in set(self.forecastTasks).difference(forecast_ids):
+            task = self.forecastTasks.pop(forecast_id)
+            # a task stops itself if a retrieval raised
+            if task.running:
+                task.stop()
+            self.latestForecasts.pop(forecast_id, None)
+        for forecast_id in forecast_ids:
+            if forecast_id not in self.forecastTasks:
+                task = LoopingCall(self._retrieveForecast, forecast_id)
+                self.forecastTasks[forecast_id] = task
+                task.start(forecastInterval, now=True)
+
+    @defer.inlineCallbacks
+    def _retrieveForecast(self, forecast_id):
+        forecast = yield get_forecast(forecast_id)
+        if forecast and forecast_id in self.forecastTasks and \
+           forecast != self.latestForecasts.get(forecast_id):
+            self.latestForecasts[forecast_id] = forecast
+            compact = compactForecast(forecast)
+            if compact is not None:
+                self.sendMessage(FORECAST, forecast_id, compact)
+
+    def connectionLost(self, reason):
+        logging.info("%s stopping" % self.name)
+        self.clients.shutdown()
+        for task in self.forecastTasks.values():
+            if task.running:
+                task.stop()
+        self.forecastTasks = {}
+        if reactor.running:
+            reactor.stop()
+
+
+class WorkerClient(Client):
+    """
+    An observations client that sends its updates to the supervisor.
+    """
+
+    def __init__(self, worker, observation_url):
+        Client.__init__(self, observation_url)
+        self.worker = worker
+
+    def observationsReceived(self, observations):
+        if self.running:
+            self.worker.sendMessage(OBSERVATIONS, self.observation_url,
+                                    packObservations(observations))
+
+
+def workerMain(name):
+    """
+    Run a worker process, communicating with the supervisor over stdin
+    and stdout.
+    """
+    from twisted.internet import stdio
+
+    logging.basicConfig(level=logging.INFO,
+                        format="%%(asctime)s %s %%(levelname)s %%(message)s" % name)
+    stdio.StandardIO(Worker(name))
+    reactor.run()
+
+
+if __name__ == "__main__":
+    workerMain(sys.argv[1] if len(sys.argv) > 1 else "worker")
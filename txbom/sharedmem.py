@@ -0,0 +1,380 @@
+
+"""
+Share the latest observation of each station with other processes on
+the same host through a memory mapped table.
+
+One process, typically the one running the observations Client or a
+txbom.service.Supervisor, opens the table for writing and passes it as
+the publisher so that every update is written to the table. Any number
+of other processes open the same file read only and look up the current
+conditions of a station without making any requests or taking any
+locks.
+
+The table has a fixed layout. A header is followed by capacity slots,
+each holding one station's record as packed binary values. Stations are
+placed in slots by open addressing on their WMO number so readers can
+find a station without an index.
+
+Each slot starts with a sequence number used as a seqlock. The writer
+makes the sequence number odd before changing a record and even again
+once the record is complete. Readers unpack the record directly from the
+mapping and then check that the sequence number is even and unchanged,
+retrying if the record was being written at the time. There must only
+be one writer.
+
+A writer opening the table builds a new file beside the existing one and
+renames it into place, so readers never see a file being truncated. The
+header holds a generation number, which the writer sets to zero in the
+file it replaced. Readers check it on every access and reopen the path
+when their table has been retired.
+
+For example, in the polling process:
+
+table = ObservationTable("/dev/shm/txbom", create=True)
+client = txbom.observations.Client(observation_url, publisher=table)
+
+and in any other process:
+
+table = ObservationTable("/dev/shm/txbom")
+current = table.read(94675)
+print(current[AIR_TEMP])
+
+This module does not depend on Twisted.
+"""
+
+import logging
+import math
+import mmap
+import os
+import struct
+import time
+import zlib
+from txbom.observations import (AIFSTIME_UTC, AIR_TEMP, APPARENT_TEMP,
+                                CLOUD, CLOUD_BASE_M, DELTA_TEMP, DEW_POINT,
+                                GUST_KMH, GUST_KT, HISTORY_PRODUCT, LAT,
+                                LOCAL_DATE_TIME_FULL, LON, NAME, PRESSURE,
+                                PRESSURE_MSL, PRESSURE_QNH, PRESSURE_TEND,
+                                RAIN_TRACE, RELATIVE_HUMIDITY, VISIBILITY_KMH,
+                                WEATHER, WIND_DIRECTION, WIND_SPEED_KMH,
+                                WIND_SPEED_KT, WMO)
+
+
+Magic = b"TXBOMOBS"
+LayoutVersion = 2
+
+# The text fields stored and their maximum encoded length in bytes.
+# Longer values are truncated.
+TextFields = [(NAME, 32),
+              (HISTORY_PRODUCT, 8),
+              (AIFSTIME_UTC, 14),
+              (LOCAL_DATE_TIME_FULL, 14),
+              (WIND_DIRECTION, 4),
+              (PRESSURE_TEND, 8),
+              (CLOUD, 32),
+              (WEATHER, 32)]
+
+# The numeric fields stored as doubles. Missing values are stored as NaN.
+NumericFields = [LAT, LON, AIR_TEMP, APPARENT_TEMP, DEW_POINT, DELTA_TEMP,
+                 RELATIVE_HUMIDITY, PRESSURE, PRESSURE_MSL, PRESSURE_QNH,
+                 WIND_SPEED_KMH, WIND_SPEED_KT, GUST_KMH, GUST_KT,
+                 RAIN_TRACE, CLOUD_BASE_M, VISIBILITY_KMH]
+
+Fields = [f for f, _size in TextFields] + NumericFields
+
+# magic, layout version, layout checksum, capacity, record size,
+# generation
+HeaderStruct = struct.Struct("<8sIIIIQ")
+HeaderSize = 64
+
+# The generation is unique to each table file. A table that has been
+# replaced by a new file has the Retired generation.
+GenerationStruct = struct.Struct("<Q")
+GenerationOffset = HeaderStruct.size - GenerationStruct.size
+Retired = 0
+
+# Each record starts with the sequence number and WMO number. The
+# doubles come first so that they are aligned.
+SequenceStruct = struct.Struct("<I")
+WmoStruct = struct.Struct("<i")
+RecordFormat = "<Ii%id%s" % (len(NumericFields),
+                             "".join(["%is" % size for _f, size in TextFields]))
+RecordStruct = struct.Struct(RecordFormat)
+
+# Records are padded to a multiple of 8 bytes
+RecordSize = (RecordStruct.size + 7) & ~7
+
+# Offset of the WMO number within a record
+WmoOffset = SequenceStruct.size
+
+# Number of attempts made to read a record while it is being written
+# before giving up. The reader yields the CPU between attempts.
+ReadRetries = 1000
+
+
+def _layoutChecksum():
+    layout = "%s|%s|%s" % (RecordFormat, ",".join(Fields), RecordSize)
+    return zlib.crc32(layout.encode("ascii")) & 0xffffffff
+
+
+def _newGeneration():
+    return GenerationStruct.unpack(os.urandom(GenerationStruct.size))[0] or 1
+
+
+def _toFloat(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("nan")
+
+
+def _toBytes(value):
+    if value is None:
+        return b""
+    if not isinstance(value, bytes):
+        value = value.encode("utf-8")
+    return value
+
+
+def _fromBytes(value):
+    value = value.rstrip(b"\0")
+    if not value:
+        return None
+    if not isinstance(value, str):
+        value = value.decode("utf-8", "replace")
+    return value
+
+
+class ObservationTable(object):
+    """
+    A fixed size table of the latest observation of each station, stored
+    in a memory mapped file.
+
+    Open the table with create=True in the single writing process. This
+    creates a new, empty, file that replaces any existing table. Readers
+    open the existing file and the capacity is read from it.
+    """
+
+    def __init__(self, path, capacity=4096, create=False):
+        self.path = path
+        self.writable = create
+
+        # WMO number -> slot index, for stations that have been found
+        self.slots = {}
+
+        if create:
+            self._create(capacity)
+        else:
+            self._open()
+
+    def _create(self, capacity):
+        """
+        Build a new table beside the path, rename it into place and
+        retire the table it replaced.
+        """
+        self.capacity = capacity
+        self.generation = _newGeneration()
+        size = HeaderSize + capacity * RecordSize
+
+        tmpPath = "%s.%i.tmp" % (self.path, os.getpid())
+        with open(tmpPath, "w+b") as f:
+            f.truncate(size)
+            self.map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_WRITE)
+        HeaderStruct.pack_into(self.map, 0, Magic, LayoutVersion, _layoutChecksum(),
+                               capacity, RecordSize, self.generation)
+
+        previous = None
+        try:
+            previous = open(self.path, "r+b")
+        except (IOError, OSError):
+            # there is no table to replace
+            pass
+        try:
+            if os.name == "nt" and os.path.exists(self.path):
+                # rename can't replace an existing file on Windows
+                os.remove(self.path)
+            os.rename(tmpPath, self.path)
+            if previous is not None and \
+               os.fstat(previous.fileno()).st_size >= HeaderSize:
+                previous.seek(GenerationOffset)
+                previous.write(GenerationStruct.pack(Retired))
+        finally:
+            if previous is not None:
+                previous.close()
+
+    def _open(self):
+        with open(self.path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HeaderSize:
+                raise ValueError("%s is not a compatible observations table" % self.path)
+            self.map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        magic, version, checksum, self.capacity, recordSize, self.generation = \
+            HeaderStruct.unpack_from(self.map, 0)
+        if magic != Magic or version != LayoutVersion or \
+           checksum != _layoutChecksum() or recordSize != RecordSize or \
+           size < HeaderSize + self.capacity * RecordSize or self.generation == Retired:
+            self.map.close()
+            raise ValueError("%s is not a compatible observations table" % self.path)
+        self.slots = {}
+
+    def _check(self):
+        """
+        Reopen the path if a writer has replaced the table since it was
+        opened.
+        """
+        if self.writable:
+            return
+        if GenerationStruct.unpack_from(self.map, GenerationOffset)[0] != self.generation:
+            logging.info("Observations table %s was replaced, reopening it" % self.path)
+            self.map.close()
+            self._open()
+
+    def close(self):
+        """
+        Unmap the table. The file is left in place.
+        """
+        self.map.close()
+
+    def __len__(self):
+        return len(self.stations())
+
+    def __contains__(self, wmo):
+        self._check()
+        return self._findSlot(int(wmo)) is not None
+
+    def _offset(self, slot):
+        return HeaderSize + slot * RecordSize
+
+    def _findSlot(self, wmo, claim=False):
+        """
+        Return the slot index holding a station. If the station is not
+        in the table None is returned, unless claim is True in which case
+        an empty slot is assigned to the station.
+        """
+        slot = self.slots.get(wmo)
+        if slot is not None:
+            return slot
+
+        start = wmo % self.capacity
+        for i in range(self.capacity):
+            slot = (start + i) % self.capacity
+            slotWmo = WmoStruct.unpack_from(self.map, self._offset(slot) + WmoOffset)[0]
+            if slotWmo == wmo:
+                self.slots[wmo] = slot
+                return slot
+            if slotWmo == 0:
+                if not claim:
+                    return None
+                WmoStruct.pack_into(self.map, self._offset(slot) + WmoOffset, wmo)
+                self.slots[wmo] = slot
+                return slot
+
+        if claim:
+            raise ValueError("Observations table %s is full" % self.path)
+        return None
+
+    def write(self, observation):
+        """
+        Write an Observation row to the table, replacing the previous
+        record for its station.
+        """
+        if not self.writable:
+            raise IOError("Observations table %s is read only" % self.path)
+
+        wmo = int(getattr(observation, WMO))
+        if wmo <= 0:
+            raise ValueError("Invalid station WMO number: %s" % wmo)
+        offset = self._offset(self._findSlot(wmo, claim=True))
+
+        values = [_toFloat(getattr(observation, f, None)) for f in NumericFields]
+        values.extend([_toBytes(getattr(observation, f, None)) for f, _size in TextFields])
+
+        sequence = SequenceStruct.unpack_from(self.map, offset)[0]
+        SequenceStruct.pack_into(self.map, offset, (sequence + 1) & 0xffffffff)
+        RecordStruct.pack_into(self.map, offset, (sequence + 1) & 0xffffffff, wmo, *values)
+        SequenceStruct.pack_into(self.map, offset, (sequence + 2) & 0xffffffff)
+
+    def publish(self, observations):
+        """
+        Write the current observation of an Observations object to the
+        table. This allows the table to be used as the publisher of an
+        observations Client or a txbom.service.Supervisor.
+        """
+        if observations is None or observations.current is None:
+            return
+        try:
+            self.write(observations.current)
+        except (TypeError, ValueError) as ex:
+            logging.error("Unable to write observation to table %s" % self.path)
+            logging.exception(ex)
+
+    def version(self, wmo):
+        """
+        Return the sequence number of a station's record, which changes
+        every time the record is written, or None if the station is not
+        in the table. Readers can poll this cheaply to detect updates.
+        """
+        self._check()
+        slot = self._findSlot(int(wmo))
+        if slot is None:
+            return None
+        return SequenceStruct.unpack_from(self.map, self._offset(slot))[0]
+
+    def read(self, wmo):
+        """
+        Return the current record of a station as a dict of field name to
+        value, or None if the station has no record. Numeric fields are
+        floats and text fields are strings. Missing values are None.
+        """
+        wmo = int(wmo)
+        self._check()
+        slot = self._findSlot(wmo)
+        if slot is None:
+            return None
+        offset = self._offset(slot)
+
+        for _attempt in range(ReadRetries):
+            values = RecordStruct.unpack_from(self.map, offset)
+            sequence = values[0]
+            if sequence & 1 or SequenceStruct.unpack_from(self.map, offset)[0] != sequence:
+                # the writer is part way through updating the record
+                time.sleep(0)
+                continue
+            if values[1] != wmo:
+                # the cached slot no longer holds the station, find it
+                # again
+                self.slots.pop(wmo, None)
+                slot = self._findSlot(wmo)
+                if slot is None:
+                    return None
+                offset = self._offset(slot)
+                continue
+            if sequence == 0:
+                return None
+
+            record = {WMO: str(wmo)}
+            i = 2
+            for field in NumericFields:
+                value = values[i]
+                record[field] = None if math.isnan(value) else value
+                i += 1
+            for field, _size in TextFields:
+                record[field] = _fromBytes(values[i])
+                i += 1
+            return record
+
+        logging.error("Unable to read a consistent record for station %s" % wmo)
+        return None
+
+    def stations(self):
+        """
+        Return a sorted list of the WMO numbers, as strings, of the
+        stations that have a record in the table.
+        """
+        self._check()
+        stations = []
+        for slot in range(self.capacity):
+            offset = self._offset(slot)
+            wmo = WmoStruct.unpack_from(self.map, offset + WmoOffset)[0]
+            if wmo and SequenceStruct.unpack_from(self.map, offset)[0]:
+                stations.append(wmo)
+        return [str(wmo) for wmo in sorted(stations)]
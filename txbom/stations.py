@@ -0,0 +1,298 @@
+
+"""
+A registry of BOM observation stations with nearest station lookup
+"""
+
+import json
+import logging
+import math
+from txbom.observations import (HISTORY_PRODUCT, LAT, LON, NAME, STATE, WMO)
+from txbom.products import BomObservationUrl, ProductId, isProductId
+
+
+# Mean radius of the earth in kilometers
+EarthRadiusKm = 6371.0
+
+# Kilometers per degree of latitude
+KmPerDegree = math.pi * EarthRadiusKm / 180.0
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """
+    Return the great circle distance, in kilometers, between two points
+    using the haversine formula.
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EarthRadiusKm * math.asin(min(1.0, math.sqrt(a)))
+
+
+class Station(object):
+    """
+    Metadata describing a single observation station.
+    """
+
+    def __init__(self, wmo, name, lat, lon, product, state=None):
+        self.wmo = str(wmo)
+        self.name = name
+        self.lat = float(lat)
+        self.lon = float(lon)
+        # The observations product the station belongs to, e.g. IDS60901
+        self.product = product
+        # The state name reported in the observations header
+        self.state = state
+
+    @property
+    def observation_url(self):
+        """
+        Return the URL of the station's JSON observations
+        """
+        return BomObservationUrl % (self.product, self.product, self.wmo)
+
+    @property
+    def category(self):
+        """
+        Return the product category of the station, which is one of
+        txbom.StateCategories for observation products, or None if the
+        product identifier is not recognised.
+        """
+        if self.product and isProductId(self.product):
+            return ProductId(self.product).state
+        return None
+
+    def toDict(self):
+        return {"wmo": self.wmo,
+                "name": self.name,
+                "lat": self.lat,
+                "lon": self.lon,
+                "product": self.product,
+                "state": self.state}
+
+    def __str__(self):
+        return "%s (%s) %.3f,%.3f %s" % (self.name, self.wmo, self.lat,
+                                         self.lon, self.product)
+
+
+class StationRegistry(object):
+    """
+    An index of observation stations supporting lookup by WMO number and
+    geospatial nearest station and radius queries.
+
+    Stations are placed into a grid of cells, cellSize degrees square,
+    so that a query only needs to examine the cells surrounding the
+    query location rather than every station.
+    """
+
+    def __init__(self, cellSize=1.0):
+        self.cellSize = cellSize
+
+        # wmo -> Station
+        self.stations = {}
+
+        # (row, col) -> list of Station
+        self.grid = {}
+
+        # bounds of the occupied grid cells, used to terminate searches
+        self.rowBounds = None
+        self.colBounds = None
+
+    def __len__(self):
+        return len(self.stations)
+
+    def __contains__(self, wmo):
+        return str(wmo) in self.stations
+
+    def _cell(self, lat, lon):
+        return (int(math.floor(lat / self.cellSize)),
+                int(math.floor(lon / self.cellSize)))
+
+    def add(self, station):
+        """
+        Add a station to the registry, replacing any existing station with
+        the same WMO number.
+        """
+        if station.wmo in self.stations:
+            self.remove(station.wmo)
+
+        self.stations[station.wmo] = station
+
+        row, col = self._cell(station.lat, station.lon)
+        self.grid.setdefault((row, col), []).append(station)
+
+        if self.rowBounds is None:
+            self.rowBounds = (row, row)
+            self.colBounds = (col, col)
+        else:
+            self.rowBounds = (min(self.rowBounds[0], row), max(self.rowBounds[1], row))
+            self.colBounds = (min(self.colBounds[0], col), max(self.colBounds[1], col))
+
+    def remove(self, wmo):
+        """
+        Remove a station from the registry.
+        """
+        station = self.stations.pop(str(wmo), None)
+        if station:
+            cell = self._cell(station.lat, station.lon)
+            self.grid[cell].remove(station)
+            if not self.grid[cell]:
+                del self.grid[cell]
+        return station
+
+    def get(self, wmo):
+        """
+        Return the station with the WMO number or None.
+        """
+        return self.stations.get(str(wmo))
+
+    def addObservations(self, observations):
+        """
+        Register the station described by an Observations object. Station
+        details are taken from the most recent observation and the state
+        from the observations header.
+        """
+        current = observations.current
+        if current is None:
+            logging.error("Can't register a station from empty observations")
+            return None
+
+        try:
+            station = Station(getattr(current, WMO),
+                              getattr(current, NAME),
+                              getattr(current, LAT),
+                              getattr(current, LON),
+                              getattr(current, HISTORY_PRODUCT),
+                              getattr(observations.header, STATE, None))
+        except (AttributeError, TypeError, ValueError) as ex:
+            logging.error("Observations don't contain usable station details")
+            logging.exception(ex)
+            return None
+
+        self.add(station)
+        return station
+
+    def _ring(self, row, col, radius):
+        """
+        Yield the stations in the grid cells that are exactly radius cells
+        away from the cell at row, col.
+        """
+        if radius == 0:
+            cells = [(row, col)]
+        else:
+            cells = []
+            for c in range(col - radius, col + radius + 1):
+                cells.append((row - radius, c))
+                cells.append((row + radius, c))
+            for r in range(row - radius + 1, row + radius):
+                cells.append((r, col - radius))
+                cells.append((r, col + radius))
+
+        for cell in cells:
+            for station in self.grid.get(cell, []):
+                yield station
+
+    def _maxRadius(self, row, col):
+        """
+        Return the ring radius beyond which no stations exist.
+        """
+        return max(abs(row - self.rowBounds[0]), abs(row - self.rowBounds[1]),
+                   abs(col - self.colBounds[0]), abs(col - self.colBounds[1]))
+
+    def _ringClearance(self, lat, radius):
+        """
+        Return a lower bound, in kilometers, on the distance from a point at
+        lat to any station outside of the ring of the given radius.
+        """
+        extent = radius * self.cellSize
+        # longitude degrees shrink towards the poles so use the latitude
+        # closest to a pole that the ring can reach.
+        extremeLat = min(90.0, abs(lat) + extent + self.cellSize)
+        return extent * KmPerDegree * math.cos(math.radians(extremeLat))
+
+    def nearest(self, lat, lon, n=1):
+        """
+        Return the n stations closest to the location.
+
+        @return: A list of (distance in km, Station) tuples sorted by
+                 increasing distance.
+        @rtype: list
+        """
+        if not self.stations:
+            return []
+
+        row, col = self._cell(lat, lon)
+        maxRadius = self._maxRadius(row, col)
+        found = []
+        radius = 0
+        while radius <= maxRadius:
+            for station in self._ring(row, col, radius):
+                found.append((distance(lat, lon, station.lat, station.lon), station))
+
+            if len(found) >= n:
+                found.sort(key=lambda item: item[0])
+                if found[n - 1][0] <= self._ringClearance(lat, radius):
+                    break
+            radius += 1
+
+        found.sort(key=lambda item: item[0])
+        return found[:n]
+
+    def within(self, lat, lon, radiusKm):
+        """
+        Return all stations within radiusKm kilometers of the location.
+
+        @return: A list of (distance in km, Station) tuples sorted by
+                 increasing distance.
+        @rtype: list
+        """
+        if not self.stations:
+            return []
+
+        row, col = self._cell(lat, lon)
+        maxRadius = self._maxRadius(row, col)
+        found = []
+        radius = 0
+        while radius <= maxRadius:
+            for station in self._ring(row, col, radius):
+                d = distance(lat, lon, station.lat, station.lon)
+                if d <= radiusKm:
+                    found.append((d, station))
+
+            if self._ringClearance(lat, radius) > radiusKm:
+                break
+            radius += 1
+
+        found.sort(key=lambda item: item[0])
+        return found
+
+    def byCategory(self, category):
+        """
+        Return all stations in a state category, e.g. txbom.SA
+        """
+        return [s for s in self.stations.values() if s.category == category]
+
+    def save(self, path):
+        """
+        Write the registry to a JSON file.
+        """
+        stations = [self.stations[wmo].toDict() for wmo in sorted(self.stations)]
+        with open(path, "w") as fd:
+            json.dump({"cellSize": self.cellSize, "stations": stations}, fd)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Create a registry from a JSON file written by save.
+        """
+        with open(path) as fd:
+            data = json.load(fd)
+
+        registry = cls(cellSize=data.get("cellSize", 1.0))
+        for item in data["stations"]:
+            registry.add(Station(item["wmo"],
+                                 item["name"] and str(item["name"]),
+                                 item["lat"],
+                                 item["lon"],
+                                 item["product"] and str(item["product"]),
+                                 item["state"] and str(item["state"])))
+        return registry
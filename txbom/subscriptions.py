@@ -0,0 +1,329 @@
+
+"""
+Fan out observation updates to many subscribers
+"""
+
+import logging
+from txbom.observations import AIFSTIME_UTC
+
+
+class ObservationChange(object):
+    """
+    Describes the difference between two successive observation updates
+    for a single station. A change is computed once per update and the
+    same instance is shared by every subscriber of the station, so
+    subscribers must treat it as read only.
+    """
+
+    def __init__(self, station, previous, current, newRows, changedFields):
+        # the station identifier (WMO number) the change applies to
+        self.station = station
+
+        # the most recent Observation before this update, or None if this
+        # is the first update seen for the station.
+        self.previous = previous
+
+        # the most recent Observation after this update
+        self.current = current
+
+        # Observation rows that were not present in the previous update,
+        # most recent first.
+        self.newRows = newRows
+
+        # A dict of field name to (old value, new value) tuples for every
+        # field of the current observation that differs from the previous
+        # current observation.
+        self.changedFields = changedFields
+
+    def __str__(self):
+        o = ["Station %s: %i new rows" % (self.station, len(self.newRows))]
+        for field in sorted(self.changedFields):
+            old, new = self.changedFields[field]
+            o.append("\t%s : %s -> %s" % (field, old, new))
+        return "\n".join(o)
+
+
+class ChangeFilter(object):
+    """
+    Base class for subscription filters. A filter decides whether an
+    ObservationChange is of interest to a subscriber.
+    """
+
+    def matches(self, change):
+        """
+        Return True if the change should be delivered to the subscriber.
+        """
+        raise NotImplementedError
+
+    def delivered(self, change):
+        """
+        Called after a change that matched has been delivered to the
+        subscriber. Filters that compare against the last delivered
+        change override this.
+        """
+        pass
+
+
+class AnyChange(ChangeFilter):
+    """
+    Deliver every change.
+    """
+
+    def matches(self, change):
+        return True
+
+
+class NewRow(ChangeFilter):
+    """
+    Deliver a change only when it contains new observation rows.
+    """
+
+    def matches(self, change):
+        return len(change.newRows) > 0
+
+
+class FieldChanged(ChangeFilter):
+    """
+    Deliver a change when a specific field has changed. If a threshold
+    is specified the field is treated as numeric and the change is only
+    delivered when the absolute difference exceeds the threshold.
+
+    The field is compared with its value in the last change delivered to
+    the subscriber, so a slow drift is reported once it exceeds the
+    threshold in total. That value is kept for each station, so use a
+    separate FieldChanged for each subscription.
+
+    For example, to be notified when the air temperature changes by more
+    than half a degree:
+
+    FieldChanged(txbom.observations.AIR_TEMP, threshold=0.5)
+    """
+
+    def __init__(self, field, threshold=None):
+        self.field = field
+        self.threshold = threshold
+
+        # station -> value of the field in the last change delivered
+        self.lastDelivered = {}
+
+    def matches(self, change):
+        if change.station in self.lastDelivered:
+            old = self.lastDelivered[change.station]
+            new = getattr(change.current, self.field, None)
+            if old == new:
+                return False
+        elif self.field in change.changedFields:
+            old, new = change.changedFields[self.field]
+        else:
+            return False
+
+        if self.threshold is None:
+            return True
+
+        try:
+            return abs(float(new) - float(old)) > self.threshold
+        except (TypeError, ValueError):
+            # A transition to or from a missing value is always a change
+            # worth reporting.
+            return old is None or new is None
+
+    def delivered(self, change):
+        self.lastDelivered[change.station] = getattr(change.current, self.field, None)
+
+
+class AllOf(ChangeFilter):
+    """
+    Deliver a change only when all of the wrapped filters match.
+    """
+
+    def __init__(self, *filters):
+        self.filters = filters
+
+    def matches(self, change):
+        for f in self.filters:
+            if not f.matches(change):
+                return False
+        return True
+
+    def delivered(self, change):
+        for f in self.filters:
+            f.delivered(change)
+
+
+class AnyOf(ChangeFilter):
+    """
+    Deliver a change when any of the wrapped filters match.
+    """
+
+    def __init__(self, *filters):
+        self.filters = filters
+
+    def matches(self, change):
+        for f in self.filters:
+            if f.matches(change):
+                return True
+        return False
+
+    def delivered(self, change):
+        # the change was only delivered for the filters that matched it,
+        # the others keep comparing against their last delivery.
+        for f in self.filters:
+            if f.matches(change):
+                f.delivered(change)
+
+
+class Subscription(object):
+    """
+    A handle to a registered subscriber. Call cancel to stop receiving
+    updates.
+    """
+
+    def __init__(self, publisher, station, callback, changeFilter):
+        self.publisher = publisher
+        self.station = station
+        self.callback = callback
+        self.changeFilter = changeFilter
+
+    def cancel(self):
+        """
+        Remove this subscription from its publisher.
+        """
+        self.publisher.unsubscribe(self)
+
+
+def computeChange(station, previous, observations):
+    """
+    Return an ObservationChange describing how the observations differ
+    from the previous current observation, or None if nothing changed.
+    """
+    current = observations.current
+
+    if previous is None:
+        return ObservationChange(station, None, current, list(observations.data),
+                                 dict((f, (None, getattr(current, f, None))) for f in current.fields))
+
+    previous_time = getattr(previous, AIFSTIME_UTC, None)
+    newRows = []
+    for observation in observations.data:
+        # observations are sorted with the most recent first and the
+        # timestamp format sorts lexically. Rows without a timestamp
+        # can't be placed and end the new rows.
+        timestamp = getattr(observation, AIFSTIME_UTC, None)
+        if timestamp is None or (previous_time is not None and timestamp <= previous_time):
+            break
+        newRows.append(observation)
+
+    changedFields = {}
+    for field in set(previous.fields).union(current.fields):
+        old = getattr(previous, field, None)
+        new = getattr(current, field, None)
+        if old != new:
+            changedFields[field] = (old, new)
+
+    if not newRows and not changedFields:
+        return None
+
+    return ObservationChange(station, previous, current, newRows, changedFields)
+
+
+class Publisher(object):
+    """
+    A Publisher distributes observation updates to any number of
+    subscribers. Subscribers register interest in a station, identified
+    by its WMO number, and may supply a ChangeFilter to limit the changes
+    they receive.
+
+    Each call to publish compares the new observations against the last
+    observations published for the same station. The change is computed
+    once and shared by all subscribers of that station. If nothing has
+    changed since the last poll no subscribers are called.
+
+    A Publisher can be passed to an observations Client so that every
+    retrieved observation update is published automatically.
+    """
+
+    def __init__(self):
+        # station -> list of Subscription
+        self.subscriptions = {}
+
+        # Subscriptions that receive changes for every station
+        self.wildcardSubscriptions = []
+
+        # station -> most recent Observation published
+        self.latest = {}
+
+    def subscribe(self, station, callback, changeFilter=None):
+        """
+        Register a callback to receive ObservationChange objects for a
+        station. If station is None the callback receives changes for
+        all stations.
+
+        @param station: The station WMO number, or None for all stations.
+        @param callback: A callable accepting a single ObservationChange.
+        @param changeFilter: An optional ChangeFilter. By default every
+                             change is delivered.
+
+        @return: A Subscription handle that can be used to unsubscribe.
+        @rtype: Subscription
+        """
+        if changeFilter is None:
+            changeFilter = AnyChange()
+
+        if station is not None:
+            station = str(station)
+
+        subscription = Subscription(self, station, callback, changeFilter)
+        if station is None:
+            self.wildcardSubscriptions.append(subscription)
+        else:
+            self.subscriptions.setdefault(station, []).append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Remove a previously registered subscription.
+        """
+        if subscription.station is None:
+            subscribers = self.wildcardSubscriptions
+        else:
+            subscribers = self.subscriptions.get(subscription.station, [])
+
+        if subscription in subscribers:
+            subscribers.remove(subscription)
+
+        if subscription.station is not None and not subscribers:
+            self.subscriptions.pop(subscription.station, None)
+
+    def publish(self, observations):
+        """
+        Publish an observations update to interested subscribers.
+
+        @param observations: An Observations object.
+
+        @return: The ObservationChange that was dispatched, or None if
+                 the update contained no changes.
+        @rtype: ObservationChange
+        """
+        if observations is None or observations.current is None:
+            return None
+
+        current = observations.current
+        station = getattr(current, 'wmo', None)
+
+        change = computeChange(station, self.latest.get(station), observations)
+        if change is None:
+            return None
+
+        self.latest[station] = current
+
+        subscribers = self.subscriptions.get(station, []) + self.wildcardSubscriptions
+        for subscription in subscribers:
+            try:
+                if subscription.changeFilter.matches(change):
+                    subscription.callback(change)
+                    subscription.changeFilter.delivered(change)
+            except Exception as ex:
+                logging.error("Observation subscriber for station %s failed" % station)
+                logging.exception(ex)
+
+        return change
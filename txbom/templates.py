@@ -0,0 +1,175 @@
+
+"""
+Render forecasts through sets of string.Template templates.
+
+The keys of the dict returned by forecastToDict can be used as
+placeholders in string.Template templates, e.g. "$fcast_town:
+$fcast_today_precis". A ForecastRenderer holds a set of named templates,
+for example a short, long and text to speech version, and renders them
+all from a single parse of each forecast.
+
+Templates are split into literal text and placeholders once, when the
+renderer is created, rather than being scanned on every substitution.
+Rendered text is cached by template and the values of its placeholders,
+so forecasts that have not changed since they were last rendered are not
+rendered again, whether they are given as text or as a dict.
+
+For example:
+
+renderer = ForecastRenderer({"short": "$fcast_town: $fcast_today_precis",
+                             "speech": "Today in $fcast_town, $fcast_today_content"},
+                            speech=["speech"])
+texts = renderer.render(forecast)
+print(texts["short"])
+
+This module does not depend on Twisted.
+"""
+
+import string
+from txbom.cache import LRUCache, contentHash, forecastCache
+from txbom.forecasts import expand_contractions
+
+
+# Limits of the rendered text cache
+DefaultMaxEntries = 1024
+DefaultMaxSize = 4 * 1024 * 1024
+
+
+class CompiledTemplate(object):
+    """
+    A string.Template split into literal text and placeholders.
+    Rendering gives the same result as the template's safe_substitute
+    method: placeholders without a value are left in place.
+    """
+
+    def __init__(self, template):
+        if not isinstance(template, string.Template):
+            template = string.Template(template)
+
+        self.template = template.template
+
+        # A hash of the template text, used in render cache keys
+        self.key = contentHash(self.template)
+
+        # A list of (literal, name, placeholder) tuples. Each literal is
+        # followed by the value of the named placeholder, or by the
+        # placeholder text itself if there is no value. name is None
+        # for the trailing literal.
+        self.parts = []
+
+        literal = []
+        position = 0
+        for match in template.pattern.finditer(self.template):
+            literal.append(self.template[position:match.start()])
+            position = match.end()
+            name = match.group("named") or match.group("braced")
+            if name is not None:
+                self.parts.append(("".join(literal), name, match.group()))
+                literal = []
+            elif match.group("escaped") is not None:
+                literal.append(template.delimiter)
+            else:
+                literal.append(match.group())
+        literal.append(self.template[position:])
+        self.parts.append(("".join(literal), None, None))
+
+        # The names of the placeholders in the template
+        self.names = sorted(set(name for _literal, name, _placeholder in self.parts
+                                if name is not None))
+
+    def valuesKey(self, values):
+        """
+        Return a hash of the values of the template's placeholders, which
+        identifies the text they render.
+        """
+        return contentHash(repr([values.get(name) for name in self.names]))
+
+    def render(self, values):
+        """
+        Return the template rendered using a dict of string values.
+        """
+        output = []
+        for literal, name, placeholder in self.parts:
+            output.append(literal)
+            if name is not None:
+                output.append(values.get(name, placeholder))
+        return "".join(output)
+
+
+class ForecastRenderer(object):
+    """
+    Render a set of named templates for each forecast.
+
+    @param templates: A dict of name to template string or
+                      string.Template.
+    @param speech: The names of templates whose output is intended for
+                   text to speech. Their output is passed through
+                   expand_contractions.
+    @param cache: The txbom.cache.ForecastCache used to parse forecasts.
+                  Defaults to the shared txbom.cache.forecastCache.
+    """
+
+    def __init__(self, templates, speech=None, cache=None,
+                 maxEntries=DefaultMaxEntries, maxSize=DefaultMaxSize):
+        self.templates = dict((name, CompiledTemplate(t)) for name, t in templates.items())
+        self.speech = set(speech or [])
+        self.forecastCache = cache or forecastCache
+
+        # (template key, speech, placeholder values hash) -> rendered text
+        self.cache = LRUCache(maxEntries, maxSize)
+
+    @property
+    def stats(self):
+        return self.cache.stats
+
+    def _render(self, forecastDict, names):
+        if names is None:
+            names = sorted(self.templates)
+
+        results = {}
+        # the values used by the templates, converted to strings once
+        values = {}
+        for name in names:
+            template = self.templates[name]
+            for placeholder in template.names:
+                if placeholder not in values and placeholder in forecastDict:
+                    values[placeholder] = "%s" % (forecastDict[placeholder],)
+            speech = name in self.speech
+            key = (template.key, speech, template.valuesKey(values))
+            text = self.cache.get(key)
+            if text is None:
+                text = template.render(values)
+                if speech:
+                    text = expand_contractions(text)
+                self.cache.put(key, text, len(text))
+            results[name] = text
+        return results
+
+    def render(self, forecast, names=None):
+        """
+        Render templates for a forecast string.
+
+        @param names: The names of the templates to render. Defaults to
+                      all templates.
+
+        @return: A dict of template name to rendered text, or None if the
+                 forecast could not be parsed.
+        @rtype: dict
+        """
+        if not forecast:
+            return None
+        forecastDict = self.forecastCache.forecastToDict(forecast)
+        if forecastDict is None:
+            return None
+        return self._render(forecastDict, names)
+
+    def renderDict(self, forecastDict, names=None):
+        """
+        Render templates for an already parsed forecast dict.
+
+        @return: A dict of template name to rendered text
+        @rtype: dict
+        """
+        if forecastDict is None:
+            return None
+        return self._render(forecastDict, names)
@@ -0,0 +1,6 @@
+
+"""
+Unit tests for txbom. Run them with trial:
+
+trial txbom
+"""
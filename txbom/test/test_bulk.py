@@ -0,0 +1,24 @@
+"""
+Tests for txbom.bulk
+"""
+
+from twisted.trial import unittest
+from txbom.bulk import OffReactorParser
+
+
+class OffReactorParserTests(unittest.TestCase):
+
+    def test_badJsonInline(self):
+        parser = OffReactorParser(inlineThreshold=1024)
+        d = parser.parseObservations('{"observations": ')
+        self.assertEqual(self.successResultOf(d), None)
+
+    def test_badJsonOffloaded(self):
+        """
+        Payloads parsed in the thread pool fail in the same way as those
+        parsed inline.
+        """
+        parser = OffReactorParser(inlineThreshold=0)
+        d = parser.parseObservations('{"observations": ')
+        d.addCallback(self.assertEqual, None)
+        return d
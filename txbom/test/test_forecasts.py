@@ -0,0 +1,32 @@
+"""
+Tests for txbom.forecasts
+"""
+
+from twisted.trial import unittest
+from txbom.forecasts import diffForecasts
+
+
+def forecastDict(fcast_time, today_precis="Fine."):
+    return {"fcast_id": "IDS10034", "fcast_town": "Adelaide", "fcast_state": "SA",
+            "fcast_date": "Friday 4 January 2013", "fcast_time": fcast_time,
+            "fcast_raw": "Issued at %s\n%s" % (fcast_time, today_precis),
+            "fcast_today_precis": today_precis,
+            "fcast_five_days": [("Saturday 5 January", "18", "30", "Sunny.")]}
+
+
+class DiffForecastsTests(unittest.TestCase):
+
+    def test_issueTimeOnly(self):
+        diff = diffForecasts(forecastDict("4:45 am"), forecastDict("10:50 am"))
+        self.assertTrue(diff.issueOnly)
+        self.assertFalse(diff)
+
+    def test_identical(self):
+        diff = diffForecasts(forecastDict("4:45 am"), forecastDict("4:45 am"))
+        self.assertFalse(diff.issueOnly)
+        self.assertFalse(diff)
+
+    def test_changed(self):
+        diff = diffForecasts(forecastDict("4:45 am"), forecastDict("10:50 am", "Showers."))
+        self.assertTrue(diff)
+        self.assertTrue(diff.sectionChanged("today"))
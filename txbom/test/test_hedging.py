@@ -0,0 +1,76 @@
+"""
+Tests for txbom.hedging
+"""
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+from txbom.hedging import DefaultHedgeDelay, Hedger, LatencyTracker
+
+
+class LatencyTrackerTests(unittest.TestCase):
+
+    def test_unmeasuredHostsFirst(self):
+        tracker = LatencyTracker()
+        tracker.record("a", 0.0)
+        tracker.record("b", 1.0)
+        self.assertEqual(tracker.ranked(["a", "b", "c"]), ["c", "a", "b"])
+
+    def test_fastestFirst(self):
+        tracker = LatencyTracker()
+        tracker.record("a", 2.0)
+        tracker.record("b", 1.0)
+        tracker.record("c", 1.0)
+        self.assertEqual(tracker.ranked(["a", "b", "c"]), ["b", "c", "a"])
+
+
+class HedgerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.hedger = Hedger(["primary", "secondary"], clock=self.clock)
+        # host -> deferred of the request to it
+        self.requests = {}
+
+    def request(self, host):
+        d = self.requests[host] = defer.Deferred()
+        return d
+
+    def latencies(self, host):
+        return list(self.hedger.tracker.latencies.get(host, []))
+
+    def test_hedgeWins(self):
+        result = self.hedger.request(self.request)
+        self.clock.advance(DefaultHedgeDelay)
+        self.clock.advance(0.5)
+        self.requests["secondary"].callback("hedge")
+
+        self.assertEqual(self.successResultOf(result), "hedge")
+        self.assertEqual(self.latencies("secondary"), [0.5])
+        self.assertEqual(self.latencies("primary"), [])
+        self.assertEqual(list(self.hedger.tracker.censored["primary"]), [DefaultHedgeDelay + 0.5])
+        self.assertEqual(self.hedger.hedgeWins, 1)
+
+    def test_cancelledHedge(self):
+        """
+        A hedge cancelled because the primary request finished is recorded
+        as a censored latency of the time it had been running.
+        """
+        result = self.hedger.request(self.request)
+        self.clock.advance(DefaultHedgeDelay)
+        self.clock.advance(1.0)
+        self.requests["primary"].callback("primary")
+
+        self.assertEqual(self.successResultOf(result), "primary")
+        self.assertEqual(self.latencies("primary"), [DefaultHedgeDelay + 1.0])
+        self.assertEqual(self.latencies("secondary"), [])
+        self.assertEqual(list(self.hedger.tracker.censored["secondary"]), [1.0])
+
+    def test_callerCancelled(self):
+        result = self.hedger.request(self.request)
+        self.clock.advance(DefaultHedgeDelay + 1.0)
+        result.cancel()
+
+        self.failureResultOf(result, defer.CancelledError)
+        self.assertEqual(self.hedger.tracker.latencies, {})
+        self.assertEqual(self.hedger.tracker.censored, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,37 @@
+"""
+Tests for txbom.mirror
+"""
+
+import os
+from twisted.internet import defer
+from twisted.trial import unittest
+from txbom.mirror import Mirror
+
+
+class FakeSession(object):
+
+    def __init__(self):
+        self.paths = []
+
+    def retrieveFile(self, path, protocol):
+        self.paths.append(path)
+        protocol.dataReceived(b"forecast")
+        return defer.succeed(None)
+
+
+class MirrorTests(unittest.TestCase):
+
+    def transfer(self, remoteDirectory):
+        mirror = Mirror(self.mktemp(), remoteDirectory=remoteDirectory)
+        os.makedirs(mirror.localDirectory)
+        session = FakeSession()
+        self.successResultOf(mirror._transfer(session, {"filename": "IDS10034.txt"}))
+        with open(os.path.join(mirror.localDirectory, "IDS10034.txt"), "rb") as f:
+            self.assertEqual(f.read(), b"forecast")
+        return session.paths
+
+    def test_remoteDirectoryWithoutSlash(self):
+        self.assertEqual(self.transfer("/anon/gen/fwo"), ["/anon/gen/fwo/IDS10034.txt"])
+
+    def test_remoteDirectoryWithSlash(self):
+        self.assertEqual(self.transfer("/anon/gen/fwo/"), ["/anon/gen/fwo/IDS10034.txt"])
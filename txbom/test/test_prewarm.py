@@ -0,0 +1,75 @@
+"""
+Tests for txbom.prewarm and the prewarming of forecast polls by
+txbom.scheduler.
+"""
+
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+from txbom.prewarm import Prewarmer
+from txbom.resolver import CachingResolver
+from txbom.scheduler import ForecastPollFraction, FreshnessScheduler, RequestBudget
+
+
+class PrewarmerResolverTests(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(reactor.installResolver, reactor.resolver)
+
+    def newPrewarmer(self, resolver=None):
+        prewarmer = Prewarmer(resolver)
+        self.addCleanup(prewarmer.close)
+        return prewarmer
+
+    def test_installsResolver(self):
+        prewarmer = self.newPrewarmer()
+        self.assertIsInstance(prewarmer.resolver, CachingResolver)
+        self.assertIdentical(reactor.resolver, prewarmer.resolver)
+
+    def test_usesInstalledResolver(self):
+        resolver = CachingResolver()
+        resolver.install()
+        self.assertIdentical(self.newPrewarmer().resolver, resolver)
+
+
+class FakePrewarmer(object):
+
+    lead = 5
+    sessions = None
+
+    def __init__(self):
+        self.prewarmed = []
+
+    def prewarm(self, item):
+        self.prewarmed.append(item)
+        return defer.succeed(None)
+
+
+class ForecastScheduler(FreshnessScheduler):
+
+    def retrieveForecast(self, forecast_id):
+        return defer.succeed("forecast")
+
+
+class ScheduledPrewarmTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.prewarmer = FakePrewarmer()
+        self.scheduler = ForecastScheduler(RequestBudget(rate=10), clock=self.clock,
+                                           prewarmer=self.prewarmer)
+        self.scheduler.add("IDS10034", slo=600)
+        self.scheduler.start()
+        self.addCleanup(self.scheduler.stop)
+
+    def test_prewarmBeforePoll(self):
+        nextPoll = 600 * ForecastPollFraction
+        self.clock.advance(nextPoll - self.prewarmer.lead - 1)
+        self.assertEqual(self.prewarmer.prewarmed, [])
+        self.clock.advance(1)
+        self.assertEqual(self.prewarmer.prewarmed, ["IDS10034"])
+
+    def test_removeCancelsPrewarm(self):
+        self.scheduler.remove("IDS10034")
+        self.clock.advance(600)
+        self.assertEqual(self.prewarmer.prewarmed, [])
+        self.assertEqual(self.scheduler.prewarmCalls, {})
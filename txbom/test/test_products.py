@@ -0,0 +1,37 @@
+"""
+Tests for txbom.products
+"""
+
+from twisted.trial import unittest
+from txbom.ftp import get_forecast
+from txbom.products import ProductId, catalog, forecastId
+
+
+class CatalogTests(unittest.TestCase):
+
+    def test_defaultExtension(self):
+        self.assertIn("IDS10034", catalog)
+        self.assertIn("IDS10034.txt", catalog)
+        self.assertIn(ProductId("IDS10034.txt"), catalog)
+        self.assertIdentical(catalog.get("IDS10034.txt"), catalog.get("IDS10034"))
+        self.assertEqual(catalog.validate("IDS10034.txt").id, "IDS10034")
+
+    def test_otherExtension(self):
+        self.assertNotIn("IDS10034.xml", catalog)
+        self.assertRaises(ValueError, catalog.validate, "IDS10034.xml")
+
+    def test_invalid(self):
+        self.assertNotIn("IDX", catalog)
+        self.assertEqual(catalog.get(None), None)
+
+
+class ForecastIdTests(unittest.TestCase):
+
+    def test_forecastId(self):
+        self.assertEqual(forecastId("IDS10034"), "IDS10034")
+        self.assertEqual(forecastId("IDS10034.txt"), "IDS10034")
+        self.assertEqual(forecastId("IDR643.gif"), None)
+        self.assertEqual(forecastId("IDS10034.txt.txt"), None)
+
+    def test_getForecastRejectsImages(self):
+        self.assertEqual(self.successResultOf(get_forecast("IDR643.gif")), None)
@@ -0,0 +1,122 @@
+"""
+Tests for txbom.query
+"""
+
+from twisted.trial import unittest
+from txbom.history import HistoryStore, MemoryBudget, epoch
+from txbom.observations import AIR_TEMP, Observation
+from txbom.query import ObservationQuery, COUNT, MAX
+
+
+def observation(wmo, airTemp, minute):
+    return Observation({"wmo": wmo, "air_temp": airTemp,
+                        "aifstime_utc": "2013010405%02i00" % minute})
+
+
+Start = epoch("20130104000000")
+End = epoch("20130105000000")
+
+
+class RemovedRowTests(unittest.TestCase):
+
+    def test_trimmedRowsAreRemovedFromSummaries(self):
+        store = HistoryStore(maxRows=2)
+        query = ObservationQuery(store, [AIR_TEMP])
+        for minute, value in enumerate([40, 10, 11, 12]):
+            store.add(observation(94675, value, minute))
+
+        self.assertEqual(query.summarise(AIR_TEMP, Start, End, MAX), {"94675": 12.0})
+        self.assertEqual(query.summarise(AIR_TEMP, Start, End, COUNT), {"94675": 2})
+
+    def test_trimmedOlderRow(self):
+        """
+        A row older than every row kept is trimmed as soon as it is added.
+        """
+        store = HistoryStore(maxRows=2)
+        query = ObservationQuery(store, [AIR_TEMP])
+        store.add(observation(94675, 10, 10))
+        store.add(observation(94675, 11, 11))
+        store.add(observation(94675, 40, 0))
+
+        self.assertEqual(query.summarise(AIR_TEMP, Start, End, MAX), {"94675": 11.0})
+        self.assertEqual(query.summarise(AIR_TEMP, Start, End, COUNT), {"94675": 2})
+
+    def test_maxAge(self):
+        store = HistoryStore(maxAge=600)
+        query = ObservationQuery(store, [AIR_TEMP])
+        for minute, value in [(0, 40), (20, 10), (25, 11)]:
+            store.add(observation(94675, value, minute))
+
+        self.assertEqual(query.summarise(AIR_TEMP, Start, End, MAX), {"94675": 11.0})
+        self.assertEqual(query.buckets(AIR_TEMP, 3600, Start, End, COUNT),
+                         {"94675": [(epoch("20130104050000"), 2)]})
+
+    def test_discardedByEviction(self):
+        """
+        The summaries of a station evicted without a spill directory are
+        removed, and the memory they used is released.
+        """
+        budget = MemoryBudget(10 ** 6)
+        store = HistoryStore(budget=budget)
+        query = ObservationQuery(store, [AIR_TEMP])
+        store.add(observation(94675, 21.0, 0))
+        store.add(observation(94672, 22.0, 0))
+        self.assertEqual(query.bucketCount, 4)
+
+        store.evict("94675")
+        self.assertEqual(query.summarise(AIR_TEMP, Start, End, MAX), {"94672": 22.0})
+        self.assertEqual(query.bucketCount, 2)
+        self.assertEqual(budget.used, store.size + query.size)
+
+    def test_summariesChargedToBudget(self):
+        budget = MemoryBudget(10 ** 6)
+        store = HistoryStore(budget=budget)
+        query = ObservationQuery(store, [AIR_TEMP])
+        for minute in range(10):
+            store.add(observation(94675, minute, minute))
+        self.assertTrue(query.size > 0)
+        self.assertEqual(budget.used, store.size + query.size)
+
+        query.close()
+        self.assertEqual(budget.used, store.size)
+
+
+class SpilledStationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.budget = MemoryBudget(10 ** 6, spillDirectory=self.mktemp())
+        self.store = HistoryStore(budget=self.budget)
+        self.query = ObservationQuery(self.store, [AIR_TEMP])
+        for station in (94675, 94672, 94866):
+            for minute in range(0, 60, 10):
+                self.store.add(observation(station, station % 100 + minute, minute))
+        self.store.evict("94675")
+        self.store.evict("94672")
+
+    def assertNotLoaded(self):
+        self.assertEqual(sorted(self.store.spilled), ["94672", "94675"])
+        self.assertEqual(list(self.store.stations), ["94866"])
+        self.assertEqual(list(self.budget.recent), [(self.store, "94866")])
+
+    def test_bucketSummaries(self):
+        for i in range(3):
+            self.assertEqual(self.query.summarise(AIR_TEMP, Start, End, MAX),
+                             {"94675": 125.0, "94672": 122.0, "94866": 116.0})
+        self.assertNotLoaded()
+
+    def test_edgeRows(self):
+        """
+        Ranges that don't cover whole buckets read the spilled rows without
+        loading them.
+        """
+        start = epoch("20130104051500")
+        self.assertEqual(self.query.summarise(AIR_TEMP, start, End, COUNT),
+                         {"94675": 4, "94672": 4, "94866": 4})
+        self.assertEqual(self.query.delta(AIR_TEMP, 600, stations=["94675"]), {"94675": 10.0})
+        self.assertNotLoaded()
+
+    def test_newQuery(self):
+        query = ObservationQuery(self.store, [AIR_TEMP])
+        self.assertEqual(query.summarise(AIR_TEMP, Start, End, COUNT),
+                         {"94675": 6, "94672": 6, "94866": 6})
+        self.assertNotLoaded()
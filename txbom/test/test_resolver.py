@@ -0,0 +1,72 @@
+"""
+Tests for txbom.resolver
+"""
+
+from twisted.internet import defer, task
+from twisted.internet.error import DNSLookupError
+from twisted.trial import unittest
+from txbom.resolver import CachingResolver
+
+
+class FakeResolver(object):
+    """
+    A resolver whose lookups are answered by the test.
+    """
+
+    def __init__(self):
+        # (name, deferred) of each lookup
+        self.lookups = []
+
+    def getHostByName(self, name, timeout=None):
+        d = defer.Deferred()
+        self.lookups.append((name, d))
+        return d
+
+
+class CachingResolverTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.fake = FakeResolver()
+        self.resolver = CachingResolver(self.fake, ttl=60, negativeTTL=10, clock=self.clock)
+
+    def test_concurrentLookupsShared(self):
+        first = self.resolver.getHostByName("ftp.bom.gov.au")
+        second = self.resolver.getHostByName("ftp.bom.gov.au")
+        self.assertEqual(len(self.fake.lookups), 1)
+        self.fake.lookups[0][1].callback("1.2.3.4")
+        self.assertEqual(self.successResultOf(first), "1.2.3.4")
+        self.assertEqual(self.successResultOf(second), "1.2.3.4")
+
+    def test_ttl(self):
+        self.resolver.getHostByName("ftp.bom.gov.au")
+        self.fake.lookups[0][1].callback("1.2.3.4")
+
+        self.clock.advance(59)
+        d = self.resolver.getHostByName("ftp.bom.gov.au")
+        self.assertEqual(self.successResultOf(d), "1.2.3.4")
+        self.assertEqual(len(self.fake.lookups), 1)
+
+        self.clock.advance(1)
+        self.resolver.getHostByName("ftp.bom.gov.au")
+        self.assertEqual(len(self.fake.lookups), 2)
+
+    def test_negativeTTL(self):
+        d = self.resolver.getHostByName("missing.example.com")
+        self.fake.lookups[0][1].errback(DNSLookupError("missing.example.com"))
+        self.failureResultOf(d, DNSLookupError)
+
+        d = self.resolver.getHostByName("missing.example.com")
+        self.failureResultOf(d, DNSLookupError)
+        self.assertEqual(len(self.fake.lookups), 1)
+
+        self.clock.advance(10)
+        self.resolver.getHostByName("missing.example.com")
+        self.assertEqual(len(self.fake.lookups), 2)
+
+    def test_prefetchRefreshesExpiringEntry(self):
+        self.resolver.getHostByName("ftp.bom.gov.au")
+        self.fake.lookups[0][1].callback("1.2.3.4")
+        self.clock.advance(55)
+        self.resolver.prefetch("ftp.bom.gov.au", lead=10)
+        self.assertEqual(len(self.fake.lookups), 2)
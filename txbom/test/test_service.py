@@ -0,0 +1,22 @@
+"""
+Tests for txbom.service
+"""
+
+from twisted.internet.task import LoopingCall
+from twisted.trial import unittest
+from txbom.service import Worker
+
+
+class WorkerTests(unittest.TestCase):
+
+    def test_unassignStoppedForecastTask(self):
+        """
+        A forecast task that has already stopped, e.g. because a retrieval
+        raised, can be unassigned.
+        """
+        worker = Worker("worker-0")
+        worker.forecastTasks["IDS10034"] = LoopingCall(lambda: None)
+        worker.latestForecasts["IDS10034"] = "forecast"
+        worker.assign([], [], 60)
+        self.assertEqual(worker.forecastTasks, {})
+        self.assertEqual(worker.latestForecasts, {})
@@ -0,0 +1,98 @@
+
+"""
+Tests for txbom.sharedmem
+"""
+
+import os
+from twisted.trial import unittest
+from txbom.observations import AIR_TEMP, NAME, Observation
+from txbom.sharedmem import ObservationTable, Retired, GenerationOffset, GenerationStruct
+
+
+def observation(wmo, airTemp, name="Station"):
+    return Observation({"wmo": wmo, "name": name, "air_temp": airTemp,
+                        "aifstime_utc": "20130104050000"})
+
+
+class ObservationTableTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.writer = ObservationTable(self.path, capacity=16, create=True)
+        self.addCleanup(self.writer.close)
+
+    def openReader(self):
+        reader = ObservationTable(self.path)
+        self.addCleanup(reader.close)
+        return reader
+
+    def test_readWrite(self):
+        self.writer.write(observation(94675, 21.5, "Adelaide"))
+        reader = self.openReader()
+        record = reader.read(94675)
+        self.assertEqual(record[AIR_TEMP], 21.5)
+        self.assertEqual(record[NAME], "Adelaide")
+        self.assertEqual(reader.read(94672), None)
+        self.assertEqual(reader.stations(), ["94675"])
+
+    def test_versionChangesOnWrite(self):
+        self.writer.write(observation(94675, 21.5))
+        reader = self.openReader()
+        before = reader.version(94675)
+        self.writer.write(observation(94675, 22.0))
+        self.assertNotEqual(reader.version(94675), before)
+        self.assertEqual(reader.read(94675)[AIR_TEMP], 22.0)
+
+    def test_collidingStations(self):
+        # both stations hash to the same slot
+        self.writer.write(observation(16, 1.0))
+        self.writer.write(observation(32, 2.0))
+        reader = self.openReader()
+        self.assertEqual(reader.read(16)[AIR_TEMP], 1.0)
+        self.assertEqual(reader.read(32)[AIR_TEMP], 2.0)
+
+    def test_staleSlotIsResolvedAgain(self):
+        """
+        A cached slot that holds another station isn't used to build the
+        record.
+        """
+        self.writer.write(observation(16, 1.0))
+        self.writer.write(observation(32, 2.0))
+        reader = self.openReader()
+        reader.slots[32] = reader._findSlot(16)
+        record = reader.read(32)
+        self.assertEqual(record["wmo"], "32")
+        self.assertEqual(record[AIR_TEMP], 2.0)
+
+    def test_recreateReplacesFile(self):
+        """
+        A writer reopening the table builds a new file and retires the
+        old one, which readers notice and reopen.
+        """
+        self.writer.write(observation(94675, 21.5))
+        reader = self.openReader()
+        self.assertEqual(reader.read(94675)[AIR_TEMP], 21.5)
+        oldInode = os.stat(self.path).st_ino
+
+        writer = ObservationTable(self.path, capacity=16, create=True)
+        self.addCleanup(writer.close)
+        writer.write(observation(94672, 30.0))
+
+        self.assertNotEqual(os.stat(self.path).st_ino, oldInode)
+        self.assertEqual(GenerationStruct.unpack_from(self.writer.map, GenerationOffset)[0], Retired)
+        self.assertEqual(reader.read(94675), None)
+        self.assertEqual(reader.read(94672)[AIR_TEMP], 30.0)
+        self.assertFalse(os.path.exists("%s.%i.tmp" % (self.path, os.getpid())))
+
+    def test_full(self):
+        writer = ObservationTable(self.mktemp(), capacity=2, create=True)
+        self.addCleanup(writer.close)
+        writer.write(observation(1, 1.0))
+        writer.write(observation(2, 2.0))
+        self.assertRaises(ValueError, writer.write, observation(3, 3.0))
+
+    def test_incompatibleFile(self):
+        path = self.mktemp()
+        with open(path, "wb") as f:
+            f.write(b"\0" * 128)
+        self.assertRaises(ValueError, ObservationTable, path)
@@ -0,0 +1,49 @@
+"""
+Tests for txbom.subscriptions
+"""
+
+from twisted.trial import unittest
+from txbom.observations import AIR_TEMP, PRESSURE, Observation
+from txbom.subscriptions import AnyOf, FieldChanged, ObservationChange
+
+
+def change(previous, airTemp, pressure):
+    current = Observation({"wmo": 94675, "air_temp": airTemp, "press": pressure})
+    changedFields = {}
+    for field, value in ((AIR_TEMP, airTemp), (PRESSURE, pressure)):
+        old = getattr(previous, field, None)
+        if old != value:
+            changedFields[field] = (old, value)
+    return ObservationChange("94675", previous, current, [], changedFields)
+
+
+class AnyOfTests(unittest.TestCase):
+
+    def deliver(self, changeFilter, change):
+        matched = changeFilter.matches(change)
+        if matched:
+            changeFilter.delivered(change)
+        return matched
+
+    def test_unmatchedFilterKeepsBaseline(self):
+        """
+        A change delivered for one filter doesn't reset the drift baseline
+        of a filter that didn't match.
+        """
+        changeFilter = AnyOf(FieldChanged(AIR_TEMP, threshold=1.0),
+                             FieldChanged(PRESSURE, threshold=5.0))
+        first = change(None, 20.0, 1000.0)
+        self.assertTrue(self.deliver(changeFilter, first))
+
+        second = change(first.current, 22.0, 1003.0)
+        self.assertTrue(self.deliver(changeFilter, second))
+
+        # the pressure has drifted 6 since it was last delivered
+        third = change(second.current, 22.0, 1006.0)
+        self.assertTrue(self.deliver(changeFilter, third))
+
+    def test_belowThreshold(self):
+        changeFilter = AnyOf(FieldChanged(AIR_TEMP, threshold=1.0))
+        first = change(None, 20.0, 1000.0)
+        self.deliver(changeFilter, first)
+        self.assertFalse(self.deliver(changeFilter, change(first.current, 20.5, 1000.0)))
@@ -0,0 +1,38 @@
+"""
+Tests for txbom.templates
+"""
+
+from twisted.trial import unittest
+from txbom.templates import ForecastRenderer
+
+
+class FakeForecastCache(object):
+
+    def __init__(self, forecastDict):
+        self.forecastDict = forecastDict
+
+    def forecastToDict(self, forecast):
+        return self.forecastDict
+
+
+class ForecastRendererTests(unittest.TestCase):
+
+    def setUp(self):
+        self.forecastDict = {"fcast_raw": "Adelaide forecast", "fcast_town": "Adelaide",
+                             "fcast_today_precis": "Sunny."}
+        self.renderer = ForecastRenderer({"short": "$fcast_town: $fcast_today_precis $missing"},
+                                         cache=FakeForecastCache(self.forecastDict))
+
+    def test_render(self):
+        self.assertEqual(self.renderer.render("Adelaide forecast"),
+                         {"short": "Adelaide: Sunny. $missing"})
+
+    def test_textAndDictShareCache(self):
+        self.renderer.render("Adelaide forecast")
+        self.renderer.renderDict(dict(self.forecastDict))
+        self.assertEqual((self.renderer.stats.hits, self.renderer.stats.misses), (1, 1))
+
+    def test_changedFieldWithSameRawText(self):
+        self.renderer.renderDict(self.forecastDict)
+        changed = dict(self.forecastDict, fcast_today_precis="Showers.")
+        self.assertEqual(self.renderer.renderDict(changed), {"short": "Adelaide: Showers. $missing"})
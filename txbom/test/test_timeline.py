@@ -0,0 +1,42 @@
+"""
+Tests for txbom.timeline
+"""
+
+from twisted.trial import unittest
+from txbom.history import HistoryStore, MemoryBudget, epoch
+from txbom.observations import AIR_TEMP, Observation
+from txbom.timeline import LINEAR, align
+
+
+def observation(wmo, airTemp, minute):
+    return Observation({"wmo": wmo, "air_temp": airTemp,
+                        "aifstime_utc": "2013010405%02i00" % minute})
+
+
+class AlignTests(unittest.TestCase):
+
+    def setUp(self):
+        self.budget = MemoryBudget(10 ** 6, spillDirectory=self.mktemp())
+        self.store = HistoryStore(budget=self.budget)
+        for station in (94675, 94672):
+            for minute in (0, 30):
+                self.store.add(observation(station, station % 100 + minute, minute))
+        self.start = epoch("20130104050000")
+
+    def test_historyStore(self):
+        times, values = align(self.store, [AIR_TEMP], self.start, self.start + 1800, 900,
+                              method=LINEAR)
+        self.assertEqual(times, [self.start, self.start + 900])
+        self.assertEqual(values, {"94675": {AIR_TEMP: [75.0, 90.0]},
+                                  "94672": {AIR_TEMP: [72.0, 87.0]}})
+
+    def test_spilledStations(self):
+        """
+        Stations evicted to disk are aligned without loading them.
+        """
+        self.store.evict("94675")
+        times, values = align(self.store, [AIR_TEMP], self.start, self.start + 1800, 900,
+                              method=LINEAR)
+        self.assertEqual(values["94675"], {AIR_TEMP: [75.0, 90.0]})
+        self.assertEqual(list(self.store.spilled), ["94675"])
+        self.assertEqual(list(self.store.stations), ["94672"])
@@ -0,0 +1,163 @@
+
+"""
+Index observations by time and align many stations onto a common time
+grid.
+
+A StationHistory (see txbom.history) is a timeline of one station's
+observation rows, with each aifstime_utc timestamp converted to seconds
+since the epoch once, when the row is added. Rows can then be looked up
+by time with at and nearest, and ranges sliced with between, using a
+binary search rather than a scan of the rows.
+
+align resamples fields of many stations onto the same grid
+of times in one call, so stations that report at different times can be
+compared directly. For example, the air temperature of every station
+every 10 minutes over the last day:
+
+store = HistoryStore()
+...
+times, values = align(store, ["air_temp"], now - 86400, now, 600, method=LINEAR)
+values["94675"]["air_temp"]  # one value, or None, for each time
+
+Passing the store, rather than store.stations, includes the stations
+whose history has been evicted to disk by a MemoryBudget.
+
+This module does not depend on Twisted.
+"""
+
+from txbom.history import HistoryStore, StationHistory
+from txbom.observations import WMO
+
+
+# Alignment methods
+NEAREST = "nearest"
+LINEAR = "linear"
+
+Methods = [NEAREST, LINEAR]
+
+
+def timeline(observations):
+    """
+    Return a StationHistory of the rows of an Observations object.
+    """
+    station = getattr(observations.current, WMO, None) if observations.current else None
+    history = StationHistory(station)
+    # rows are most recent first, add them oldest first
+    for observation in reversed(observations.data):
+        history.add(observation)
+    return history
+
+
+def grid(start, end, step):
+    """
+    Return the times from start, every step seconds, before end.
+    """
+    return list(range(int(start), int(end), int(step)))
+
+
+def _series(history, field, numeric):
+    """
+    Return the times and values of the rows of a history that have a
+    value for a field.
+    """
+    times = []
+    values = []
+    for timestamp, observation in zip(history.times, history.rows):
+        value = getattr(observation, field, None)
+        if value is None:
+            continue
+        if numeric:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+        times.append(timestamp)
+        values.append(value)
+    return times, values
+
+
+def _alignNearest(times, values, points, tolerance):
+    result = []
+    count = len(times)
+    i = 0
+    for point in points:
+        while i < count and times[i] < point:
+            i += 1
+        # the closest row is at i or i - 1, preferring the earlier row
+        if i == count or (i > 0 and point - times[i - 1] <= times[i] - point):
+            j = i - 1
+        else:
+            j = i
+        if j < 0:
+            result.append(None)
+        elif tolerance is None:
+            # don't extend beyond the first and last rows
+            inside = count and times[0] <= point <= times[-1]
+            result.append(values[j] if inside else None)
+        elif abs(times[j] - point) <= tolerance:
+            result.append(values[j])
+        else:
+            result.append(None)
+    return result
+
+
+def _alignLinear(times, values, points, tolerance):
+    result = []
+    count = len(times)
+    i = 0
+    for point in points:
+        while i < count and times[i] < point:
+            i += 1
+        if i < count and times[i] == point:
+            result.append(values[i])
+        elif 0 < i < count and (tolerance is None or times[i] - times[i - 1] <= tolerance):
+            fraction = float(point - times[i - 1]) / (times[i] - times[i - 1])
+            result.append(values[i - 1] + (values[i] - values[i - 1]) * fraction)
+        else:
+            result.append(None)
+    return result
+
+
+def align(histories, fields, start, end, step, method=NEAREST, tolerance=None):
+    """
+    Resample fields of many stations onto a common grid of times.
+
+    @param histories: A HistoryStore, a dict of station to StationHistory
+                      or a list of StationHistory. The spilled stations of
+                      a HistoryStore are read without loading them back
+                      into memory.
+    @param method: NEAREST uses the value of the closest row. LINEAR
+                   interpolates between the rows either side of each
+                   time and only applies to numeric values.
+    @param tolerance: For NEAREST, the furthest a row may be from a grid
+                      time. For LINEAR, the largest gap between the rows
+                      either side. By default any row is used, but times
+                      before the first or after the last row have no
+                      value.
+
+    @return: A tuple of the list of grid times and a dict of station to
+             a dict of field to a list of values, one for each grid time
+             and None where there is no value.
+    @rtype: tuple
+    """
+    if method not in Methods:
+        raise ValueError("Unknown alignment method: %s" % method)
+
+    if isinstance(histories, HistoryStore):
+        store = histories
+        # read one spilled history at a time
+        histories = (store.peek(station) for station in store.stationNames())
+    elif isinstance(histories, dict):
+        histories = histories.values()
+
+    points = grid(start, end, step)
+    alignSeries = _alignLinear if method == LINEAR else _alignNearest
+
+    result = {}
+    for history in histories:
+        stationValues = {}
+        for field in fields:
+            times, values = _series(history, field, method == LINEAR)
+            stationValues[field] = alignSeries(times, values, points, tolerance)
+        result[history.station] = stationValues
+    return points, result
@@ -0,0 +1,470 @@
+
+"""
+HTTP transport and polling client for retrieving observations from the
+BOM.
+
+Importing this module loads Twisted. The observation data classes in
+txbom.observations don't require it.
+"""
+
+import datetime
+import logging
+import json
+import sys
+import zlib
+from twisted.internet import reactor, defer
+from twisted.internet.protocol import Protocol
+from twisted.internet.task import LoopingCall
+from twisted.web import error
+from twisted.web.client import Agent, BrowserLikeRedirectAgent, ResponseDone
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+from txbom.observations import (AIFSTIME_UTC, Observations, TransferStats,
+                                UserAgent, transferStats)
+from txbom.products import isValidObservationUrl
+
+
+class DecodingBodyProtocol(Protocol):
+    """
+    Collect a response body, decompressing it incrementally as each chunk
+    arrives if the server used a gzip or deflate content encoding.
+
+    @param connections: An optional set that the transport is added to
+                        while the body is arriving.
+    """
+
+    def __init__(self, finished, encoding, stats, connections=None):
+        self.finished = finished
+        self.encoding = encoding
+        self.stats = stats
+        self.connections = connections
+        self.chunks = []
+        self.received = 0
+        self.decoded = 0
+
+        if encoding == "gzip":
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            self.decoder = zlib.decompressobj(zlib.MAX_WBITS)
+        else:
+            self.decoder = None
+
+    def _decode(self, data):
+        try:
+            return self.decoder.decompress(data)
+        except zlib.error:
+            if self.encoding == "deflate" and self.received == len(data):
+                # Some servers send raw deflate data without the zlib
+                # header. Switch decoders on the first chunk only.
+                self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                return self.decoder.decompress(data)
+            raise
+
+    def connectionMade(self):
+        if self.connections is not None:
+            self.connections.add(self.transport)
+
+    def dataReceived(self, data):
+        self.received += len(data)
+        if self.decoder:
+            try:
+                data = self._decode(data)
+            except zlib.error as ex:
+                self.decoder = None
+                self.transport.stopProducing()
+                self.finished.errback(ex)
+                return
+        self.decoded += len(data)
+        self.chunks.append(data)
+
+    def connectionLost(self, reason):
+        if self.connections is not None:
+            self.connections.discard(self.transport)
+
+        if self.finished.called:
+            return
+
+        if not reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.errback(reason)
+            return
+
+        if self.decoder:
+            data = self.decoder.flush()
+            self.decoded += len(data)
+            self.chunks.append(data)
+
+        for stats in self.stats:
+            stats.record(self.encoding, self.received, self.decoded)
+        self.finished.callback(b"".join(self.chunks))
+
+
+def fetch(url, compressed=True, stats=None, agent=None, connections=None):
+    """
+    Retrieve the resource at url. When compressed is True the server is
+    asked to use a gzip or deflate content encoding which is decoded as
+    the response arrives.
+
+    @param stats: An optional TransferStats updated, along with the module
+                  level transferStats, once the transfer completes.
+    @param agent: An optional twisted.web.client.Agent used to make the
+                  request.
+    @param connections: An optional set holding the transport of the
+                        response while its body is arriving.
+
+    @return: A deferred that returns the response body
+    @rtype: defer.Deferred
+    """
+    if agent is None:
+        agent = Agent(reactor)
+    # follow redirects from the BOM site, as getPage did
+    agent = BrowserLikeRedirectAgent(agent)
+
+    headers = Headers({b"User-Agent": [UserAgent]})
+    if compressed:
+        headers.addRawHeader(b"Accept-Encoding", b"gzip, deflate")
+
+    d = agent.request(b"GET", url.encode("ascii"), headers)
+
+    def responseReceived(response):
+        if response.code != 200:
+            response.deliverBody(Protocol())
+            raise error.Error(response.code, response.phrase)
+
+        encoding = None
+        encodings = response.headers.getRawHeaders(b"Content-Encoding")
+        if encodings:
+            encoding = encodings[-1].decode("ascii").strip().lower()
+            if encoding == "identity":
+                encoding = None
+            elif encoding not in ("gzip", "deflate"):
+                raise error.Error(response.code, ("Unsupported content encoding: %s" % encoding).encode("ascii"))
+
+        # cancelling the request while the body is arriving closes the
+        # connection
+        finished = defer.Deferred(lambda _d: bodyProtocol.transport.stopProducing())
+        allStats = [transferStats]
+        if stats is not None:
+            allStats.append(stats)
+        bodyProtocol = DecodingBodyProtocol(finished, encoding, allStats, connections)
+        response.deliverBody(bodyProtocol)
+        return finished
+
+    d.addCallback(responseReceived)
+    return d
+
+
+class Client(object):
+    """
+    The observations client allows a user to obtain BoM observations for a
+    specified URL. The client can operate in two modes.
+
+    The first mode simply retrieves the BoM observations whenever the
+    Client's get_observations method is called.
+
+    The second mode will keep the client's observations attribute
+    up to date by running a periodic task that retrieves the latest observation.
+    The update routine used in this mode is optimized to make the fewest
+    update requests as possible to maintain current data. It inspects the first
+    response and determines the appropriate time to begin the periodic
+    observations retrieval such that the minimum number of requests are
+    made to keep the observations up to date.
+    """
+
+    # Perform an observation retrieval every 30 minutes. This is how often
+    # the data is refreshed on the BoM website. There is no point requesting
+    # updates any faster.
+    Update_Frequency_In_Seconds = 30 * 60
+
+    def __init__(self, observation_url=None, publisher=None, parser=None,
+                 compressed=True, clock=None, prewarmer=None):
+        self.observation_url = observation_url
+
+        # The IReactorTime provider used to schedule retrievals. Tests and
+        # txbom.replay pass a twisted.internet.task.Clock.
+        self.clock = clock or reactor
+
+        # Request compressed transfers of the observations JSON
+        self.compressed = compressed
+
+        # Byte counters for this client's downloads
+        self.transferStats = TransferStats()
+
+        # An optional txbom.subscriptions.Publisher that is passed every
+        # observation update so that it can be fanned out to subscribers.
+        self.publisher = publisher
+
+        # An optional txbom.bulk.OffReactorParser used to parse large
+        # responses away from the reactor thread.
+        self.parser = parser
+
+        # The most recent observation response object
+        self.observations = None
+
+        # A reference to the task that periodically requests an
+        # observation update. This is needed so the task can be
+        # stopped later.
+        self.periodicRetrievalTask = None
+
+        # An optional txbom.prewarm.Prewarmer that resolves the host and
+        # opens a connection shortly before each scheduled retrieval.
+        # Requests are then made through its connection pool.
+        self.prewarmer = prewarmer
+        self.prewarmCall = None
+
+        # True between start and stop
+        self.running = False
+
+        # Delayed calls that haven't run yet, requests in progress and the
+        # connections receiving their responses. stop cancels them all.
+        self.calls = set()
+        self.requests = set()
+        self.connections = set()
+
+    def start(self):
+        """
+        Start monitoring sensors in and around the home environment
+        """
+        if self.observation_url is None:
+            logging.error("Can't start periodic observations retrieval as no URL is set")
+            return
+        if self.running:
+            return
+
+        logging.info('BoM Observation Client starting')
+        self.running = True
+        # Obtain the first observation right now. Inspect the update timestamp
+        # attribute so we can determine the time until the next update which
+        # will determine the time at which the periodic update task will begin.
+        #
+        self.retrieveFirstObservations()
+
+    def stop(self):
+        """
+        Stop monitoring sensors in and around the home environment
+        """
+        logging.info('BoM Observation Client stopping')
+        self.running = False
+
+        if self.periodicRetrievalTask is not None and self.periodicRetrievalTask.running:
+            self.periodicRetrievalTask.stop()
+        self.periodicRetrievalTask = None
+
+        for call in list(self.calls):
+            if call.active():
+                call.cancel()
+        self.calls.clear()
+        self.prewarmCall = None
+
+        requests, self.requests = self.requests, set()
+        for d in requests:
+            d.cancel()
+        for transport in list(self.connections):
+            transport.stopProducing()
+        self.connections.clear()
+
+    @property
+    def scheduledCalls(self):
+        """
+        Return the number of pending delayed calls, counting a running
+        periodic retrieval task as one.
+        """
+        count = len([call for call in self.calls if call.active()])
+        if self.periodicRetrievalTask is not None and self.periodicRetrievalTask.running:
+            count += 1
+        return count
+
+    def callLater(self, delay, f, *args, **kwargs):
+        """
+        Schedule a call on the client's clock that is cancelled if the
+        client is stopped before it runs.
+
+        @rtype: IDelayedCall
+        """
+        def run():
+            self.calls.discard(call)
+            return f(*args, **kwargs)
+
+        call = self.clock.callLater(delay, run)
+        self.calls.add(call)
+        return call
+
+    @defer.inlineCallbacks
+    def retrieveFirstObservations(self):
+        """
+        Retrieve the first BOM observations and inspect it for the most recent
+        update time. Using that information determine the time until the next
+        observation update and schedule the BOM retrieval task to begin running
+        periodically at the calculated delay interval.
+        """
+        try:
+            observations = yield self.get_observations(self.observation_url)
+            if not self.running:
+                # stopped while the retrieval was in progress
+                defer.returnValue(False)
+            self.observations = observations
+
+            self.observationsReceived(observations)
+            self.publishObservations(observations)
+
+            if observations.current.aifstime_utc:
+                # imported here as txbom.history imports txbom.observations
+                from txbom.history import epoch
+                refresh_utc = epoch(observations.current.aifstime_utc)
+                if refresh_utc is None:
+                    raise ValueError("Invalid %s: %s" % (AIFSTIME_UTC, observations.current.aifstime_utc))
+                # While the update timestamp within the data indicates an update interval
+                # of 30 minutes, the updates of the half hourly data at the BoM web site
+                # seem to occur at 5 minutes past the data timestamp so the real time to
+                # the next update is 30 minutes (for the data) + 5 minutes (for the web
+                # server to receive the data update). Then I'll add 2 minutes of buffer
+                # time to ensure that the next query will see new data.
+                # Therefore the total time from the last data timestamp to the next query
+                # will be 30 + 5 + 2 = 37 minutes. From that initial offset time the
+                # periodic task runs at intervals of Update_Frequency_In_Seconds seconds.
+                next_refresh_time = refresh_utc + 37 * 60
+                time_until_next_refresh = next_refresh_time - self.clock.seconds()
+                logging.info("Scheduling the periodic observation retrieval task to begin after delay of: %s" % datetime.timedelta(seconds=time_until_next_refresh))
+                # The delay is negative when the station's latest data is
+                # already overdue, in which case start polling now.
+                delay_in_seconds = max(0, time_until_next_refresh)
+                self.callLater(delay_in_seconds, self.startPeriodicRetrievalTask)
+                self.schedulePrewarm(delay_in_seconds)
+            else:
+                logging.error("Could not extract most recent BOM refresh time from %s field" % AIFSTIME_UTC)
+
+        except Exception as ex:
+            logging.error("First BoM observation retrieval failed")
+            logging.exception(ex)
+            # schedule another attempt in 10 seconds.
+            logging.info("Scheduling another attempt to retrieve first BoM observation")
+            self.callLater(10, self.retrieveFirstObservations)
+
+        defer.returnValue(True)
+
+    def startPeriodicRetrievalTask(self):
+        """
+        Begin the looping call that will retrieve the latest BoM observation
+        """
+        self.periodicRetrievalTask = LoopingCall(self._retrieveObservations)
+        self.periodicRetrievalTask.clock = self.clock
+        self.periodicRetrievalTask.start(Client.Update_Frequency_In_Seconds, now=True)
+        logging.info("Starting periodic BoM observation retrieval task")
+
+    @defer.inlineCallbacks
+    def _retrieveObservations(self):
+        """
+        Retrieve the latest BoM observation and store it
+        """
+        observations = yield self.get_observations(self.observation_url)
+        if observations:
+            logging.info("BoM observations retrieved successfully")
+            self.observations = observations
+
+            # pass observations off the user provided handler
+            self.observationsReceived(observations)
+            self.publishObservations(observations)
+
+        self.schedulePrewarm(Client.Update_Frequency_In_Seconds)
+        defer.returnValue(None)
+
+    def schedulePrewarm(self, delay):
+        """
+        Prepare the connection for a retrieval scheduled in delay seconds.
+        """
+        if self.prewarmer is None or not self.running or delay <= self.prewarmer.lead:
+            return
+        if self.prewarmCall is not None and self.prewarmCall.active():
+            self.prewarmCall.cancel()
+            self.calls.discard(self.prewarmCall)
+        self.prewarmCall = self.callLater(delay - self.prewarmer.lead,
+                                          self.prewarmer.prewarm, self.observation_url)
+
+    @defer.inlineCallbacks
+    def get_observations(self, observation_url):
+        """
+        Retrieve the latest observations from the BOM in JSON format.
+
+        Returns a deferred that will eventually return an Observation
+        object with attributes populated from parsing the JSON update.
+
+        @return: A deferred that returns an Observations object
+        @rtype: defer.Deferred
+        """
+        if not isValidObservationUrl(observation_url):
+            logging.error("Invalid observations URL: %s" % observation_url)
+            defer.returnValue(None)
+
+        try:
+            logging.debug("Requesting new observation data from: %s" % observation_url)
+            request = self.fetch(observation_url)
+            self.requests.add(request)
+            try:
+                jsonString = yield request
+            except Exception:
+                if request not in self.requests:
+                    # cancelled by stop
+                    defer.returnValue(None)
+                raise
+            finally:
+                self.requests.discard(request)
+            logging.debug("Retrieved new observation data")
+            if self.parser:
+                observations = yield self.parser.parseObservations(jsonString)
+            else:
+                jsonData = json.loads(jsonString)
+                observations = Observations(jsonData)
+            defer.returnValue(observations)
+        except Exception as ex:
+            logging.error("Unable to retrieve observations data:")
+            logging.exception(ex)
+            defer.returnValue(None)
+
+    def fetch(self, observation_url):
+        """
+        Retrieve the observations JSON. Override this method to supply
+        responses from elsewhere, e.g. a txbom.replay.Recording.
+
+        @return: A deferred that returns the response body
+        @rtype: defer.Deferred
+        """
+        agent = self.prewarmer.agent if self.prewarmer is not None else None
+        return fetch(observation_url, compressed=self.compressed,
+                     stats=self.transferStats, agent=agent, connections=self.connections)
+
+    def observationsReceived(self, observations):
+        """
+        Override this method to receive observation updates as they are
+        retrieved.
+        """
+        pass
+
+    def publishObservations(self, observations):
+        """
+        Pass the observations to the publisher, if one is set, so that
+        subscribers are notified of any changes.
+        """
+        if self.publisher:
+            self.publisher.publish(observations)
+
+
+def get_observations(observation_url, parser=None):
+    """
+    Retrieve the latest observations from the BOM.
+    Returns a deferred to the caller that will eventually return a
+    Observations object or None.
+
+    @param parser: An optional txbom.bulk.OffReactorParser used to parse
+                   the response away from the reactor thread.
+
+    @return: A deferred that returns a Observations object
+    @rtype: defer.Deferred
+    """
+    logging.debug("Retrieving observations from url %s" % (observation_url))
+    return Client(parser=parser).get_observations(observation_url)
+
+
+if sys.version_info < (3, 7):
+    # See the note at the end of txbom.observations
+    _module = sys.modules["txbom.observations"]
+    for _name in _module.TransportNames:
+        setattr(_module, _name, globals()[_name])